@@ -0,0 +1,70 @@
+"""
+Hydration benchmark for LedgerAmount columns.
+
+Loads Ticker rows with commodity aware LedgerAmount columns, and compares
+against the old path of a plain LedgerAmount result followed by the
+load_commodities reconstructor formatting and parsing every Amount again.
+
+Usage::
+    python bench/hydration.py [rows]
+"""
+import datetime
+import sys
+import time
+
+from ledger import Amount
+from sqlalchemy_models import (sa, LedgerAmount, create_session_engine,
+                               setup_database, exchange as em)
+
+AMOUNTS = ['bid', 'ask', 'high', 'low', 'volume', 'last']
+
+
+def populate(eng, rows):
+    now = datetime.datetime.utcnow()
+    eng.execute(em.Ticker.__table__.insert(), [
+        {'bid': 769 + i % 7, 'ask': 771 + i % 5, 'high': 800, 'low': 700,
+         'volume': 10000.1 + i, 'last': 770, 'market': 'BTC_USD',
+         'exchange': 'bench', 'time': now} for i in range(rows)])
+
+
+def load_legacy(eng):
+    table = em.Ticker.__table__
+    columns = [sa.type_coerce(table.c[c], LedgerAmount()).label(c) if c in AMOUNTS else table.c[c]
+               for c in table.c.keys()]
+    loaded = []
+    for row in eng.execute(sa.select(columns)):
+        row = dict(row)
+        base, quote = row['market'].split("_")
+        for name in AMOUNTS:
+            commodity = base if name == 'volume' else quote
+            row[name] = Amount("{0:.8f} {1}".format(row[name].to_double(), commodity))
+        loaded.append(row)
+    return loaded
+
+
+def load_commodity_aware(eng):
+    return [dict(row) for row in eng.execute(sa.select([em.Ticker.__table__]))]
+
+
+def load_orm(ses):
+    ses.expunge_all()
+    return ses.query(em.Ticker).all()
+
+
+def timed(label, fn, *args):
+    start = time.time()
+    result = fn(*args)
+    elapsed = time.time() - start
+    print("%-28s %8.3fs  %10.0f rows/s" % (label, elapsed, len(result) / elapsed))
+    return elapsed
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    ses, eng = create_session_engine(uri="sqlite://")
+    setup_database(eng, models=[em.Ticker])
+    populate(eng, rows)
+    legacy = timed("legacy reconstructor", load_legacy, eng)
+    aware = timed("commodity aware", load_commodity_aware, eng)
+    timed("commodity aware (ORM)", load_orm, ses)
+    print("speedup: %.2fx" % (legacy / aware))
@@ -0,0 +1,46 @@
+"""
+Ledger entry benchmark for Trades.
+
+Compares Trade.get_ledger_entry on hydrated Trades against render_trades
+on the same trades as column tuples.
+
+Usage::
+    python bench/journal.py [rows]
+"""
+import datetime
+import sys
+import time
+
+from ledger import Amount
+from sqlalchemy_models import sa, user as um, exchange as em
+from sqlalchemy_models.journal import render_trades
+
+
+def make_trades(rows):
+    date = datetime.datetime.utcfromtimestamp(1468126581)
+    trades = []
+    for i in xrange(rows):
+        fee, fee_side = ("%s BTC" % (0.001 * (i % 3)), 'base') if i % 2 else ("%s USD" % (i % 5), 'quote')
+        trades.append(em.Trade(str(i), 'bench', 'BTC_USD', 'buy' if i % 3 else 'sell',
+                               Amount("%s BTC" % (1.1 + i % 7)), Amount("%s USD" % (770 + i % 11)),
+                               Amount(fee), fee_side, date))
+    return trades
+
+
+def timed(label, fn, *args):
+    start = time.time()
+    result = fn(*args)
+    elapsed = time.time() - start
+    print("%-28s %8.3fs  %10.0f rows/s" % (label, elapsed, len(result) / elapsed))
+    return elapsed
+
+
+if __name__ == "__main__":
+    sa.orm.class_mapper(um.User)  # configures every mapper; wallet's relationships find User by name
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    trades = make_trades(rows)
+    columns = [(t.trade_id, t.exchange, t.market, t.trade_side, t.amount.to_double(), t.price.to_double(),
+                t.fee.to_double(), t.fee_side, t.time) for t in trades]
+    legacy = timed("get_ledger_entry", lambda: [t.get_ledger_entry() for t in trades])
+    batch = timed("render_trades", render_trades, columns)
+    print("speedup: %.2fx" % (legacy / batch))
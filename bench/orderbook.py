@@ -0,0 +1,50 @@
+"""
+Order book price level benchmark.
+
+Times OrderBook updates that create and empty price levels, the only ones
+that move a side's sorted price list, at several book depths. Runs with the
+sortedcontainers extra if it is installed, or the plain list otherwise.
+
+Usage::
+    python bench/orderbook.py [updates]
+"""
+import random
+import sys
+import time
+from decimal import Decimal
+
+from sqlalchemy_models.orders import BookOrder, OrderBook, SortedList
+
+DEPTHS = [100, 1000, 10000, 100000]
+
+
+def make_book(depth):
+    book = OrderBook('bench', 'BTC_USD')
+    for i in xrange(depth):
+        book.update(BookOrder('b%d' % i, 'bid', Decimal(10000 - i), Decimal(1)))
+        book.update(BookOrder('a%d' % i, 'ask', Decimal(10001 + i), Decimal(1)))
+    return book
+
+
+def churn(book, depth, updates):
+    """Cancel a random level's only order and add one at a new level, updates times."""
+    rand = random.Random(1)
+    start = time.time()
+    for i in xrange(updates):
+        side, prefix = ('bid', 'b') if i % 2 else ('ask', 'a')
+        level = rand.randrange(depth)
+        book.remove('%s%d' % (prefix, level))
+        offset = Decimal(rand.randrange(1, 100)) / 100  # a price between the existing levels
+        price = Decimal(10000 - level) - offset if side == 'bid' else Decimal(10001 + level) + offset
+        book.update(BookOrder('%s%d' % (prefix, level), side, price, Decimal(1)))
+    return time.time() - start
+
+
+if __name__ == "__main__":
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print("price lists: %s" % ('SortedList' if SortedList is not None else 'list'))
+    for depth in DEPTHS:
+        book = make_book(depth)
+        elapsed = churn(book, depth, updates)
+        print("%7d levels per side  %8.3fs  %8.2f us per level change" % (
+            depth, elapsed, elapsed / (2 * updates) * 1e6))
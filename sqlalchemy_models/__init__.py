@@ -3,28 +3,151 @@ Base declarative and tools for model manipulation.
 """
 import copy
 import datetime
-import json
-import os
 import re
+import time
+from collections import OrderedDict
+from decimal import Decimal, ROUND_HALF_EVEN
 from ledger import Amount
 
 import sqlalchemy as sa
 import sqlalchemy.orm as orm
-from alchemyjsonschema.dictify import jsonify
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import as_declarative, declared_attr
+from sqlalchemy.sql.expression import FunctionElement
 from sqlalchemy.types import TypeDecorator, FLOAT
 
+from engine import get_engine, get_sessionmaker, pool_options, pool_stats
+from schema import (SetupResult, collect_tables, schema_fingerprints, stored_fingerprints,
+                    store_fingerprints)
+from serialize import SERIALIZERS, load_schemas, serialize, serialize_many
+
 __all__ = ['sa', 'orm', 'Base', 'generate_signature_class',
-           'LedgerAmount', 'create_session_engine', 'setup_database']
+           'LedgerAmount', 'apply_commodities', 'amount_sum',
+           'migrate_amount_storage', 'create_session_engine', 'pool_stats',
+           'setup_database', 'serialize', 'serialize_many']
+
+
+class _amount_text(FunctionElement):
+    """
+    A LedgerAmount value rendered as round-trip text, followed by a space
+    and its commodity symbol, i.e. '770.0 USD'.
+    """
+    name = 'amount_text'
+
+    def __init__(self, value, commodity, type_):
+        self.type = type_
+        self.exact = type_.amount_type.storage != 'float'
+        super(_amount_text, self).__init__(value, commodity)
+
+
+def _amount_text_result(element, add_to_result_map):
+    # Register the text itself, as visit_function does, rather than letting
+    # the summed column and commodity inside it claim the result column.
+    if add_to_result_map is not None:
+        add_to_result_map(element.name, element.name, (), element.type)
+
+
+@compiles(_amount_text)
+def _compile_amount_text(element, compiler, add_to_result_map=None, **kw):
+    _amount_text_result(element, add_to_result_map)
+    value, commodity = list(element.clauses)
+    return "CAST(%s AS VARCHAR) || ' ' || COALESCE(%s, '')" % (
+        compiler.process(value, **kw), compiler.process(commodity, **kw))
+
+
+@compiles(_amount_text, 'postgresql')
+def _compile_amount_text_pg(element, compiler, add_to_result_map=None, **kw):
+    _amount_text_result(element, add_to_result_map)
+    value, commodity = list(element.clauses)
+    return "CAST(%s AS TEXT) || ' ' || COALESCE(%s, '')" % (
+        compiler.process(value, **kw), compiler.process(commodity, **kw))
+
+
+@compiles(_amount_text, 'sqlite')
+def _compile_amount_text_sqlite(element, compiler, add_to_result_map=None, **kw):
+    if element.exact:
+        return _compile_amount_text(element, compiler, add_to_result_map=add_to_result_map, **kw)
+    _amount_text_result(element, add_to_result_map)
+    value, commodity = list(element.clauses)
+    return "printf('%%.17g', %s) || ' ' || COALESCE(%s, '')" % (
+        compiler.process(value, **kw), compiler.process(commodity, **kw))
+
+
+class _market_half(FunctionElement):
+    """
+    The base (index 0) or quote (index 1) half of a 'BASE_QUOTE' market.
+    """
+    type = sa.String()
+    name = 'market_half'
+
+    def __init__(self, market, index):
+        self.index = index
+        super(_market_half, self).__init__(market)
+
+
+@compiles(_market_half)
+def _compile_market_half(element, compiler, **kw):
+    market = compiler.process(list(element.clauses)[0], **kw)
+    if element.index == 0:
+        return "SUBSTRING(%s FROM 1 FOR POSITION('_' IN %s) - 1)" % (market, market)
+    return "SUBSTRING(%s FROM POSITION('_' IN %s) + 1)" % (market, market)
+
+
+@compiles(_market_half, 'postgresql')
+def _compile_market_half_pg(element, compiler, **kw):
+    market = compiler.process(list(element.clauses)[0], **kw)
+    return "split_part(%s, '_', %s)" % (market, element.index + 1)
+
+
+@compiles(_market_half, 'sqlite')
+def _compile_market_half_sqlite(element, compiler, **kw):
+    market = compiler.process(list(element.clauses)[0], **kw)
+    if element.index == 0:
+        return "substr(%s, 1, instr(%s, '_') - 1)" % (market, market)
+    return "substr(%s, instr(%s, '_') + 1)" % (market, market)
+
+
+class _CommodityAmountText(TypeDecorator):
+    """
+    Result type for LedgerAmount columns selected together with their
+    commodity. Builds the Amount in a single pass.
+    """
+    impl = sa.String
+
+    def __init__(self, amount_type):
+        super(_CommodityAmountText, self).__init__()
+        self.amount_type = amount_type
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        number, commodity = value.rsplit(' ', 1)
+        return self.amount_type.to_amount(self.amount_type.from_db(number), commodity)
 
 
 class LedgerAmount(TypeDecorator):
     """
     Represents a ledger amount. A decorated commodity value of high precision.
-    Does not preserve commodity, price, or other meta data.
+    Does not preserve price, or other meta data.
+
+    The commodity can be fixed, or taken from a sibling column when the row
+    is loaded. For a 'BASE_QUOTE' market column, market_side picks the half
+    to use, either 'base', 'quote' or the name of another column holding
+    one of those values.
+
+    Amounts are stored as FLOAT by default. For exact storage, use 'bigint'
+    to store an integer count of base units (10 ** scale per coin), or
+    'numeric' to store NUMERIC(precision, scale). Values with more than
+    scale decimal places are rounded half-even when bound.
 
     Usage::
         LedgerAmount()
+        LedgerAmount(commodity='BTC')
+        LedgerAmount(commodity_column='currency')
+        LedgerAmount(commodity_column='market', market_side='quote')
+        LedgerAmount(commodity_column='market', market_side='fee_side')
+        LedgerAmount(commodity_column='currency', storage='bigint')
+        LedgerAmount(storage='numeric', precision=28, scale=8)
     """
 
     @property
@@ -33,17 +156,209 @@ class LedgerAmount(TypeDecorator):
 
     impl = FLOAT
 
+    def __init__(self, commodity=None, commodity_column=None, market_side=None,
+                 storage='float', precision=28, scale=8):
+        super(LedgerAmount, self).__init__()
+        if storage not in ('float', 'bigint', 'numeric'):
+            raise ValueError("unknown LedgerAmount storage '%s'" % storage)
+        self.commodity = commodity
+        self.commodity_column = commodity_column
+        self.market_side = market_side
+        self.storage = storage
+        self.precision = precision
+        self.scale = scale
+
+    def load_dialect_impl(self, dialect):
+        if self.storage == 'bigint':
+            return dialect.type_descriptor(sa.BigInteger())
+        elif self.storage == 'numeric':
+            return dialect.type_descriptor(sa.Numeric(self.precision, self.scale))
+        return self.impl
+
+    def to_decimal(self, value):
+        """
+        Convert a number or Amount to a Decimal rounded to this column's scale.
+
+        :param value: The number or Amount to convert
+        :rtype: Decimal
+        """
+        if isinstance(value, Amount):
+            value = Decimal(value.number().to_fullstring().replace(',', ''))
+        elif isinstance(value, float):
+            value = Decimal(repr(value))
+        elif not isinstance(value, Decimal):
+            value = Decimal(value)
+        return value.quantize(Decimal(1).scaleb(-self.scale), rounding=ROUND_HALF_EVEN)
+
+    def from_db(self, value):
+        """
+        Convert a stored value, or its text, back to a number of coins.
+
+        :param value: The value as returned by the database
+        :return: A Decimal for exact storage, or a float
+        """
+        if self.storage == 'bigint':
+            return self.to_decimal(value).scaleb(-self.scale)
+        elif self.storage == 'numeric':
+            return self.to_decimal(value)
+        return float(value)
+
+    def to_amount(self, value, commodity=None):
+        """
+        Build an Amount from a number, in the given commodity.
+
+        :param value: The number or Amount to convert
+        :param str commodity: The commodity symbol, if any
+        :rtype: Amount
+        """
+        if self.storage == 'float':
+            if isinstance(value, Amount):
+                value = value.to_double()
+            number = "{0:.8f}".format(float(value))
+        else:
+            number = "{0:.{1}f}".format(self.to_decimal(value), self.scale)
+        if commodity:
+            return Amount("{0} {1}".format(number, commodity))
+        return Amount(number)
+
+    def commodity_of(self, obj):
+        """
+        The commodity for this column on a model instance.
+
+        :param obj: The model instance this column belongs to
+        :return: The commodity symbol, or None if unknown
+        """
+        if self.commodity_column is None:
+            return self.commodity
+        commodity = getattr(obj, self.commodity_column, None)
+        if commodity is None or self.market_side is None:
+            return commodity
+        side = self.market_side
+        if side not in ('base', 'quote'):
+            side = getattr(obj, side, None)
+        return commodity.split("_")[0 if side == 'base' else 1]
+
+    def commodity_expression(self, table):
+        """
+        A SQL expression for this column's commodity in the given table.
+
+        :param table: The table or alias this column is selected from
+        :return: The expression, or None if the table can't provide it
+        """
+        if table is None or self.commodity_column not in table.c:
+            return None
+        commodity = table.c[self.commodity_column]
+        if self.market_side is None:
+            return commodity
+        if self.market_side in ('base', 'quote'):
+            return _market_half(commodity, 0 if self.market_side == 'base' else 1)
+        if self.market_side not in table.c:
+            return None
+        return sa.case([(table.c[self.market_side] == 'base', _market_half(commodity, 0))],
+                       else_=_market_half(commodity, 1))
+
+    def column_expression(self, colexpr):
+        if self.commodity_column is None:
+            return colexpr
+        commodity = self.commodity_expression(getattr(colexpr, 'table', None))
+        if commodity is None:
+            return colexpr
+        return _amount_text(colexpr, commodity, _CommodityAmountText(self))
+
     def process_bind_param(self, value, dialect):
-        if value is not None and hasattr(value, 'to_double'):
+        if value is None:
+            return value
+        elif self.storage == 'bigint':
+            return int(self.to_decimal(value).scaleb(self.scale))
+        elif self.storage == 'numeric':
+            return self.to_decimal(value)
+        elif hasattr(value, 'to_double'):
             value = float(value.to_double())
         return value
 
     def process_result_value(self, value, dialect):
         if value is not None and not isinstance(value, Amount):
-            value = Amount("{0:.8f}".format(float(value)))
+            value = self.to_amount(self.from_db(value), self.commodity)
         return value
 
 
+def amount_sum(column, commodity=None):
+    """
+    A SQL SUM() of a LedgerAmount column, loaded as an Amount.
+    Exact when the column uses 'bigint' or 'numeric' storage.
+
+    Usage::
+        amount_sum(Balance.total, commodity=Balance.currency)  # grouped by currency
+        amount_sum(Credit.amount, commodity='BTC')
+
+    :param column: The LedgerAmount column to add up
+    :param commodity: A commodity symbol, or a grouped column holding one
+    :return: The SQL expression
+    """
+    amount_type = copy.copy(column.type)
+    amount_type.commodity_column = None
+    if commodity is None or isinstance(commodity, basestring):
+        amount_type.commodity = commodity or amount_type.commodity
+        return sa.func.sum(column, type_=amount_type)
+    return _amount_text(sa.func.sum(column), commodity, _CommodityAmountText(amount_type))
+
+
+def migrate_amount_storage(eng, column):
+    """
+    Convert an existing FLOAT column to the storage its LedgerAmount now
+    declares, rounding stored values to the column's scale.
+
+    Postgres columns are altered in place. SQLite can't change column types,
+    so values are rewritten in place; integer base units are exact there up
+    to 2 ** 53. Other databases raise ValueError.
+
+    :param eng: The sqlalchemy engine to use.
+    :param column: The table column, i.e. Balance.__table__.c.total
+    """
+    amount_type = column.type
+    preparer = eng.dialect.identifier_preparer
+    table = preparer.format_table(column.table)
+    name = preparer.quote(column.name)
+    if amount_type.storage == 'float':
+        return
+    if eng.dialect.name == 'postgresql':
+        if amount_type.storage == 'bigint':
+            sql = "ALTER TABLE %s ALTER COLUMN %s TYPE BIGINT USING round(CAST(%s AS NUMERIC) * 1e%d)" % (
+                table, name, name, amount_type.scale)
+        else:
+            sql = "ALTER TABLE %s ALTER COLUMN %s TYPE NUMERIC(%d, %d) USING round(CAST(%s AS NUMERIC), %d)" % (
+                table, name, amount_type.precision, amount_type.scale, name, amount_type.scale)
+    elif eng.dialect.name == 'sqlite':
+        if amount_type.storage == 'bigint':
+            sql = "UPDATE %s SET %s = CAST(round(%s * 1e%d) AS INTEGER)" % (table, name, name, amount_type.scale)
+        else:
+            sql = "UPDATE %s SET %s = round(%s, %d)" % (table, name, name, amount_type.scale)
+    else:
+        raise ValueError("can't migrate LedgerAmount storage on %s, only postgresql and sqlite" % eng.dialect.name)
+    eng.execute(sa.text(sql))
+
+
+_AMOUNT_COLUMNS = {}
+
+
+def apply_commodities(obj):
+    """
+    Convert every LedgerAmount attribute of a model instance to an Amount
+    in its column's commodity.
+
+    :param obj: The model instance to update
+    """
+    cls = obj.__class__
+    if cls not in _AMOUNT_COLUMNS:
+        _AMOUNT_COLUMNS[cls] = [(prop.key, prop.columns[0].type)
+                                for prop in orm.class_mapper(cls).column_attrs
+                                if isinstance(prop.columns[0].type, LedgerAmount)]
+    for key, amount_type in _AMOUNT_COLUMNS[cls]:
+        value = getattr(obj, key)
+        if value is not None:
+            setattr(obj, key, amount_type.to_amount(value, amount_type.commodity_of(obj)))
+
+
 @as_declarative()
 class Base(object):
     """
@@ -83,56 +398,79 @@ def generate_signature_class(cls):
                                                         nullable=False)})
 
 
-def create_session_engine(uri=None, cfg=None):
+def create_session_engine(uri=None, cfg=None, scoped=False, **options):
     """
-    Create an sqlalchemy session and engine.
+    Create an sqlalchemy session, using the shared engine for the URI and
+    pool options. Engines and their pools are created once per process.
+
+    Pool options are read from the [db] section of the config, i.e.
+    SA_POOL_SIZE, SA_MAX_OVERFLOW, SA_POOL_TIMEOUT, SA_POOL_RECYCLE and
+    SA_POOL_PRE_PING. Keyword options override them. With an explicit uri
+    the config isn't read at all, so only keyword options apply.
 
-    :param str uri: The database URI to connect to
+    :param str uri: The database URI to connect to, instead of the config's
     :param cfg: The configuration object with database URI info.
+    :param bool scoped: Return a thread-local scoped_session instead of a session
+    :param options: Keyword arguments for create_engine, i.e. pool_size=10
     :return: The session and the engine as a list (in that order)
     """
-    if uri is not None:
-        eng = sa.create_engine(uri)
-    elif cfg is not None:
-        eng = sa.create_engine(cfg.get('db', 'SA_ENGINE_URI'))
-    else:
+    if uri is None and cfg is not None:
+        uri = cfg.get('db', 'SA_ENGINE_URI')
+        options = dict(pool_options(cfg), **options)
+    if uri is None:
         raise IOError("unable to connect to SQL database")
-    ses = orm.sessionmaker(bind=eng)()
+    eng = get_engine(uri, **options)
+    factory = get_sessionmaker(eng, scoped=scoped)
+    ses = factory if scoped else factory()
     return ses, eng
 
 
-def setup_database(eng, modules=None, models=None):
+def setup_database(eng, modules=None, models=None, fingerprint=False):
     """
-    Set up databases using create_all().
+    Set up databases with a single create_all() for the requested tables,
+    and the tables they refer to.
+
+    With fingerprint, the DDL of the tables is hashed and stored in the
+    database, and create_all() is skipped entirely while it matches.
 
     :param eng: The sqlalchemy engine to use.
     :param list modules: A list of modules with models inside.
     :param list models:  A list of models to setup.
+    :param bool fingerprint: Skip create_all() when the stored fingerprint matches
+    :rtype: SetupResult
     """
-    if modules is not None:
-        for modu in modules:
-            for m in modu.__all__:
-                getattr(modu, m).metadata.create_all(eng)
-    if models is not None:
-        for mod in models:
-            mod.metadata.create_all(eng)
+    timings = OrderedDict()
+    start = time.time()
+    tables = collect_tables(modules, models)
+    timings['collect'] = time.time() - start
+    if fingerprint and tables:
+        start = time.time()
+        fingerprints = schema_fingerprints(tables, eng.dialect)
+        matched = stored_fingerprints(eng, list(fingerprints)) == fingerprints
+        timings['fingerprint'] = time.time() - start
+        if matched:
+            return SetupResult(tables, False, timings)
+    start = time.time()
+    Base.metadata.create_all(eng, tables=tables)
+    timings['create_all'] = time.time() - start
+    if fingerprint and tables:
+        start = time.time()
+        store_fingerprints(eng, fingerprints)
+        timings['store'] = time.time() - start
+    return SetupResult(tables, True, timings)
 
 
 def get_schemas():
-    fpath = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'definitions.json')
-    schemas = ""
-    for line in open(fpath, 'r'):
-        schemas += line
-    return json.loads(schemas)['definitions']
+    return load_schemas()
 
 
 def jsonify2(obj, name):
-    # TODO replace this with a cached definitions patch
-    # this is inefficient to do each time...
-    schemas = get_schemas()
-    spec = copy.copy(schemas[name])
-    spec['definitions'] = schemas
-    for attr in obj.__dict__:
-        if isinstance(getattr(obj, attr), Amount):
-            setattr(obj, attr, getattr(obj, attr).to_double())
-    return json.dumps(jsonify(obj, spec))
+    """
+    Serialize a model object to a json string, according to its schema.
+    Reads Amounts as numbers without writing them back to the object.
+
+    :param obj: The model object
+    :param str name: The schema name, i.e. 'Trade'
+    :rtype: str
+    """
+    return SERIALIZERS.serialize(obj, name)
@@ -0,0 +1,320 @@
+"""
+API key lookups for request authentication.
+"""
+import datetime
+import threading
+from collections import namedtuple
+
+from __init__ import sa, orm
+from cache import TTLCache
+from statements import connection_for
+import user as um
+
+__all__ = ['KeyRecord', 'KeyResolver', 'NonceResult', 'advance_nonce', 'advance_nonces',
+           'PermissionRegistry', 'permissions']
+
+KEY_COLUMNS = ['key', 'user_id', 'keytype', 'permissionbits', 'deactivated_at', 'username']
+
+
+class KeyRecord(namedtuple('KeyRecord', KEY_COLUMNS)):
+    """A read-only copy of a UserKey row, with its User's username."""
+
+    def is_active(self, now=None):
+        """
+        Whether the key is not yet deactivated.
+
+        :param datetime now: The time to check at, defaults to now
+        """
+        now = now if now is not None else datetime.datetime.utcnow()
+        return self.deactivated_at is None or self.deactivated_at > now
+
+
+class KeyResolver(TTLCache):
+    """
+    A read-through cache of KeyRecords by key, each loaded with its User in
+    a single query. Entries are dropped whenever their UserKey is updated or
+    deleted through the ORM, and again when that session commits or rolls
+    back, in case another session cached the old row in between. Rows
+    changed outside the ORM are not seen until the ttl expires. Unknown keys
+    are not cached.
+
+    Usage::
+        resolver = KeyResolver()
+        record = resolver.resolve(session, key)  # None if unknown or deactivated
+        resolver.hits, resolver.misses
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        super(KeyResolver, self).__init__(maxsize=maxsize, ttl=ttl)
+        self._pending_key = 'key_resolver_%s' % id(self)
+        sa.event.listen(um.UserKey, 'after_update', self._on_flush)
+        sa.event.listen(um.UserKey, 'after_delete', self._on_flush)
+        sa.event.listen(orm.Session, 'after_commit', self._on_end)
+        sa.event.listen(orm.Session, 'after_rollback', self._on_end)
+
+    def _on_flush(self, mapper, connection, target):
+        keys = [target.key] + list(sa.inspect(target).attrs.key.history.deleted or ())  # the key itself may change
+        for key in keys:
+            self.invalidate(key)
+        session = orm.object_session(target)
+        if session is not None:
+            session.info.setdefault(self._pending_key, set()).update(keys)
+
+    def _on_end(self, session):
+        for key in session.info.pop(self._pending_key, ()):
+            self.invalidate(key)
+
+    def close(self):
+        """
+        Stop listening for UserKey flushes and session commits.
+        """
+        sa.event.remove(um.UserKey, 'after_update', self._on_flush)
+        sa.event.remove(um.UserKey, 'after_delete', self._on_flush)
+        sa.event.remove(orm.Session, 'after_commit', self._on_end)
+        sa.event.remove(orm.Session, 'after_rollback', self._on_end)
+
+    def resolve(self, session, key, active_only=True):
+        """
+        The KeyRecord for an API key.
+
+        :param session: The sqlalchemy session to load misses with
+        :param str key: The UserKey key
+        :param bool active_only: Return None for deactivated keys
+        :return: The KeyRecord, or None
+        """
+        record = self.get(key)
+        if record is None:
+            row = session.query(um.UserKey.key, um.UserKey.user_id, um.UserKey.keytype, um.UserKey.permissionbits,
+                                um.UserKey.deactivated_at, um.User.username).join(
+                um.User, um.User.id == um.UserKey.user_id).filter(um.UserKey.key == key).first()
+            if row is None:
+                return None
+            record = KeyRecord(*row)
+            self.set(key, record)
+        if active_only and not record.is_active():
+            return None
+        return record
+
+
+class NonceResult(namedtuple('NonceResult', ['accepted', 'user_id'])):
+    """
+    Whether a nonce was accepted, or replayed. The key's user_id is known
+    for accepted nonces on Postgres, and None otherwise.
+    """
+
+
+def advance_nonce(bind, key, nonce):
+    """
+    Set a UserKey's last_nonce to nonce if it is greater, in one conditional
+    UPDATE, so concurrent requests with the same key can't both pass.
+    Unknown keys are rejected like replays.
+
+    :param bind: The session, engine or connection to write with
+    :param str key: The UserKey key
+    :param int nonce: The request's nonce
+    :rtype: NonceResult
+    """
+    table = um.UserKey.__table__
+    stmt = table.update().where(sa.and_(table.c.key == key, table.c.last_nonce < nonce)).values(last_nonce=nonce)
+    with connection_for(bind) as conn:
+        if conn.dialect.name == 'postgresql':
+            row = conn.execute(stmt.returning(table.c.user_id)).first()
+            return NonceResult(row is not None, row[0] if row is not None else None)
+        return NonceResult(conn.execute(stmt).rowcount == 1, None)
+
+
+def _locked_nonces(conn, keys):
+    """Postgres: lock the keys' rows, in key order, and read their user_id and current last_nonce."""
+    table = um.UserKey.__table__
+    rows = conn.execute(sa.select([table.c.key, table.c.user_id, table.c.last_nonce]).where(
+        table.c.key.in_(sorted(keys))).order_by(table.c.key).with_for_update())
+    return dict((key, (user_id, last_nonce)) for key, user_id, last_nonce in rows)
+
+
+def _check_nonces(current, requests):
+    """
+    Each request's NonceResult, in order, given the keys' (user_id,
+    last_nonce), and the greatest accepted nonce per key.
+    """
+    current = dict(current)
+    results, latest = [], {}
+    for key, nonce in requests:
+        if key in current and nonce > current[key][1]:
+            user_id = current[key][0]
+            current[key] = (user_id, nonce)
+            latest[key] = nonce
+            results.append(NonceResult(True, user_id))
+        else:
+            results.append(NonceResult(False, None))
+    return results, latest
+
+
+def _advance_values(conn, latest):
+    """Postgres: advance each key to its greatest accepted nonce in one UPDATE ... FROM (VALUES ...)."""
+    table = um.UserKey.__table__
+    preparer = conn.dialect.identifier_preparer
+    values, params = [], {}
+    for i, (key, nonce) in enumerate(latest.items()):
+        values.append("(:k%d, CAST(:n%d AS BIGINT))" % (i, i))
+        params.update({'k%d' % i: key, 'n%d' % i: nonce})
+    sql = ("UPDATE {t} AS k SET last_nonce = v.nonce FROM (VALUES {values}) AS v ({key}, nonce) "
+           "WHERE k.{key} = v.{key} AND k.last_nonce < v.nonce").format(
+        t=preparer.format_table(table), key=preparer.quote('key'), values=", ".join(values))
+    conn.execute(sa.text(sql), **params)
+
+
+def advance_nonces(bind, requests):
+    """
+    advance_nonce for many requests, i.e. a gateway's batch. Requests are
+    checked in order, so a key's nonces must increase through the batch.
+
+    Postgres locks the keys' rows with SELECT ... FOR UPDATE, so the nonces
+    each request is checked against are current until the transaction ends,
+    then advances every key with one UPDATE ... FROM (VALUES ...). A
+    connection that is not in a transaction gets one for the batch. Other
+    databases run a conditional UPDATE per request.
+
+    :param bind: The session, engine or connection to write with
+    :param requests: A list of (key, nonce) tuples
+    :return: A list of NonceResults, in the order of requests
+    """
+    requests = list(requests)
+    with connection_for(bind) as conn:
+        if conn.dialect.name != 'postgresql':
+            return [advance_nonce(conn, key, nonce) for key, nonce in requests]
+        if not requests:
+            return []
+        if conn.in_transaction():
+            return _locked_advance(conn, requests)
+        # a bare connection would release the row locks after the SELECT
+        with conn.begin():
+            return _locked_advance(conn, requests)
+
+
+def _locked_advance(conn, requests):
+    """Lock, check and advance requests' keys, in conn's transaction."""
+    results, latest = _check_nonces(_locked_nonces(conn, set(key for key, nonce in requests)), requests)
+    if latest:
+        _advance_values(conn, latest)
+    return results
+
+
+class PermissionRegistry(object):
+    """
+    Permission names and their UserKey.permissionbits bits, with requirements
+    compiled to integer masks, so a check is a single & on a key's bits.
+
+    KeyPermission is not in user.__all__, so its table is only set up with
+    setup_database(eng, models=[KeyPermission]).
+
+    Usage::
+        permissions.load(session)  # once, from the KeyPermission rows
+        permissions.register('withdraw', 4)
+        permissions.check(record.permissionbits, 'trade', 'withdraw')
+        permissions.keys_with(session, 'withdraw')
+    """
+
+    def __init__(self):
+        self._bits = {}
+        self._masks = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def register(self, name, bit):
+        """
+        Map a permission name to its bit.
+
+        :param str name: The permission name, i.e. 'withdraw'
+        :param int bit: The permission's bit value, i.e. 4
+        :raises ValueError: If the name is already mapped to another bit
+        """
+        with self._lock:
+            if self._bits.get(name, bit) != bit:
+                raise ValueError("permission '%s' is already bit %s" % (name, self._bits[name]))
+            self._bits[name] = bit
+            self._masks.clear()
+
+    def load(self, session, reload=False):
+        """
+        Register every distinct name and permission in the KeyPermission rows.
+        Only the first call queries, unless reload is set. Nothing is
+        registered if any name has more than one bit.
+
+        :param session: The sqlalchemy session to use
+        :param bool reload: Query again, i.e. after adding KeyPermissions
+        :raises ValueError: Listing every name with conflicting bits
+        """
+        if self.loaded and not reload:
+            return
+        found = {}
+        for name, bit in session.query(um.KeyPermission.name, um.KeyPermission.permission).distinct():
+            found.setdefault(name, set()).add(bit)
+        with self._lock:
+            for name, bit in self._bits.items():
+                if name in found:
+                    found[name].add(bit)
+            conflicts = sorted((name, sorted(bits)) for name, bits in found.items() if len(bits) > 1)
+            if conflicts:
+                raise ValueError("conflicting permission bits: %s" % ", ".join(
+                    "'%s' is %s" % (name, " and ".join(str(bit) for bit in bits)) for name, bits in conflicts))
+            for name, bits in found.items():
+                self._bits[name] = bits.pop()
+            self._masks.clear()
+        self.loaded = True
+
+    def mask(self, *names):
+        """
+        The bits of all the named permissions, OR'ed together.
+
+        :raises ValueError: For an unknown permission name
+        :rtype: int
+        """
+        with self._lock:
+            mask = self._masks.get(names)
+            if mask is None:
+                mask = 0
+                for name in names:
+                    if name not in self._bits:
+                        raise ValueError("unknown permission '%s'" % name)
+                    mask |= self._bits[name]
+                self._masks[names] = mask
+        return mask
+
+    def names(self, bits):
+        """
+        The names of the permissions set in bits.
+
+        :param int bits: A UserKey's permissionbits
+        :rtype: list
+        """
+        return sorted(name for name, bit in self._bits.items() if (bits or 0) & bit == bit)
+
+    def check(self, bits, *names):
+        """
+        Whether bits has every one of the named permissions.
+
+        :param int bits: A UserKey's permissionbits, i.e. from a KeyRecord
+        :rtype: bool
+        """
+        mask = self.mask(*names)
+        return (bits or 0) & mask == mask
+
+    def criterion(self, *names):
+        """
+        A SQL condition for UserKeys with every one of the named permissions.
+        """
+        mask = self.mask(*names)
+        return um.UserKey.permissionbits.op('&')(mask) == mask
+
+    def keys_with(self, session, *names):
+        """
+        The UserKeys with every one of the named permissions, filtered in SQL.
+
+        :param session: The sqlalchemy session to use
+        :return: A UserKey query
+        """
+        return session.query(um.UserKey).filter(self.criterion(*names))
+
+
+# The process-wide registry
+permissions = PermissionRegistry()
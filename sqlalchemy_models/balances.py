@@ -0,0 +1,315 @@
+"""
+Queries for the latest Balance records, and Balances computed from Credits
+and Debits with SQL aggregates.
+"""
+import datetime
+from collections import namedtuple
+from decimal import Decimal
+
+from __init__ import sa, orm
+from cache import TTLCache
+from statements import committed_horizon
+import wallet as wm
+
+__all__ = ['BalanceRecord', 'BalanceCache', 'latest_balances', 'RecomputeResult', 'recompute_balances']
+
+BALANCE_COLUMNS = ['id', 'user_id', 'currency', 'total', 'available', 'time', 'reference']
+
+
+class BalanceRecord(namedtuple('BalanceRecord', BALANCE_COLUMNS)):
+    """A read-only copy of a Balance row. Amounts are shared, don't modify them."""
+
+
+class BalanceCache(TTLCache):
+    """
+    A read-through cache of each user's latest balances, for latest_balances.
+    Entries for a user are dropped whenever one of their Balance rows is
+    flushed by the ORM, and again when that session commits or rolls back,
+    in case another session cached the old balances in between. Rows
+    written outside the ORM are not seen until the ttl expires.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        super(BalanceCache, self).__init__(maxsize=maxsize, ttl=ttl)
+        self._pending_key = 'balance_cache_%s' % id(self)
+        sa.event.listen(wm.Balance, 'after_insert', self._on_flush)
+        sa.event.listen(wm.Balance, 'after_update', self._on_flush)
+        sa.event.listen(wm.Balance, 'after_delete', self._on_flush)
+        sa.event.listen(orm.Session, 'after_commit', self._on_end)
+        sa.event.listen(orm.Session, 'after_rollback', self._on_end)
+
+    def _on_flush(self, mapper, connection, target):
+        self.invalidate(target.user_id)
+        session = orm.object_session(target)
+        if session is not None:
+            session.info.setdefault(self._pending_key, set()).add(target.user_id)
+
+    def _on_end(self, session):
+        for user_id in session.info.pop(self._pending_key, ()):
+            self.invalidate(user_id)
+
+    def close(self):
+        """
+        Stop listening for Balance flushes and session commits.
+        """
+        sa.event.remove(wm.Balance, 'after_insert', self._on_flush)
+        sa.event.remove(wm.Balance, 'after_update', self._on_flush)
+        sa.event.remove(wm.Balance, 'after_delete', self._on_flush)
+        sa.event.remove(orm.Session, 'after_commit', self._on_end)
+        sa.event.remove(orm.Session, 'after_rollback', self._on_end)
+
+
+def _latest_query(session, user_id):
+    columns = [getattr(wm.Balance, c) for c in BALANCE_COLUMNS]
+    if session.get_bind(mapper=sa.inspect(wm.Balance)).dialect.name == 'postgresql':
+        query = session.query(*columns).distinct(wm.Balance.user_id, wm.Balance.currency).order_by(
+            wm.Balance.user_id, wm.Balance.currency, wm.Balance.time.desc(), wm.Balance.id.desc())
+        if user_id is not None:
+            query = query.filter(wm.Balance.user_id == user_id)
+        return query
+    rank = sa.func.row_number().over(partition_by=(wm.Balance.user_id, wm.Balance.currency),
+                                     order_by=(wm.Balance.time.desc(), wm.Balance.id.desc()))
+    ranked = session.query(wm.Balance.__table__, rank.label('rank'))
+    if user_id is not None:
+        ranked = ranked.filter(wm.Balance.user_id == user_id)
+    ranked = ranked.subquery()
+    return session.query(*[ranked.c[c] for c in BALANCE_COLUMNS]).filter(ranked.c.rank == 1).order_by(
+        ranked.c.user_id, ranked.c.currency)
+
+
+def latest_balances(session, user_id=None, cache=None):
+    """
+    The latest Balance for each user and currency, in a single query. Uses
+    DISTINCT ON with Postgres, or a row_number() window elsewhere.
+
+    :param session: The sqlalchemy session to use
+    :param int user_id: Only return this user's balances
+    :param BalanceCache cache: A cache to read a single user's balances through
+    :return: A list of BalanceRecords, ordered by user_id and currency
+    """
+    if cache is not None and user_id is not None:
+        records = cache.get(user_id)
+        if records is not None:
+            return list(records)
+    records = [BalanceRecord(*row) for row in _latest_query(session, user_id)]
+    if cache is not None and user_id is not None:
+        cache.set(user_id, tuple(records))
+    return records
+
+
+# Kept out of the models' metadata, like the schema fingerprints.
+checkpoint_metadata = sa.MetaData()
+checkpoint_mark_table = sa.Table('balance_checkpoint_mark', checkpoint_metadata,
+                                 sa.Column('name', sa.String(16), primary_key=True),  # the model's table
+                                 sa.Column('mark_id', sa.Integer, nullable=False),
+                                 sa.Column('time', sa.DateTime(), nullable=False))
+# Totals are stored in units of the amounts' scale, i.e. satoshis, to stay exact.
+checkpoint_total_table = sa.Table('balance_checkpoint_total', checkpoint_metadata,
+                                  sa.Column('user_id', sa.Integer, primary_key=True),
+                                  sa.Column('currency', sa.String(4), primary_key=True),
+                                  sa.Column('total', sa.BigInteger, nullable=False),
+                                  sa.Column('available', sa.BigInteger, nullable=False))
+
+# The pg_advisory_xact_lock key serializing recompute_balances.
+CHECKPOINT_LOCK = 0x62616c61
+
+# (model, transaction_state): (sign for total, sign for available). Other states don't count.
+EFFECTS = {(wm.Credit, 'complete'): (1, 1),
+           (wm.Credit, 'unconfirmed'): (1, 0),
+           (wm.Debit, 'complete'): (-1, -1),
+           (wm.Debit, 'unconfirmed'): (-1, -1)}
+
+
+class RecomputeResult(namedtuple('RecomputeResult', ['balances', 'marks', 'mismatches'])):
+    """
+    The (total, available) Decimals written per (user_id, currency), the
+    checkpoint's new high-water ids, and (user_id, currency, incremental,
+    full) tuples for any totals a verification found to differ.
+    """
+
+
+def _amount_type():
+    return wm.Credit.amount.property.columns[0].type
+
+
+def _settled_mark(conn, table, start, horizon=None):
+    """
+    The highest id below which every row after start is in a final state,
+    and at most horizon, when given.
+    """
+    pending = conn.execute(sa.select([sa.func.min(table.c.id)]).where(
+        sa.and_(table.c.id > start, table.c.transaction_state == 'unconfirmed'))).scalar()
+    if pending is not None:
+        mark = pending - 1
+    else:
+        mark = conn.execute(sa.select([sa.func.max(table.c.id)])).scalar() or start
+    return mark if horizon is None else min(mark, horizon)
+
+
+def _lock_checkpoint(conn):
+    """
+    Hold the checkpoint until the transaction ends, so concurrent
+    recompute_balances calls run one after another. Postgres takes an
+    advisory lock, other databases a write lock with a no-op UPDATE.
+    """
+    if conn.dialect.name == 'postgresql':
+        conn.execute(sa.select([sa.func.pg_advisory_xact_lock(CHECKPOINT_LOCK)]))
+    else:
+        conn.execute(checkpoint_mark_table.update().values(mark_id=checkpoint_mark_table.c.mark_id))
+
+
+def _aggregate(conn, model, start, mark):
+    """
+    Sum a model's amounts after start per (user_id, currency), split into the
+    rows up to mark, which can be checkpointed, and the unsettled ones after it.
+
+    :return: Two dicts of [total, available] Decimals by (user_id, currency)
+    """
+    table = model.__table__
+    amount_type = _amount_type()
+    raw = amount_type.load_dialect_impl(conn.dialect)
+    amount = sa.type_coerce(table.c.amount, raw)
+    if 'fee' in table.c:
+        amount = amount + sa.type_coerce(table.c.fee, raw)
+    settled = sa.case([(table.c.id <= mark, 1)], else_=0)
+    rows = conn.execute(sa.select([table.c.user_id, table.c.currency, table.c.transaction_state, settled,
+                                   sa.func.sum(amount)]).where(table.c.id > start).group_by(
+        table.c.user_id, table.c.currency, table.c.transaction_state, settled))
+    done, tail = {}, {}
+    for user_id, currency, state, is_settled, value in rows:
+        if (model, state) not in EFFECTS:
+            continue
+        value = amount_type.to_decimal(amount_type.from_db(value))
+        totals = (done if is_settled else tail).setdefault((user_id, currency), [Decimal(0), Decimal(0)])
+        for i, sign in enumerate(EFFECTS[(model, state)]):
+            totals[i] += sign * value
+    return done, tail
+
+
+def _add(into, totals):
+    for key, (total, available) in totals.items():
+        current = into.setdefault(key, [Decimal(0), Decimal(0)])
+        current[0] += total
+        current[1] += available
+
+
+def _load_marks(conn):
+    """The stored high-water ids by table name."""
+    return dict(conn.execute(sa.select([checkpoint_mark_table.c.name, checkpoint_mark_table.c.mark_id])).fetchall())
+
+
+def _load_totals(conn, user_ids):
+    """The stored [total, available] Decimals of some users, by (user_id, currency)."""
+    totals = {}
+    scale = _amount_type().scale
+    user_ids = sorted(user_ids)
+    for start in range(0, len(user_ids), 500):
+        rows = conn.execute(sa.select([checkpoint_total_table]).where(
+            checkpoint_total_table.c.user_id.in_(user_ids[start:start + 500])))
+        for user_id, currency, total, available in rows:
+            totals[(user_id, currency)] = [Decimal(total).scaleb(-scale), Decimal(available).scaleb(-scale)]
+    return totals
+
+
+def _store_checkpoint(conn, marks, totals, full):
+    scale = _amount_type().scale
+    now = datetime.datetime.utcnow()
+    conn.execute(checkpoint_mark_table.delete())
+    conn.execute(checkpoint_mark_table.insert(), [{'name': name, 'mark_id': mark_id, 'time': now}
+                                                  for name, mark_id in marks.items()])
+    if full:
+        conn.execute(checkpoint_total_table.delete())
+    else:
+        user_ids = sorted(set(k[0] for k in totals))
+        for start in range(0, len(user_ids), 500):
+            conn.execute(checkpoint_total_table.delete().where(
+                checkpoint_total_table.c.user_id.in_(user_ids[start:start + 500])))
+    if totals:
+        conn.execute(checkpoint_total_table.insert(), [
+            {'user_id': user_id, 'currency': currency, 'total': int(total.scaleb(scale)),
+             'available': int(available.scaleb(scale))} for (user_id, currency), (total, available) in totals.items()])
+
+
+def _full_totals(conn):
+    totals = {}
+    for model in (wm.Credit, wm.Debit):
+        done, tail = _aggregate(conn, model, 0, 0)
+        _add(totals, tail)
+    return totals
+
+
+def recompute_balances(session, full=False, verify=False, reference='recompute_balances', cache=None):
+    """
+    Write new Balance snapshots computed from Credits and Debits with grouped
+    SQL aggregates, reading only the rows added since the last checkpoint.
+
+    Complete Credits add to the total and available amounts, and unconfirmed
+    ones only to the total. Complete and unconfirmed Debits subtract their
+    amount and fee from both. Trades have no user, so they don't count.
+
+    The checkpoint stores a high-water id per table and the totals up to it.
+    The mark stops before the oldest unconfirmed row, whose state may still
+    change, so rows after it are aggregated again on every run. A snapshot
+    is written for each user and currency with rows after the previous mark.
+
+    A row committed after one with a higher id would land below the mark and
+    never be counted. On Postgres the mark is also kept at or below the ids
+    committed when every open Credit and Debit write has ended, which holds
+    as long as ids are drawn by the INSERTs themselves, as the models do.
+    SQLite has one writer at a time. Other databases must commit rows in id
+    order. The checkpoint is locked until the caller's transaction ends, so
+    concurrent calls don't count rows twice.
+
+    :param session: The sqlalchemy session to use. The caller commits. It
+                    must not hold uncommitted Credit or Debit writes, which
+                    the Postgres horizon would wait on.
+    :param bool full: Ignore the stored checkpoint and aggregate every row,
+                      writing a snapshot for every user and currency
+    :param bool verify: Also aggregate every row and report any totals that differ
+    :param str reference: The reference of the written Balances
+    :param BalanceCache cache: A cache to drop the updated users from, since
+                               Balances are written with core inserts
+    :rtype: RecomputeResult
+    """
+    conn = session.connection()
+    checkpoint_metadata.create_all(conn)
+    _lock_checkpoint(conn)
+    tables = dict((model, model.__table__) for model in (wm.Credit, wm.Debit))
+    horizon = committed_horizon(conn, tables.values()) if conn.dialect.name == 'postgresql' else {}
+    stored = {} if full else _load_marks(conn)
+    starts = dict((model, stored.get(table.name, 0)) for model, table in tables.items())
+    marks = dict((model, _settled_mark(conn, table, starts[model], horizon.get(table)))
+                 for model, table in tables.items())
+    done, tail = {}, {}
+    for model in tables:
+        model_done, model_tail = _aggregate(conn, model, starts[model], marks[model])
+        _add(done, model_done)
+        _add(tail, model_tail)
+    touched = set(done) | set(tail)
+    checkpoint = {} if full else _load_totals(conn, set(k[0] for k in touched))
+    _add(checkpoint, done)
+    _store_checkpoint(conn, dict((tables[m].name, mark) for m, mark in marks.items()), checkpoint, full)
+    balances = dict((k, list(v)) for k, v in checkpoint.items() if k in touched)
+    _add(balances, tail)
+    mismatches = []
+    if verify:
+        everything = _full_totals(conn)
+        current = _load_totals(conn, set(k[0] for k in everything))
+        _add(current, tail)  # every row after the new marks
+        for key in sorted(set(everything) | set(current)):
+            expected = everything.get(key, [Decimal(0), Decimal(0)])
+            got = current.get(key, [Decimal(0), Decimal(0)])
+            if expected != got:
+                mismatches.append((key[0], key[1], tuple(got), tuple(expected)))
+    amount_type = _amount_type()
+    now = datetime.datetime.utcnow()
+    if balances:
+        conn.execute(wm.Balance.__table__.insert(), [
+            {'user_id': user_id, 'currency': currency, 'total': amount_type.to_amount(total, currency),
+             'available': amount_type.to_amount(available, currency), 'reference': reference, 'time': now}
+            for (user_id, currency), (total, available) in sorted(balances.items())])
+    if cache is not None:
+        for user_id in set(k[0] for k in balances):
+            cache.invalidate(user_id)
+    return RecomputeResult(dict((k, tuple(v)) for k, v in balances.items()),
+                           dict((tables[m].name, mark) for m, mark in marks.items()), mismatches)
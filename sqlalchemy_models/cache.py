@@ -0,0 +1,71 @@
+"""
+A small in-process cache for read-through lookups.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+__all__ = ['TTLCache']
+
+_missing = object()
+
+
+class TTLCache(object):
+    """
+    A bounded, thread safe LRU cache. Entries expire ttl seconds after they
+    are set, or never if ttl is None.
+
+    Usage::
+        cache = TTLCache(maxsize=1024, ttl=60)
+        cache.set(key, value)
+        cache.get(key)  # value, or None once expired or evicted
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        The cached value for key, or default on a miss.
+        """
+        with self._lock:
+            value, expires = self._data.pop(key, (_missing, None))
+            if value is _missing or (expires is not None and expires < time.time()):
+                self.misses += 1
+                return default
+            self._data[key] = (value, expires)  # most recently used goes last
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Cache a value, evicting the least recently used entry when full.
+        """
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Drop the cached value for key, if any.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Drop every cached value.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
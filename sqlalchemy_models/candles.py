@@ -0,0 +1,222 @@
+"""
+Incremental Candle rollups from Ticker rows.
+"""
+import datetime
+from collections import OrderedDict
+
+from __init__ import sa, orm, LedgerAmount
+from statements import committed_horizon
+import exchange as em
+
+__all__ = ['INTERVALS', 'bucket_start', 'update_candles', 'get_candles']
+
+# Candle intervals in seconds, each rolled up from the one before it
+INTERVALS = OrderedDict([('1m', 60), ('5m', 300), ('1h', 3600), ('1d', 86400)])
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# The pg_advisory_xact_lock key serializing update_candles.
+CANDLE_LOCK = 0x63616e64
+
+TICKER_FIELDS = ['id', 'exchange', 'market', 'time', 'last', 'bid', 'ask', 'volume']
+CANDLE_FIELDS = ['id', 'exchange', 'market', 'bucket_start', 'open', 'high', 'low', 'close', 'bid',
+                 'ask', 'volume', 'ticker_count', 'open_time', 'close_time', 'ticker_id']
+
+
+def bucket_start(time, interval):
+    """
+    The start of the interval's bucket holding a time. Buckets are aligned to
+    the unix epoch, so days start at midnight UTC.
+
+    :param datetime time: A naive UTC datetime
+    :param str interval: One of INTERVALS, i.e. '5m'
+    :rtype: datetime
+    """
+    seconds = INTERVALS[interval]
+    elapsed = int((time - EPOCH).total_seconds())
+    return EPOCH + datetime.timedelta(seconds=elapsed - elapsed % seconds)
+
+
+def _select(session, model, fields):
+    """Column expressions for a model, with amounts selected as stored numbers."""
+    dialect = session.get_bind(mapper=orm.class_mapper(model)).dialect
+    columns = []
+    for name in fields:
+        column = getattr(model, name)
+        column_type = column.property.columns[0].type
+        if isinstance(column_type, LedgerAmount):
+            column = sa.type_coerce(column, column_type.load_dialect_impl(dialect))
+        columns.append(column.label(name))
+    return columns
+
+
+def _from_db(model, rows, fields):
+    """Rows as dicts, with amounts converted to numbers."""
+    types = [(name, getattr(model, name).property.columns[0].type) for name in fields]
+    types = [(name, t) for name, t in types if isinstance(t, LedgerAmount)]
+    dicts = []
+    for row in rows:
+        d = dict(zip(fields, row))
+        for name, amount_type in types:
+            d[name] = amount_type.from_db(d[name])
+        dicts.append(d)
+    return dicts
+
+
+def _fold(candles):
+    """Combine candles, or single ticker candles, into one."""
+    first = min(candles, key=lambda c: (c['open_time'], c['ticker_id']))
+    last = max(candles, key=lambda c: (c['close_time'], c['ticker_id']))
+    return {'open': first['open'], 'high': max(c['high'] for c in candles),
+            'low': min(c['low'] for c in candles), 'close': last['close'], 'bid': last['bid'],
+            'ask': last['ask'], 'volume': last['volume'],
+            'ticker_count': sum(c['ticker_count'] for c in candles),
+            'open_time': first['open_time'], 'close_time': last['close_time'],
+            'ticker_id': max(c['ticker_id'] for c in candles)}
+
+
+def _existing(session, interval, keys):
+    """The stored candles for (exchange, market, bucket_start) keys, by key."""
+    if not keys:
+        return {}
+    rows = session.query(*_select(session, em.Candle, CANDLE_FIELDS)).filter(
+        em.Candle.interval == interval,
+        em.Candle.exchange.in_(set(k[0] for k in keys)),
+        em.Candle.market.in_(set(k[1] for k in keys)),
+        em.Candle.bucket_start.in_(set(k[2] for k in keys)))
+    candles = _from_db(em.Candle, rows, CANDLE_FIELDS)
+    return dict(((c['exchange'], c['market'], c['bucket_start']), c) for c in candles
+                if (c['exchange'], c['market'], c['bucket_start']) in keys)
+
+
+def _write(session, interval, folded, existing):
+    """Insert new candles and update changed ones, with core statements."""
+    table = em.Candle.__table__
+    inserts, updates = [], []
+    for key, values in folded.items():
+        if key in existing:
+            params = dict(("new_%s" % k, v) for k, v in values.items())
+            updates.append(dict(params, candle_id=existing[key]['id']))
+        else:
+            inserts.append(dict(values, exchange=key[0], market=key[1], bucket_start=key[2],
+                                interval=interval))
+    conn = session.connection()
+    if inserts:
+        conn.execute(table.insert(), inserts)
+    if updates:
+        # bind names can't match the columns being set
+        conn.execute(table.update().where(table.c.id == sa.bindparam('candle_id')).values(
+            **dict((k, sa.bindparam("new_%s" % k)) for k in folded.values()[0])), updates)
+
+
+def _update_minutes(session, tickers):
+    """Fold tickers into their 1m candles. Returns the touched bucket keys."""
+    buckets = OrderedDict()
+    for t in tickers:
+        key = (t['exchange'], t['market'], bucket_start(t['time'], '1m'))
+        buckets.setdefault(key, []).append(
+            {'open': t['last'], 'high': t['last'], 'low': t['last'], 'close': t['last'],
+             'bid': t['bid'], 'ask': t['ask'], 'volume': t['volume'], 'ticker_count': 1,
+             'open_time': t['time'], 'close_time': t['time'], 'ticker_id': t['id']})
+    existing = _existing(session, '1m', set(buckets))
+    folded = {}
+    for key, parts in buckets.items():
+        folded[key] = _fold(parts + [existing[key]] if key in existing else parts)
+    _write(session, '1m', folded, existing)
+    return set(buckets)
+
+
+def _roll_up(session, interval, child_interval, child_keys):
+    """Recompute the candles of an interval from their child candles."""
+    keys = set((e, m, bucket_start(start, interval)) for e, m, start in child_keys)
+    folded = {}
+    for exchange, market, start in keys:
+        end = start + datetime.timedelta(seconds=INTERVALS[interval])
+        rows = session.query(*_select(session, em.Candle, CANDLE_FIELDS)).filter(
+            em.Candle.exchange == exchange, em.Candle.market == market,
+            em.Candle.interval == child_interval,
+            em.Candle.bucket_start >= start, em.Candle.bucket_start < end).order_by(em.Candle.bucket_start)
+        folded[(exchange, market, start)] = _fold(_from_db(em.Candle, rows, CANDLE_FIELDS))
+    _write(session, interval, folded, _existing(session, interval, keys))
+    return keys
+
+
+def _lock_candles(conn):
+    """
+    Hold the candles until the transaction ends, so concurrent update_candles
+    calls run one after another. Postgres takes an advisory lock, other
+    databases a write lock with an UPDATE that matches no rows.
+    """
+    if conn.dialect.name == 'postgresql':
+        conn.execute(sa.select([sa.func.pg_advisory_xact_lock(CANDLE_LOCK)]))
+    else:
+        table = em.Candle.__table__
+        conn.execute(table.update().where(sa.false()).values(id=table.c.id))
+
+
+def update_candles(session, batch_size=10000):
+    """
+    Fold the Tickers inserted since the last update into 1m candles, then
+    roll the touched candles up through 5m, 1h and 1d.
+
+    The high-water mark is the highest Ticker id in a 1m candle. Postgres
+    draws ids before commit, i.e. with several pollers or bulk_insert_tickers'
+    COPY, so only Tickers up to the committed horizon are folded in, and a
+    Ticker committed late with a lower id is still above the mark next time.
+    Other databases must commit Tickers in id order, as SQLite does. The
+    candles are locked until the caller's transaction ends, so concurrent
+    calls don't count Tickers twice. Tickers are read batch_size at a time.
+
+    :param session: The sqlalchemy session to use. The caller commits. It
+                    must not hold uncommitted Ticker writes, which the
+                    Postgres horizon would wait on.
+    :param int batch_size: The number of Tickers to read per batch
+    :return: The number of Tickers folded in
+    """
+    conn = session.connection(mapper=orm.class_mapper(em.Candle))
+    _lock_candles(conn)
+    horizon = None
+    if conn.dialect.name == 'postgresql':
+        horizon = committed_horizon(conn, [em.Ticker.__table__])[em.Ticker.__table__]
+    mark = session.query(sa.func.max(em.Candle.ticker_id)).filter(em.Candle.interval == '1m').scalar() or 0
+    count = 0
+    while True:
+        query = session.query(*_select(session, em.Ticker, TICKER_FIELDS)).filter(em.Ticker.id > mark)
+        if horizon is not None:
+            query = query.filter(em.Ticker.id <= horizon)
+        rows = query.order_by(em.Ticker.id).limit(batch_size).all()
+        if not rows:
+            break
+        tickers = _from_db(em.Ticker, rows, TICKER_FIELDS)
+        keys = _update_minutes(session, tickers)
+        intervals = list(INTERVALS)
+        for child_interval, interval in zip(intervals, intervals[1:]):
+            keys = _roll_up(session, interval, child_interval, keys)
+        mark = tickers[-1]['id']
+        count += len(tickers)
+        if len(rows) < batch_size:
+            break
+    return count
+
+
+def get_candles(session, exchange, market, interval, start=None, end=None):
+    """
+    The candles for a market, oldest first, without reading Tickers.
+
+    :param session: The sqlalchemy session to use
+    :param str exchange: The exchange, i.e. 'kraken'
+    :param str market: The market, i.e. 'BTC_USD'
+    :param str interval: One of INTERVALS, i.e. '1h'
+    :param datetime start: Only candles starting at or after this time
+    :param datetime end: Only candles starting before this time
+    :rtype: list
+    """
+    if interval not in INTERVALS:
+        raise ValueError("unknown candle interval '%s'" % interval)
+    query = session.query(em.Candle).filter(em.Candle.exchange == exchange, em.Candle.market == market,
+                                            em.Candle.interval == interval)
+    if start is not None:
+        query = query.filter(em.Candle.bucket_start >= start)
+    if end is not None:
+        query = query.filter(em.Candle.bucket_start < end)
+    return query.order_by(em.Candle.bucket_start).all()
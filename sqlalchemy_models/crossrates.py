@@ -0,0 +1,219 @@
+"""
+Best-path cross rates between every pair of currencies in a set of Tickers.
+
+Requires numpy, i.e. pip install sqlalchemy-models[numpy]
+"""
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import exchange as em
+
+__all__ = ['CrossRates']
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is required for cross rates, install sqlalchemy-models[numpy]")
+
+
+def _number(value):
+    return value.to_double() if hasattr(value, 'to_double') else float(value)
+
+
+class CrossRates(object):
+    """
+    A currency graph built from Tickers, with the best synthetic bid and ask
+    for every reachable pair.
+
+    Each Ticker for BASE_QUOTE is an edge selling BASE at the bid, and one
+    buying BASE at the ask. Rates are found with a shortest path over
+    -log(rate), so the best bid for X_Y is the most Y one X can be sold for,
+    and the best ask is the least Y one X can be bought for. With several
+    exchanges for a market, each direction uses the best of them.
+
+    Updating a Ticker with better rates only relaxes paths through it;
+    anything else recomputes the whole matrix on the next lookup.
+
+    Crossed markets, where one exchange bids more than another asks, make
+    arbitrage cycles. Rates for pairs whose paths can reach a cycle are not
+    defined, and raise ValueError.
+
+    Usage::
+        rates = CrossRates(tickers)
+        rates.ticker('DASH', 'USD')  # like multiply_tickers(dash_btc, btc_usd)
+        rates.update(new_ticker)
+    """
+
+    def __init__(self, tickers=()):
+        _require_numpy()
+        self._tickers = {}  # (exchange, market): Ticker
+        self._currencies = []
+        self._index = {}
+        self._edges = {}  # (from, to): (weight, Ticker)
+        self._dist = None
+        self._next = None
+        self._cache = {}
+        for ticker in tickers:
+            self._tickers[(ticker.exchange, ticker.market)] = ticker
+        self._rebuild_edges()
+
+    @property
+    def currencies(self):
+        return list(self._currencies)
+
+    def _invalidate(self):
+        self._dist = None
+        self._cache = {}
+
+    def _add_currency(self, currency):
+        if currency not in self._index:
+            self._index[currency] = len(self._currencies)
+            self._currencies.append(currency)
+            self._invalidate()
+
+    def _market_edges(self, market):
+        """The best (weight, Ticker) for each direction of a market."""
+        base, quote = market.split("_")
+        sell, buy = (float('inf'), None), (float('inf'), None)
+        for (exchange, m), ticker in self._tickers.items():
+            if m != market:
+                continue
+            bid, ask = _number(ticker.bid), _number(ticker.ask)
+            if bid > 0 and -math.log(bid) < sell[0]:
+                sell = (-math.log(bid), ticker)
+            if ask > 0 and math.log(ask) < buy[0]:
+                buy = (math.log(ask), ticker)
+        return {(base, quote): sell, (quote, base): buy}
+
+    def _rebuild_edges(self):
+        self._edges = {}
+        for market in set(m for e, m in self._tickers):
+            for currency in market.split("_"):
+                self._add_currency(currency)
+            self._edges.update(self._market_edges(market))
+        self._invalidate()
+
+    def _compute(self):
+        """Floyd-Warshall over the whole graph, one vectorized step per currency."""
+        n = len(self._currencies)
+        dist = np.full((n, n), np.inf)
+        nxt = np.tile(np.arange(n), (n, 1))
+        np.fill_diagonal(dist, 0)
+        for (src, dst), (weight, ticker) in self._edges.items():
+            dist[self._index[src], self._index[dst]] = weight
+        for k in range(n):
+            candidate = dist[:, k, None] + dist[None, k, :]
+            better = candidate < dist
+            dist = np.where(better, candidate, dist)
+            nxt = np.where(better, nxt[:, k, None], nxt)
+        self._dist, self._next = dist, nxt
+        self._cache = {}
+
+    def _relax(self, src, dst, weight):
+        """Relax every path through an improved edge."""
+        u, v = self._index[src], self._index[dst]
+        candidate = self._dist[:, u, None] + weight + self._dist[None, v, :]
+        better = candidate < self._dist
+        hop = self._next[:, u].copy()
+        hop[u] = v
+        self._dist = np.where(better, candidate, self._dist)
+        self._next = np.where(better, hop[:, None], self._next)
+        self._cache = {}
+
+    def update(self, ticker):
+        """
+        Add or replace the Ticker for its exchange and market.
+
+        :param Ticker ticker: The new Ticker
+        """
+        old_edges = self._market_edges(ticker.market)
+        self._tickers[(ticker.exchange, ticker.market)] = ticker
+        new_edges = self._market_edges(ticker.market)
+        self._edges.update(new_edges)
+        for currency in ticker.market.split("_"):
+            self._add_currency(currency)
+        if self._dist is None:
+            return
+        if any(new_edges[key][0] > old_edges[key][0] for key in new_edges):
+            self._invalidate()  # a rate got worse, paths through it may no longer be best
+            return
+        for (src, dst), (weight, t) in new_edges.items():
+            self._relax(src, dst, weight)
+
+    def _path(self, src, dst):
+        """The currencies on the best path from src to dst."""
+        u, v = self._index[src], self._index[dst]
+        path = [u]
+        while u != v:
+            u = self._next[u, v]
+            path.append(u)
+            if len(path) > len(self._currencies):
+                raise ValueError("arbitrage cycle on the path from %s to %s" % (src, dst))
+        return [self._currencies[i] for i in path]
+
+    def _hops(self, path):
+        """The Tickers for each step of a path, and whether the step sells their base."""
+        return [(self._edges[(a, b)][1], self._edges[(a, b)][1].market == "%s_%s" % (a, b))
+                for a, b in zip(path, path[1:])]
+
+    def rate(self, src, dst):
+        """
+        The best number of dst one src can be converted to.
+
+        :param str src: The currency to sell
+        :param str dst: The currency to buy
+        :return: The rate, or None if dst can't be reached
+        """
+        if self._dist is None:
+            self._compute()
+        if src not in self._index or dst not in self._index:
+            return None
+        u, v = self._index[src], self._index[dst]
+        cycles = np.flatnonzero(np.diagonal(self._dist) < -1e-12)
+        if len(cycles) and np.isfinite(self._dist[u, cycles] + self._dist[cycles, v]).any():
+            raise ValueError("arbitrage cycle between %s and %s" % (src, dst))
+        dist = self._dist[u, v]
+        return math.exp(-dist) if dist != np.inf else None
+
+    def ticker(self, base, quote):
+        """
+        The synthetic Ticker for a pair, with exchange 'multiple' like
+        multiply_tickers. The bid and ask use their best paths, high, low and
+        last are multiplied along the bid's path, and volume is 0.
+
+        :param str base: The base currency
+        :param str quote: The quote currency
+        :return: The Ticker, or None if either side can't be reached
+        """
+        if (base, quote) in self._cache:
+            return self._cache[(base, quote)]
+        bid, inverse_ask = self.rate(base, quote), self.rate(quote, base)
+        if base == quote or bid is None or inverse_ask is None:
+            return None
+        high = low = last = 1.0
+        hops = self._hops(self._path(base, quote))
+        for t, sells_base in hops:
+            if sells_base:
+                high, low, last = high * _number(t.high), low * _number(t.low), last * _number(t.last)
+            else:
+                high, low, last = high / _number(t.low), low / _number(t.high), last / _number(t.last)
+        ticker = em.Ticker(bid=bid, ask=1 / inverse_ask, high=high, low=low, volume=0, last=last,
+                           market="%s_%s" % (base, quote), exchange='multiple',
+                           time=min(t.time for t, sells_base in hops))
+        self._cache[(base, quote)] = ticker
+        return ticker
+
+    def tickers(self):
+        """
+        The synthetic Tickers for every reachable pair of currencies.
+
+        :rtype: list
+        """
+        if self._dist is None:
+            self._compute()
+        pairs = [(a, b) for a in self._currencies for b in self._currencies if a != b]
+        return [t for t in (self.ticker(a, b) for a, b in pairs) if t is not None]
@@ -0,0 +1,190 @@
+"""
+A registry of shared engines, with configurable, instrumented connection pools.
+"""
+import threading
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+from sqlalchemy.pool import QueuePool
+
+__all__ = ['PoolStats', 'TimedQueuePool', 'POOL_OPTIONS', 'pool_options', 'get_engine',
+           'get_sessionmaker', 'pool_stats', 'dispose_engines']
+
+# [db] config keys for pool settings, and the create_engine arguments they set
+POOL_OPTIONS = {'SA_POOL_SIZE': ('pool_size', int),
+                'SA_MAX_OVERFLOW': ('max_overflow', int),
+                'SA_POOL_TIMEOUT': ('pool_timeout', float),
+                'SA_POOL_RECYCLE': ('pool_recycle', int),
+                'SA_POOL_PRE_PING': ('pool_pre_ping', bool)}
+
+# options only a QueuePool accepts
+QUEUE_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+_ENGINES = {}
+_SESSIONMAKERS = {}
+_STATS = {}
+_lock = threading.Lock()
+
+
+class PoolStats(object):
+    """
+    Counters for an engine's connection pool. Wait times are only measured
+    for a TimedQueuePool.
+    """
+
+    def __init__(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.timeouts = 0
+        self.peak_overflow = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self._lock = threading.Lock()
+
+    def waited(self, seconds, overflow):
+        with self._lock:
+            self.wait_time += seconds
+            self.max_wait = max(self.max_wait, seconds)
+            self.peak_overflow = max(self.peak_overflow, overflow)
+
+    def as_dict(self):
+        return {'connects': self.connects, 'checkouts': self.checkouts,
+                'checkins': self.checkins, 'timeouts': self.timeouts,
+                'peak_overflow': self.peak_overflow, 'wait_time': self.wait_time,
+                'max_wait': self.max_wait,
+                'mean_wait': self.wait_time / self.checkouts if self.checkouts else 0.0}
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that records how long each checkout waited for a connection."""
+
+    stats = None
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        except sa.exc.TimeoutError:
+            self.stats.timeouts += 1
+            raise
+        finally:
+            self.stats.waited(time.time() - start, max(self.overflow(), 0))
+
+    def recreate(self):
+        pool = super(TimedQueuePool, self).recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def pool_options(cfg):
+    """
+    Read the pool settings from the [db] section of a config.
+
+    :param cfg: The configuration object
+    :return: A dict of create_engine keyword arguments
+    """
+    options = {}
+    for key, (name, type_) in POOL_OPTIONS.items():
+        if cfg.has_option('db', key):
+            options[name] = cfg.getboolean('db', key) if type_ is bool else type_(cfg.get('db', key))
+    return options
+
+
+def _listen(eng, stats):
+    def on_connect(dbapi_connection, connection_record):
+        stats.connects += 1
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        stats.checkouts += 1
+
+    def on_checkin(dbapi_connection, connection_record):
+        stats.checkins += 1
+
+    sa.event.listen(eng, 'connect', on_connect)
+    sa.event.listen(eng, 'checkout', on_checkout)
+    sa.event.listen(eng, 'checkin', on_checkin)
+
+
+def _freeze(value):
+    """A hashable copy of an option value, with dicts, lists and sets made into sorted tuples."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(_freeze(v) for v in value))
+    return value
+
+
+def get_engine(uri, **options):
+    """
+    The shared engine for a URI and create_engine options, created on first
+    use. Other databases get a TimedQueuePool by default. Queue pool options
+    are ignored for SQLite, unless a poolclass is given.
+
+    :param str uri: The database URI to connect to
+    :param options: Keyword arguments for create_engine, i.e. pool_size=10
+    :rtype: sqlalchemy.engine.Engine
+    """
+    key = (uri, _freeze(options))
+    with _lock:
+        if key not in _ENGINES:
+            if sa.engine.url.make_url(uri).get_backend_name() != 'sqlite':
+                options.setdefault('poolclass', TimedQueuePool)
+            elif 'poolclass' not in options:
+                options = dict((k, v) for k, v in options.items() if k not in QUEUE_POOL_OPTIONS)
+            eng = sa.create_engine(uri, **options)
+            stats = PoolStats()
+            if isinstance(eng.pool, TimedQueuePool):
+                eng.pool.stats = stats
+            _listen(eng, stats)
+            _STATS[eng] = stats
+            _ENGINES[key] = eng
+        return _ENGINES[key]
+
+
+def get_sessionmaker(eng, scoped=False):
+    """
+    The shared session factory for an engine.
+
+    :param eng: The engine sessions are bound to
+    :param bool scoped: Return a thread-local scoped_session registry instead
+    """
+    key = (eng, scoped)
+    with _lock:
+        if key not in _SESSIONMAKERS:
+            factory = orm.sessionmaker(bind=eng)
+            _SESSIONMAKERS[key] = orm.scoped_session(factory) if scoped else factory
+        return _SESSIONMAKERS[key]
+
+
+def pool_stats(eng):
+    """
+    Checkout, overflow and wait time statistics for an engine's pool.
+
+    :param eng: An engine from get_engine
+    :rtype: dict
+    """
+    stats = _STATS[eng].as_dict()
+    pool = eng.pool
+    if isinstance(pool, QueuePool):
+        stats.update({'size': pool.size(), 'checked_out': pool.checkedout(),
+                      'checked_in': pool.checkedin(), 'overflow': pool.overflow()})
+    return stats
+
+
+def dispose_engines():
+    """
+    Close every pooled connection and empty the registry, i.e. in a child
+    process after a fork.
+    """
+    with _lock:
+        for scoped in [f for (eng, is_scoped), f in _SESSIONMAKERS.items() if is_scoped]:
+            scoped.remove()
+        for eng in _ENGINES.values():
+            eng.dispose()
+        _ENGINES.clear()
+        _SESSIONMAKERS.clear()
+        _STATS.clear()
@@ -8,20 +8,20 @@ import string
 import isodate
 from alchemyjsonschema.dictify import datetime_rfc3339
 
-from __init__ import sa, orm, Base, LedgerAmount
+from __init__ import sa, Base, LedgerAmount, apply_commodities
 from ledger import Amount
 import datetime
 
-__all__ = ['LimitOrder', 'Ticker', 'Trade']
+__all__ = ['LimitOrder', 'Ticker', 'Trade', 'Candle']
 
 
 class LimitOrder(Base):
     id = sa.Column(sa.Integer, sa.Sequence('limit_order_id_seq'), primary_key=True)
     create_time = sa.Column(sa.DateTime(), default=datetime.datetime.utcnow)
     change_time = sa.Column(sa.DateTime(), default=datetime.datetime.utcnow)
-    price = sa.Column(LedgerAmount, nullable=False)
-    amount = sa.Column(LedgerAmount, nullable=False)
-    exec_amount = sa.Column(LedgerAmount, nullable=False)
+    price = sa.Column(LedgerAmount(commodity_column='market', market_side='quote'), nullable=False)
+    amount = sa.Column(LedgerAmount(commodity_column='market', market_side='base'), nullable=False)
+    exec_amount = sa.Column(LedgerAmount(commodity_column='market', market_side='base'), nullable=False)
     market = sa.Column(sa.String(9), nullable=False)
     side = sa.Column(sa.Enum("bid", "ask", name='order_side'), nullable=False)
     exchange = sa.Column(sa.String(12), nullable=False)
@@ -35,18 +35,25 @@ class LimitOrder(Base):
         self.market = market
         self.side = side
         self.exchange = exchange
-        if order_id is None:
-            self.order_id = "tmp|%s" % ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(15))
-        elif "|" not in str(order_id):
-            self.order_id = "%s|%s" % (exchange, order_id)  # to ensure uniqueness
-        else:
-            self.order_id = order_id
+        self.order_id = self.unique_id(exchange, order_id)
         self.create_time = create_time if create_time is not None else datetime.datetime.utcnow()
         self.change_time = change_time if change_time is not None else datetime.datetime.utcnow()
         self.exec_amount = exec_amount
         self.state = state
         self.load_commodities()
 
+    @staticmethod
+    def unique_id(exchange, order_id=None):
+        """
+        The order_id to store for an exchange's order id. Ids are prefixed
+        with the exchange to ensure uniqueness, or generated if not given.
+        """
+        if order_id is None:
+            return "tmp|%s" % ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(15))
+        elif "|" not in str(order_id):
+            return "%s|%s" % (exchange, order_id)  # to ensure uniqueness
+        return order_id
+
     def __repr__(self):
         return "<LimitOrder(price=%s, amount=%s, exec_amount=%s, market='%s', side='%s', exchange='%s', order_id='%s', " \
                "state='%s', create_time=%s)>" % (
@@ -54,35 +61,26 @@ class LimitOrder(Base):
                     self.market, self.side, self.exchange,
                     self.order_id, self.state, datetime_rfc3339(self.create_time))
 
-    @orm.reconstructor
     def load_commodities(self):
         """
         Load the commodities for Amounts in this object.
+
+        LedgerAmount columns are loaded with their commodity, so this is only
+        needed after assigning plain numbers to an instance.
         """
-        base, quote = self.market.split("_")
-        if isinstance(self.price, Amount):
-            self.price = Amount("{0:.8f} {1}".format(self.price.to_double(), quote))
-        else:
-            self.price = Amount("{0:.8f} {1}".format(self.price, quote))
-        if isinstance(self.amount, Amount):
-            self.amount = Amount("{0:.8f} {1}".format(self.amount.to_double(), base))
-        else:
-            self.amount = Amount("{0:.8f} {1}".format(self.amount, base))
-        if isinstance(self.exec_amount, Amount):
-            self.exec_amount = Amount("{0:.8f} {1}".format(self.exec_amount.to_double(), base))
-        else:
-            self.exec_amount = Amount("{0:.8f} {1}".format(self.exec_amount, base))
+        apply_commodities(self)
 
 
 class Ticker(Base):
+    __table_args__ = (sa.Index('ix_ticker_exchange_market_time', 'exchange', 'market', 'time'),)
     id = sa.Column(sa.Integer, sa.Sequence('ticker_id_seq'),  primary_key=True)
     time = sa.Column(sa.DateTime(), default=datetime.datetime.utcnow)
-    bid = sa.Column(LedgerAmount, nullable=False)
-    ask = sa.Column(LedgerAmount, nullable=False)
-    high = sa.Column(LedgerAmount, nullable=False)
-    low = sa.Column(LedgerAmount, nullable=False)
-    volume = sa.Column(LedgerAmount, nullable=False)
-    last = sa.Column(LedgerAmount, nullable=False)
+    bid = sa.Column(LedgerAmount(commodity_column='market', market_side='quote'), nullable=False)
+    ask = sa.Column(LedgerAmount(commodity_column='market', market_side='quote'), nullable=False)
+    high = sa.Column(LedgerAmount(commodity_column='market', market_side='quote'), nullable=False)
+    low = sa.Column(LedgerAmount(commodity_column='market', market_side='quote'), nullable=False)
+    volume = sa.Column(LedgerAmount(commodity_column='market', market_side='base'), nullable=False)
+    last = sa.Column(LedgerAmount(commodity_column='market', market_side='quote'), nullable=False)
     market = sa.Column(sa.String(9), nullable=False)
     exchange = sa.Column(sa.String(12), nullable=False)
 
@@ -104,36 +102,14 @@ class Ticker(Base):
             self.low, self.volume, self.last,
             self.market, self.exchange, datetime_rfc3339(self.time))
 
-    @orm.reconstructor
     def load_commodities(self):
         """
         Load the commodities for Amounts in this object.
+
+        LedgerAmount columns are loaded with their commodity, so this is only
+        needed after assigning plain numbers to an instance.
         """
-        base, quote = self.market.split("_")
-        if isinstance(self.bid, Amount):
-            self.bid = Amount("{0:.8f} {1}".format(self.bid.to_double(), quote))
-        else:
-            self.bid = Amount("{0:.8f} {1}".format(self.bid, quote))
-        if isinstance(self.ask, Amount):
-            self.ask = Amount("{0:.8f} {1}".format(self.ask.to_double(), quote))
-        else:
-            self.ask = Amount("{0:.8f} {1}".format(self.ask, quote))
-        if isinstance(self.high, Amount):
-            self.high = Amount("{0:.8f} {1}".format(self.high.to_double(), quote))
-        else:
-            self.high = Amount("{0:.8f} {1}".format(self.high, quote))
-        if isinstance(self.low, Amount):
-            self.low = Amount("{0:.8f} {1}".format(self.low.to_double(), quote))
-        else:
-            self.low = Amount("{0:.8f} {1}".format(self.low, quote))
-        if isinstance(self.volume, Amount):
-            self.volume = Amount("{0:.8f} {1}".format(self.volume.to_double(), base))
-        else:
-            self.volume = Amount("{0:.8f} {1}".format(self.volume, base))
-        if isinstance(self.last, Amount):
-            self.last = Amount("{0:.8f} {1}".format(self.last.to_double(), quote))
-        else:
-            self.last = Amount("{0:.8f} {1}".format(self.last, quote))
+        apply_commodities(self)
 
     def calculate_index(self):
         """
@@ -157,15 +133,15 @@ class Trade(Base):
     exchange = sa.Column(sa.String(12), nullable=False)
     market = sa.Column(sa.String(9), nullable=False)
     trade_side = sa.Column(sa.Enum('buy', 'sell', name='trade_side'), nullable=False)
-    amount = sa.Column(LedgerAmount, nullable=False)
-    price = sa.Column(LedgerAmount, nullable=False)
-    fee = sa.Column(LedgerAmount, nullable=False)
+    amount = sa.Column(LedgerAmount(commodity_column='market', market_side='base'), nullable=False)
+    price = sa.Column(LedgerAmount(commodity_column='market', market_side='quote'), nullable=False)
+    fee = sa.Column(LedgerAmount(commodity_column='market', market_side='fee_side'), nullable=False)
     fee_side = sa.Column(sa.String(5), nullable=False)
     time = sa.Column(sa.DateTime(), nullable=False)
 
     def __init__(self, trade_id, exchange, market, side, amount, price, fee,
                  fee_side, time=None):
-        self.trade_id = "%s|%s" % (exchange, trade_id)  # to ensure uniqueness
+        self.trade_id = self.unique_id(exchange, trade_id)
         self.exchange = exchange
         self.market = market
         self.trade_side = side
@@ -176,6 +152,13 @@ class Trade(Base):
         self.time = time if time is not None else datetime.datetime.utcnow()
         self.load_commodities()
 
+    @staticmethod
+    def unique_id(exchange, trade_id):
+        """
+        The trade_id to store for an exchange's trade id.
+        """
+        return "%s|%s" % (exchange, trade_id)  # to ensure uniqueness
+
     # noinspection PyPep8
     def __repr__(self):
         return "<Trade(trade_id='%s', side='%s', amount=%s, price=%s, fee=%s, fee_side='%s', market='%s', " \
@@ -184,25 +167,14 @@ class Trade(Base):
                    self.price, self.fee, self.fee_side,
                    self.market, self.exchange, datetime_rfc3339(self.time))
 
-    @orm.reconstructor
     def load_commodities(self):
         """
         Load the commodities for Amounts in this object.
+
+        LedgerAmount columns are loaded with their commodity, so this is only
+        needed after assigning plain numbers to an instance.
         """
-        base, quote = self.market.split("_")
-        if isinstance(self.price, Amount):
-            self.price = Amount("{0:.8f} {1}".format(self.price.to_double(), quote))
-        else:
-            self.price = Amount("{0:.8f} {1}".format(float(self.price), quote))
-        if isinstance(self.amount, Amount):
-            self.amount = Amount("{0:.8f} {1}".format(self.amount.to_double(), base))
-        else:
-            self.amount = Amount("{0:.8f} {1}".format(float(self.amount), base))
-        fee_currency = base if self.fee_side == 'base' else quote
-        if isinstance(self.fee, Amount):
-            self.fee = Amount("{0:.8f} {1}".format(float(self.fee.to_double()), fee_currency))
-        else:
-            self.fee = Amount("{0:.8f} {1}".format(float(self.fee), fee_currency))
+        apply_commodities(self)
 
     def get_ledger_entry(self):
         ledger = ""
@@ -265,3 +237,62 @@ class Trade(Base):
         ledger += "    FX:{0}:{1}   {2} @ {3}\n".format(self.market, self.trade_side, b_vol, self.price)
         ledger += feeline
         return ledger
+
+
+class Candle(Base):
+    """
+    Open, high, low and close of Ticker last prices over a time bucket, with
+    the bid, ask and volume of the bucket's latest Ticker.
+    """
+    __table_args__ = (sa.UniqueConstraint('exchange', 'market', 'interval', 'bucket_start'),
+                      sa.Index('ix_candle_interval_ticker_id', 'interval', 'ticker_id'))
+    id = sa.Column(sa.Integer, sa.Sequence('candle_id_seq'), primary_key=True)
+    exchange = sa.Column(sa.String(12), nullable=False)
+    market = sa.Column(sa.String(9), nullable=False)
+    interval = sa.Column(sa.String(3), nullable=False)  # i.e. 1m, 5m, 1h, 1d
+    bucket_start = sa.Column(sa.DateTime(), nullable=False)
+    open = sa.Column(LedgerAmount(commodity_column='market', market_side='quote'), nullable=False)
+    high = sa.Column(LedgerAmount(commodity_column='market', market_side='quote'), nullable=False)
+    low = sa.Column(LedgerAmount(commodity_column='market', market_side='quote'), nullable=False)
+    close = sa.Column(LedgerAmount(commodity_column='market', market_side='quote'), nullable=False)
+    bid = sa.Column(LedgerAmount(commodity_column='market', market_side='quote'), nullable=False)
+    ask = sa.Column(LedgerAmount(commodity_column='market', market_side='quote'), nullable=False)
+    volume = sa.Column(LedgerAmount(commodity_column='market', market_side='base'), nullable=False)
+    ticker_count = sa.Column(sa.Integer, nullable=False)
+    open_time = sa.Column(sa.DateTime(), nullable=False)
+    close_time = sa.Column(sa.DateTime(), nullable=False)
+    ticker_id = sa.Column(sa.Integer, nullable=False)  # the highest Ticker id included
+
+    def __init__(self, exchange, market, interval, bucket_start, open, high, low, close, bid, ask,
+                 volume, ticker_count, open_time, close_time, ticker_id):
+        self.exchange = exchange
+        self.market = market
+        self.interval = interval
+        self.bucket_start = bucket_start
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.bid = bid
+        self.ask = ask
+        self.volume = volume
+        self.ticker_count = ticker_count
+        self.open_time = open_time
+        self.close_time = close_time
+        self.ticker_id = ticker_id
+        self.load_commodities()
+
+    def __repr__(self):
+        return "<Candle(open=%s, high=%s, low=%s, close=%s, bid=%s, ask=%s, volume=%s, market='%s', " \
+               "exchange='%s', interval='%s', bucket_start=%s)>" % (
+                   self.open, self.high, self.low, self.close, self.bid, self.ask, self.volume,
+                   self.market, self.exchange, self.interval, datetime_rfc3339(self.bucket_start))
+
+    def load_commodities(self):
+        """
+        Load the commodities for Amounts in this object.
+
+        LedgerAmount columns are loaded with their commodity, so this is only
+        needed after assigning plain numbers to an instance.
+        """
+        apply_commodities(self)
@@ -0,0 +1,98 @@
+"""
+Streaming exports of query results.
+"""
+import json
+
+from __init__ import sa, orm, LedgerAmount
+from serialize import SERIALIZERS
+
+__all__ = ['export_ndjson']
+
+
+def _amount_converter(amount_type, convert):
+    def to_json(value):
+        if value is None:
+            return None
+        return convert(amount_type.from_db(value))
+    return to_json
+
+
+def _columns(model, schema, attr_of, dialect):
+    """
+    The scalar schema properties of a model that map to columns, as a list of
+    (name, SQL expression, converter) in schema order. LedgerAmounts are read
+    as their stored type on the dialect, i.e. base units for 'bigint' storage.
+    """
+    columns = []
+    for name, prop in schema['properties'].items():
+        if prop.get('type') in (None, 'object', 'array'):
+            continue  # relationships can't be served from column tuples
+        attr = getattr(model, name, None)
+        if attr is None or not hasattr(attr.property, 'columns'):
+            continue
+        convert = SERIALIZERS.converter(name, prop)
+        column_type = attr.property.columns[0].type
+        expr = attr_of(name)
+        if isinstance(column_type, LedgerAmount):
+            # skip building Amounts; read the stored number directly
+            expr = sa.type_coerce(expr, column_type.load_dialect_impl(dialect))
+            convert = _amount_converter(column_type, convert)
+        columns.append((name, expr.label(name), convert))
+    return columns
+
+
+def export_ndjson(source, fileobj, model=None, bind=None, chunk_size=1000, json_array=False):
+    """
+    Stream the rows of a query to a file as newline delimited json, using the
+    model's schema. Rows are read as column tuples through a server-side
+    cursor, chunk_size at a time, so memory use doesn't grow with the export.
+
+    Relationship properties are not included.
+
+    :param source: An orm Query for a model, or a select() from its table
+    :param fileobj: A file-like object to write to
+    :param model: The model class, required for a select()
+    :param bind: The session, engine or connection for a select()
+    :param int chunk_size: The number of rows to fetch and write at a time
+    :param bool json_array: Write a single json array instead of lines
+    :return: The number of rows written
+    """
+    is_query = isinstance(source, orm.Query)
+    if is_query:
+        model = model or source.column_descriptions[0]['type']
+        bind = bind or source.session
+    elif model is None or bind is None:
+        raise ValueError("a model and bind are required to export a select()")
+    dialect = bind.dialect if hasattr(bind, 'dialect') else bind.get_bind(mapper=orm.class_mapper(model)).dialect
+    columns = _columns(model, SERIALIZERS.spec(model.__name__),
+                       (lambda name: getattr(model, name)) if is_query
+                       else (lambda name: model.__table__.c[name]), dialect)
+    exprs = [expr for name, expr, convert in columns]
+    if is_query:
+        stmt = source.with_entities(*exprs).statement
+    else:
+        stmt = source.with_only_columns(exprs)
+    result = bind.execute(stmt.execution_options(stream_results=True))
+
+    count = 0
+    fileobj.write("[" if json_array else "")
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        lines = []
+        for row in rows:
+            d = {}
+            for (name, expr, convert), value in zip(columns, row):
+                value = convert(value)
+                if value is not None:
+                    d[name] = value
+            lines.append(json.dumps(d))
+        if json_array:
+            fileobj.write(("\n" if count == 0 else ",\n") + ",\n".join(lines))
+        else:
+            fileobj.write("\n".join(lines) + "\n")
+        count += len(rows)
+    result.close()
+    fileobj.write("\n]\n" if json_array else "")
+    return count
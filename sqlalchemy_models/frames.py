@@ -0,0 +1,183 @@
+"""
+Columnar Ticker history for vectorized analytics.
+
+Requires numpy, i.e. pip install sqlalchemy-models[numpy]
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from __init__ import sa, orm
+import exchange as em
+
+__all__ = ['TickerFrame']
+
+AMOUNTS = ['bid', 'ask', 'high', 'low', 'volume', 'last']
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is required for TickerFrame, install sqlalchemy-models[numpy]")
+
+
+def _categories(values):
+    """Integer codes for values, and the list of distinct values they index."""
+    categories, codes = np.unique(np.asarray(values, dtype=object).astype(str), return_inverse=True)
+    return codes.astype(np.int32), [str(c) for c in categories]
+
+
+class TickerFrame(object):
+    """
+    Ticker rows as numpy arrays: float64 amounts, datetime64 times and
+    integer codes for exchange and market.
+
+    Usage::
+        frame = TickerFrame.from_query(session.query(Ticker).filter(Ticker.market == 'BTC_USD'))
+        frame.calculate_index()
+        frame.aggregate(frame.spread(), by='exchange')
+    """
+
+    def __init__(self, columns, exchanges, markets):
+        _require_numpy()
+        self.columns = columns
+        self.exchanges = exchanges
+        self.markets = markets
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build a frame from (id, time, exchange, market, bid, ask, high, low,
+        volume, last) tuples, with amounts as numbers.
+        """
+        _require_numpy()
+        rows = list(rows)
+        fields = zip(*rows) if rows else [()] * 10
+        columns = {'id': np.asarray(fields[0], dtype=np.int64),
+                   'time': np.asarray(fields[1], dtype='datetime64[us]')}
+        columns['exchange'], exchanges = _categories(fields[2])
+        columns['market'], markets = _categories(fields[3])
+        for name, values in zip(AMOUNTS, fields[4:]):
+            columns[name] = np.asarray(values, dtype=np.float64)
+        return cls(columns, exchanges, markets)
+
+    @classmethod
+    def from_query(cls, query):
+        """
+        Load a frame from a Ticker query, reading amounts as stored numbers
+        without building Ticker or Amount objects.
+
+        :param query: An orm Query for Tickers
+        :rtype: TickerFrame
+        """
+        dialect = query.session.get_bind(mapper=orm.class_mapper(em.Ticker)).dialect
+        columns = [em.Ticker.id, em.Ticker.time, em.Ticker.exchange, em.Ticker.market]
+        amount_type = em.Ticker.bid.property.columns[0].type
+        for name in AMOUNTS:
+            columns.append(sa.type_coerce(getattr(em.Ticker, name),
+                                          amount_type.load_dialect_impl(dialect)).label(name))
+        rows = query.with_entities(*columns)
+        if amount_type.storage != 'float':
+            rows = (row[:4] + tuple(amount_type.from_db(v) for v in row[4:]) for row in rows)
+        return cls.from_rows(rows)
+
+    @classmethod
+    def from_tickers(cls, tickers):
+        """
+        Build a frame from Ticker objects. Unsaved Tickers get id -1.
+
+        :param tickers: An iterable of Tickers
+        :rtype: TickerFrame
+        """
+        return cls.from_rows((t.id if t.id is not None else -1, t.time, t.exchange, t.market) +
+                             tuple(float(getattr(t, name).to_double()) for name in AMOUNTS)
+                             for t in tickers)
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def __getitem__(self, index):
+        """A frame of the rows selected by a boolean mask, index array or slice."""
+        return TickerFrame(dict((name, values[index]) for name, values in self.columns.items()),
+                           self.exchanges, self.markets)
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get('columns', {})
+        if name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    def calculate_index(self):
+        """(bid + ask + last) / 3 for every row, like Ticker.calculate_index."""
+        return (self.columns['bid'] + self.columns['ask'] + self.columns['last']) / 3
+
+    def spread(self):
+        """ask - bid for every row."""
+        return self.columns['ask'] - self.columns['bid']
+
+    def mid(self):
+        """(bid + ask) / 2 for every row."""
+        return (self.columns['bid'] + self.columns['ask']) / 2
+
+    def returns(self, field='last'):
+        """
+        The simple return of a field from the previous row, in time order,
+        of the same exchange and market. NaN for each series' first row.
+
+        :param str field: An amount column, i.e. 'last'
+        :return: An array in the frame's row order
+        """
+        values = self.columns[field]
+        order = np.lexsort((self.columns['id'], self.columns['time'],
+                           self.columns['market'], self.columns['exchange']))
+        ordered = values[order]
+        result = np.full(len(values), np.nan)
+        if len(values) > 1:
+            same = ((self.columns['exchange'][order][1:] == self.columns['exchange'][order][:-1]) &
+                    (self.columns['market'][order][1:] == self.columns['market'][order][:-1]))
+            changes = np.where(same, ordered[1:] / ordered[:-1] - 1, np.nan)
+            result[order[1:]] = changes
+        return result
+
+    def groups(self, by='market'):
+        """
+        The row indexes for each exchange or market.
+
+        :param str by: 'market' or 'exchange'
+        :return: A dict of index arrays by name
+        """
+        codes = self.columns[by]
+        names = self.markets if by == 'market' else self.exchanges
+        return dict((names[code], np.flatnonzero(codes == code)) for code in np.unique(codes))
+
+    def aggregate(self, values, by='market', how=None):
+        """
+        Reduce an array over the rows of each exchange or market.
+
+        :param values: An array in the frame's row order, i.e. frame.spread()
+        :param str by: 'market' or 'exchange'
+        :param how: The reduction, defaults to numpy.mean
+        :return: A dict of results by name
+        """
+        how = how or np.mean
+        return dict((name, how(values[index])) for name, index in self.groups(by).items())
+
+    def to_tickers(self, index=None):
+        """
+        Build Ticker objects for the frame's rows, not attached to a session.
+
+        :param index: A mask, index array or slice of the rows to convert
+        :rtype: list
+        """
+        frame = self if index is None else self[index]
+        columns = frame.columns
+        times = columns['time'].astype(object)
+        tickers = []
+        for i in range(len(frame)):
+            ticker = em.Ticker(columns['bid'][i], columns['ask'][i], columns['high'][i],
+                               columns['low'][i], columns['volume'][i], columns['last'][i],
+                               self.markets[columns['market'][i]], self.exchanges[columns['exchange'][i]],
+                               time=times[i])
+            ticker.id = int(columns['id'][i])
+            tickers.append(ticker)
+        return tickers
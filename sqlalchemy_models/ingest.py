@@ -0,0 +1,331 @@
+"""
+Bulk ingestion of exchange data, bypassing the ORM unit of work.
+"""
+import csv
+import datetime
+import itertools
+import StringIO
+import time
+from collections import OrderedDict, namedtuple
+
+from __init__ import sa
+import exchange as em
+import wallet as wm
+from statements import connection_for, insert_on_conflict, on_conflict_statement
+
+__all__ = ['IngestResult', 'IgnoreResult', 'CreditChange', 'CreditIngestResult', 'normalize', 'bulk_insert',
+           'bulk_insert_tickers', 'bulk_insert_trades', 'bulk_insert_limit_orders', 'bulk_insert_ignore',
+           'bulk_insert_ignore_trades', 'bulk_insert_ignore_limit_orders', 'ingest_credits']
+
+
+class IngestResult(namedtuple('IngestResult', ['rows', 'seconds'])):
+    """The number of rows written by a bulk ingest, and how long it took."""
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else float(self.rows)
+
+
+class IgnoreResult(namedtuple('IgnoreResult', ['inserted', 'skipped', 'seconds'])):
+    """The rows inserted and skipped as duplicates by an insert-ignore, and how long it took."""
+
+
+class CreditChange(namedtuple('CreditChange', ['id', 'ref_id', 'user_id', 'currency', 'amount',
+                                               'transaction_state'])):
+    """A Credit written by ingest_credits, with its amount as a number."""
+
+
+class CreditIngestResult(namedtuple('CreditIngestResult', ['inserted', 'confirmed', 'seconds'])):
+    """
+    The new Credits and the unconfirmed ones upgraded to complete by
+    ingest_credits, and how long it took.
+    """
+
+
+def _utc(dt):
+    """A naive UTC datetime, converting from tz aware datetimes."""
+    if dt is not None and dt.tzinfo is not None:
+        dt = (dt - dt.utcoffset()).replace(tzinfo=None)
+    return dt
+
+
+def _ticker_row(bid, ask, high, low, volume, last, market, exchange, time=None):
+    return {'bid': bid, 'ask': ask, 'high': high, 'low': low, 'volume': volume,
+            'last': last, 'market': market, 'exchange': exchange,
+            'time': _utc(time) if time is not None else datetime.datetime.utcnow()}
+
+
+def _trade_row(trade_id, exchange, market, side, amount, price, fee, fee_side, time=None):
+    return {'trade_id': em.Trade.unique_id(exchange, trade_id), 'exchange': exchange,
+            'market': market, 'trade_side': side, 'amount': amount, 'price': price,
+            'fee': fee, 'fee_side': fee_side,
+            'time': _utc(time) if time is not None else datetime.datetime.utcnow()}
+
+
+def _limit_order_row(price, amount, market, side, exchange, order_id=None, create_time=None,
+                     change_time=None, exec_amount=0, state='pending'):
+    now = datetime.datetime.utcnow()
+    return {'price': price, 'amount': amount, 'market': market, 'side': side,
+            'exchange': exchange, 'order_id': em.LimitOrder.unique_id(exchange, order_id),
+            'create_time': _utc(create_time) if create_time is not None else now,
+            'change_time': _utc(change_time) if change_time is not None else now,
+            'exec_amount': exec_amount, 'state': state}
+
+
+def _credit_row(amount, address, currency, network, transaction_state, reference, ref_id, user_id, time):
+    return {'amount': amount, 'address': address, 'currency': currency, 'network': network,
+            'transaction_state': transaction_state, 'reference': reference, 'ref_id': ref_id,
+            'user_id': user_id, 'time': time.replace(tzinfo=None)}
+
+
+# Row builders take the same arguments as the model constructors.
+NORMALIZERS = {em.Ticker: _ticker_row,
+               em.Trade: _trade_row,
+               em.LimitOrder: _limit_order_row,
+               wm.Credit: _credit_row}
+
+# The unique column duplicates are detected on.
+CONFLICT_KEYS = {em.Trade: 'trade_id',
+                 em.LimitOrder: 'order_id',
+                 wm.Credit: 'ref_id'}
+
+
+def normalize(model, row):
+    """
+    Build the column values for a model from a row, the way its constructor
+    would: ids prefixed with the exchange, defaults filled in and datetimes
+    converted to naive UTC. Amounts are converted by their column on insert.
+
+    :param model: The model class, i.e. Trade
+    :param row: A dict of constructor keyword arguments, or a tuple of positional ones
+    :rtype: dict
+    """
+    if isinstance(row, dict):
+        return NORMALIZERS[model](**row)
+    return NORMALIZERS[model](*row)
+
+
+def _csv_value(value):
+    if value is None:
+        return '\\N'
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, float):
+        return repr(value)
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    return value
+
+
+def _copy(conn, table, rows):
+    """Write rows with Postgres COPY, prefetching ids from the table's sequence."""
+    dialect = conn.dialect
+    keys = sorted(rows[0])
+    processors = [table.c[k].type.dialect_impl(dialect).bind_processor(dialect) for k in keys]
+    ids = [r[0] for r in conn.execute(sa.text("SELECT nextval(:seq) FROM generate_series(1, :n)"),
+                                      seq=table.c.id.default.name, n=len(rows))]
+    buf = StringIO.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    for pk, row in itertools.izip(ids, rows):
+        values = [pk]
+        for k, process in zip(keys, processors):
+            value = row[k]
+            values.append(_csv_value(process(value) if process is not None else value))
+        writer.writerow(values)
+    buf.seek(0)
+    preparer = dialect.identifier_preparer
+    sql = "COPY %s (%s) FROM STDIN WITH CSV NULL '\\N'" % (
+        preparer.format_table(table), ", ".join(preparer.quote(k) for k in ['id'] + keys))
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(sql, buf)
+    finally:
+        cursor.close()
+
+
+def bulk_insert(bind, model, rows, batch_size=10000, method=None):
+    """
+    Insert many rows for a model without building ORM objects.
+
+    The method defaults to 'copy' on Postgres, 'executemany' on SQLite and
+    multi-row INSERT ... VALUES ('values') elsewhere.
+
+    :param bind: The session, engine or connection to write with
+    :param model: The model class, one of Ticker, Trade or LimitOrder
+    :param rows: An iterable of dicts or tuples, as accepted by the constructor
+    :param int batch_size: The number of rows to write per statement
+    :param str method: 'copy', 'executemany' or 'values'
+    :rtype: IngestResult
+    """
+    table = model.__table__
+    start = time.time()
+    count = 0
+    rows = iter(rows)
+    with connection_for(bind) as conn:
+        if method is None:
+            method = {'postgresql': 'copy', 'sqlite': 'executemany'}.get(conn.dialect.name, 'values')
+        while True:
+            batch = [normalize(model, row) for row in itertools.islice(rows, batch_size)]
+            if not batch:
+                break
+            if method == 'copy':
+                _copy(conn, table, batch)
+            elif method == 'executemany':
+                conn.execute(table.insert(), batch)
+            else:
+                conn.execute(table.insert().values(batch))
+            count += len(batch)
+    return IngestResult(count, time.time() - start)
+
+
+def bulk_insert_ignore(bind, model, rows, batch_size=1000):
+    """
+    Insert many rows for a model, skipping those whose unique id is already
+    stored, with INSERT ... ON CONFLICT DO NOTHING. Duplicates don't abort
+    the batch, so overlapping fetches can be written as they are.
+
+    Needs Postgres 9.5 or SQLite 3.24 or later.
+
+    :param bind: The session, engine or connection to write with
+    :param model: The model class, Trade or LimitOrder
+    :param rows: An iterable of dicts or tuples, as accepted by the constructor
+    :param int batch_size: The number of rows to write per statement
+    :rtype: IgnoreResult
+    """
+    table = model.__table__
+    key = CONFLICT_KEYS[model]
+    start = time.time()
+    inserted = skipped = 0
+    rows = iter(rows)
+    with connection_for(bind) as conn:
+        while True:
+            batch = [normalize(model, row) for row in itertools.islice(rows, batch_size)]
+            if not batch:
+                break
+            result = insert_on_conflict(conn, table, batch, key)
+            written = len(result.fetchall()) if result.returns_rows else result.rowcount
+            inserted += written
+            skipped += len(batch) - written
+    return IgnoreResult(inserted, skipped, time.time() - start)
+
+
+def bulk_insert_ignore_trades(bind, rows, **kwargs):
+    """
+    Insert many Trades, skipping trade_ids already stored. See bulk_insert_ignore.
+
+    :param rows: dicts or tuples of Trade constructor arguments
+    :rtype: IgnoreResult
+    """
+    return bulk_insert_ignore(bind, em.Trade, rows, **kwargs)
+
+
+def bulk_insert_ignore_limit_orders(bind, rows, **kwargs):
+    """
+    Insert many LimitOrders, skipping order_ids already stored. See bulk_insert_ignore.
+
+    :param rows: dicts or tuples of LimitOrder constructor arguments
+    :rtype: IgnoreResult
+    """
+    return bulk_insert_ignore(bind, em.LimitOrder, rows, **kwargs)
+
+
+def bulk_insert_tickers(bind, rows, **kwargs):
+    """
+    Insert many Tickers. See bulk_insert.
+
+    :param rows: dicts or tuples of Ticker constructor arguments
+    :rtype: IngestResult
+    """
+    return bulk_insert(bind, em.Ticker, rows, **kwargs)
+
+
+def bulk_insert_trades(bind, rows, **kwargs):
+    """
+    Insert many Trades. See bulk_insert.
+
+    :param rows: dicts or tuples of Trade constructor arguments
+    :rtype: IngestResult
+    """
+    return bulk_insert(bind, em.Trade, rows, **kwargs)
+
+
+def bulk_insert_limit_orders(bind, rows, **kwargs):
+    """
+    Insert many LimitOrders. See bulk_insert.
+
+    :param rows: dicts or tuples of LimitOrder constructor arguments
+    :rtype: IngestResult
+    """
+    return bulk_insert(bind, em.LimitOrder, rows, **kwargs)
+
+
+CREDIT_FIELDS = ['id', 'ref_id', 'user_id', 'currency', 'amount', 'transaction_state']
+
+
+def _credit_statement(dialect, batch):
+    """
+    The INSERT ... ON CONFLICT (ref_id) DO UPDATE for a batch of Credits, and
+    its params. On Postgres it returns CREDIT_FIELDS and whether each row
+    was inserted.
+    """
+    table = wm.Credit.__table__
+    preparer = dialect.identifier_preparer
+    confirm = ("DO UPDATE SET transaction_state = excluded.transaction_state "
+               "WHERE {t}.transaction_state = 'unconfirmed' AND excluded.transaction_state = 'complete'").format(
+        t=preparer.format_table(table))
+    # xmax is 0 for rows inserted by this statement
+    returning = ", ".join([preparer.quote(f) for f in CREDIT_FIELDS] + ["xmax = 0"])
+    return on_conflict_statement(dialect, table, batch, 'ref_id', confirm, returning)
+
+
+def _credit_changes(conn, batch):
+    """Write a batch of Credits, returning (inserted, confirmed) CreditChanges."""
+    table = wm.Credit.__table__
+    amount_type = table.c.amount.type
+    change = lambda row: CreditChange(*(list(row[:4]) + [amount_type.from_db(row[4]), row[5]]))
+    stmt, params = _credit_statement(conn.dialect, batch)
+    if conn.dialect.name == 'postgresql':
+        rows = conn.execute(stmt, **params).fetchall()
+        return [change(r) for r in rows if r[-1]], [change(r) for r in rows if not r[-1]]
+    ref_ids = [row['ref_id'] for row in batch]
+    before = dict(conn.execute(sa.select([table.c.ref_id, table.c.transaction_state])
+                               .where(table.c.ref_id.in_(ref_ids))).fetchall())
+    conn.execute(stmt, params)
+    raw = amount_type.load_dialect_impl(conn.dialect)
+    columns = [table.c[f] if f != 'amount' else sa.type_coerce(table.c.amount, raw) for f in CREDIT_FIELDS]
+    after = [change(r) for r in conn.execute(sa.select(columns).where(table.c.ref_id.in_(ref_ids)))]
+    return ([c for c in after if c.ref_id not in before],
+            [c for c in after if before.get(c.ref_id) == 'unconfirmed' and c.transaction_state == 'complete'])
+
+
+def ingest_credits(bind, rows, batch_size=500):
+    """
+    Insert many Credits, i.e. a block's outputs, keyed on ref_id. Credits
+    already stored are skipped, except that unconfirmed ones are upgraded to
+    complete when a row for them is complete. Rescanning blocks after a reorg
+    or restart is safe.
+
+    Each batch is one INSERT ... ON CONFLICT (ref_id) DO UPDATE statement.
+    Postgres returns the changed rows from it; other databases read them back
+    in the same transaction. Needs Postgres 9.5 or SQLite 3.24 or later.
+
+    :param bind: The session, engine or connection to write with
+    :param rows: An iterable of dicts or tuples, as accepted by the Credit constructor
+    :param int batch_size: The number of rows to write per statement
+    :rtype: CreditIngestResult
+    """
+    start = time.time()
+    inserted, confirmed = [], []
+    rows = iter(rows)
+    with connection_for(bind) as conn:
+        while True:
+            batch = OrderedDict()
+            for row in itertools.islice(rows, batch_size):
+                row = normalize(wm.Credit, row)
+                batch[row['ref_id']] = row  # one statement can't change a row twice
+            if not batch:
+                break
+            new, upgraded = _credit_changes(conn, batch.values())
+            inserted.extend(new)
+            confirmed.extend(upgraded)
+    return CreditIngestResult(inserted, confirmed, time.time() - start)
@@ -0,0 +1,342 @@
+"""
+Ledger-cli journal export of Trade, Credit and Debit history.
+"""
+import fcntl
+import heapq
+import json
+import multiprocessing
+import os
+from collections import deque, namedtuple
+
+from alchemyjsonschema.dictify import datetime_rfc3339
+
+from __init__ import sa, orm, LedgerAmount, apply_commodities
+from statements import committed_horizon
+import exchange as em
+import wallet as wm
+
+__all__ = ['JournalResult', 'export_journal', 'append_journal', 'read_checkpoint',
+           'write_checkpoint', 'TRADE_FIELDS', 'trade_rows', 'render_trades']
+
+# The models with a get_ledger_entry, in the order they're written when times tie.
+JOURNAL_MODELS = [em.Trade, wm.Credit, wm.Debit]
+
+
+class JournalResult(namedtuple('JournalResult', ['entries', 'checkpoint'])):
+    """The number of journal entries written, and the checkpoint to resume from."""
+
+
+def _columns(model, dialect):
+    """The model's column attributes, with amounts selected as stored numbers."""
+    columns = []
+    for prop in orm.class_mapper(model).column_attrs:
+        expr = getattr(model, prop.key)
+        column_type = prop.columns[0].type
+        if isinstance(column_type, LedgerAmount):
+            expr = sa.type_coerce(expr, column_type.load_dialect_impl(dialect))
+        columns.append((prop.key, expr.label(prop.key)))
+    return columns
+
+
+def _stream(session, index, model, after, upto, chunk_size):
+    """Yield (time, index, id, values) for a model's rows in time order, from a server-side cursor."""
+    columns = _columns(model, session.get_bind(mapper=orm.class_mapper(model)).dialect)
+    query = session.query(*[expr for key, expr in columns]).order_by(model.time, model.id)
+    if after is not None:
+        query = query.filter(model.id > after)
+    if upto is not None:
+        query = query.filter(model.id <= upto)
+    keys = [key for key, expr in columns]
+    for row in query.yield_per(chunk_size):
+        values = dict(zip(keys, row))
+        yield values['time'], index, values['id'], values
+
+
+def _render(index, values):
+    model = JOURNAL_MODELS[index]
+    obj = orm.class_mapper(model).class_manager.new_instance()
+    for key, value in values.items():
+        column_type = getattr(model, key).property.columns[0].type
+        if isinstance(column_type, LedgerAmount) and value is not None:
+            value = column_type.from_db(value)
+        setattr(obj, key, value)
+    apply_commodities(obj)
+    return obj.get_ledger_entry()
+
+
+def _render_chunk(chunk):
+    """Render a chunk of (index, values) rows to a single string. Runs in the pool."""
+    return "".join([_render(index, values) for index, values in chunk])
+
+
+def _chunks(rows, chunk_size):
+    """Group merged rows into chunks, with the highest id per model in each."""
+    chunk, last = [], {}
+    for time, index, pk, values in rows:
+        chunk.append((index, values))
+        name = JOURNAL_MODELS[index].__name__
+        last[name] = max(pk, last.get(name))
+        if len(chunk) >= chunk_size:
+            yield chunk, last
+            chunk, last = [], {}
+    if chunk:
+        yield chunk, last
+
+
+def export_journal(session, fileobj, checkpoint=None, chunk_size=1000, processes=None):
+    """
+    Write the ledger-cli journal of every Trade, Credit and Debit to a file,
+    in time order, using each model's get_ledger_entry.
+
+    Rows are read through one server-side cursor per table and merged by
+    time. Entries are rendered in a process pool, chunk_size rows at a time,
+    and written in order as each chunk is done, so memory use doesn't grow
+    with the journal.
+
+    Only rows with an id after the checkpoint are exported. Rows inserted
+    later with an earlier time are appended after the ones already written.
+    On Postgres, ids are drawn before commit, so only rows up to each
+    table's committed horizon are exported and the checkpoint moves to it;
+    a row committed late with a lower id is then still exported next time.
+    Other databases must commit rows in id order, as SQLite does.
+
+    :param session: The sqlalchemy session to use. It must not hold
+                    uncommitted writes to the exported tables.
+    :param fileobj: A file-like object to write to
+    :param dict checkpoint: The highest exported id per model name, i.e. {'Trade': 42}
+    :param int chunk_size: The number of rows per rendered chunk
+    :param int processes: The pool size, defaults to the cpu count. 0 renders in this process.
+    :rtype: JournalResult
+    """
+    checkpoint = dict(checkpoint or {})
+    # fork the pool before any cursors are open
+    pool = multiprocessing.Pool(processes) if processes != 0 else None
+    try:
+        horizon = {}
+        conn = session.connection(mapper=orm.class_mapper(JOURNAL_MODELS[0]))
+        if conn.dialect.name == 'postgresql':
+            upto = committed_horizon(conn, [model.__table__ for model in JOURNAL_MODELS])
+            horizon = dict((model.__name__, upto[model.__table__]) for model in JOURNAL_MODELS)
+        rows = heapq.merge(*[_stream(session, index, model, checkpoint.get(model.__name__),
+                                     horizon.get(model.__name__), chunk_size)
+                             for index, model in enumerate(JOURNAL_MODELS)])
+        pending = deque()
+        max_pending = 2 * (processes or multiprocessing.cpu_count())
+        count = 0
+        for chunk, last in _chunks(rows, chunk_size):
+            if pool is None:
+                count += _write(fileobj, checkpoint, _render_chunk(chunk), len(chunk), last)
+                continue
+            pending.append((pool.apply_async(_render_chunk, (chunk,)), len(chunk), last))
+            while len(pending) >= max_pending:
+                count += _write(fileobj, checkpoint, *pending.popleft())
+        while pending:
+            count += _write(fileobj, checkpoint, *pending.popleft())
+        for name, pk in horizon.items():  # every row up to the horizon was read
+            checkpoint[name] = max(pk, checkpoint.get(name))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return JournalResult(count, checkpoint)
+
+
+def _write(fileobj, checkpoint, entries, count, last):
+    """Write a rendered chunk, then advance the checkpoint past it."""
+    fileobj.write(entries if isinstance(entries, basestring) else entries.get())
+    for name, pk in last.items():
+        checkpoint[name] = max(pk, checkpoint.get(name))
+    return count
+
+
+def _read_checkpoint_file(path):
+    """The checkpoint ids and the journal size they were written with, or None for older files."""
+    if not os.path.exists(path):
+        return {}, None
+    with open(path, 'r') as f:
+        data = json.loads(f.read())
+    if 'ids' in data and 'journal_size' in data:
+        return data['ids'], data['journal_size']
+    return data, None
+
+
+def read_checkpoint(path):
+    """
+    Read a journal checkpoint written by write_checkpoint.
+
+    :param str path: The checkpoint file, which may not exist yet
+    :rtype: dict
+    """
+    return _read_checkpoint_file(path)[0]
+
+
+def write_checkpoint(path, checkpoint, journal_size=None):
+    """
+    Atomically replace a journal checkpoint file.
+
+    :param str path: The checkpoint file
+    :param dict checkpoint: The highest exported id per model name
+    :param int journal_size: The journal's size in bytes when it held
+                             exactly the entries up to the checkpoint
+    """
+    data = checkpoint if journal_size is None else {'ids': checkpoint, 'journal_size': journal_size}
+    tmp = "%s.tmp" % path
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(data))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+def append_journal(session, path, checkpoint_path, **kwargs):
+    """
+    Append the entries added since the last run to a journal file, then
+    save the new checkpoint. Meant for nightly exports.
+
+    The checkpoint records the journal's size, and the journal is cut back
+    to it before appending, so entries appended by a run that died before
+    saving its checkpoint are not written twice. Without a checkpoint file
+    the journal is started over. Runs on the same journal take an exclusive
+    lock on it, so they append one after another.
+
+    :param session: The sqlalchemy session to use
+    :param str path: The journal file
+    :param str checkpoint_path: The checkpoint file
+    :param kwargs: Passed on to export_journal
+    :rtype: JournalResult
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)  # released when the file is closed
+        checkpoint, size = _read_checkpoint_file(checkpoint_path)
+        if size is None and not checkpoint:
+            size = 0
+        if size is not None:
+            f.truncate(size)
+        result = export_journal(session, f, checkpoint=checkpoint, **kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+        write_checkpoint(checkpoint_path, result.checkpoint, os.fstat(f.fileno()).st_size)
+    return result
+
+
+# The columns render_trades reads, in order.
+TRADE_FIELDS = ['trade_id', 'exchange', 'market', 'trade_side', 'amount', 'price', 'fee',
+                'fee_side', 'time']
+
+COIN = 10 ** 8  # Amounts are displayed with 8 decimal places
+
+
+def _units(amount_type, values):
+    """Stored amounts as integer counts of 1e-8, the way to_amount rounds them."""
+    return [int("{0:.8f}".format(amount_type.from_db(value)).replace('.', '')) for value in values]
+
+
+def _div(n, d):
+    """n / d rounded half-even, as ledger displays amounts."""
+    q, r = divmod(n, d)
+    if 2 * r > d or (2 * r == d and q % 2):
+        q += 1
+    return q
+
+
+def _show(units, commodity):
+    """Format like str() of an 8 decimal Amount."""
+    whole, frac = divmod(abs(units), COIN)
+    return "%s%d.%08d %s" % ('-' if units < 0 else '', whole, frac, commodity)
+
+
+def _truncated(units, commodity):
+    """
+    Amount("{0:.8} {1}".format(x, commodity)), which keeps only the first
+    8 characters of str(x).
+    """
+    number = _show(units, commodity)[:8]
+    negative = number.startswith('-')
+    whole, _, frac = number.lstrip('-').partition('.')
+    units = int(whole or 0) * COIN + int((frac + '00000000')[:8])
+    return -units if negative else units
+
+
+def trade_rows(query):
+    """
+    The TRADE_FIELDS columns of a Trade query as tuples, with amounts as
+    stored, for render_trades.
+
+    :param query: An orm Query for Trades
+    :rtype: list
+    """
+    dialect = query.session.get_bind(mapper=orm.class_mapper(em.Trade)).dialect
+    columns = []
+    for name in TRADE_FIELDS:
+        column = getattr(em.Trade, name)
+        column_type = column.property.columns[0].type
+        if isinstance(column_type, LedgerAmount):
+            column = sa.type_coerce(column, column_type.load_dialect_impl(dialect))
+        columns.append(column.label(name))
+    return query.with_entities(*columns).all()
+
+
+def render_trades(rows):
+    """
+    Render the ledger entries of many Trades from their columns, without
+    building Trade or Amount objects. Each entry is identical to
+    Trade.get_ledger_entry, with the postings computed in integer units.
+
+    :param rows: Tuples of TRADE_FIELDS, with amounts as stored, i.e. from trade_rows
+    :return: A list of ledger entry strings
+    """
+    if not rows:
+        return []
+    columns = zip(*rows)
+    trade_ids, exchanges, markets, sides, _, _, _, fee_sides, times = columns
+    amounts, prices, fees = [_units(getattr(em.Trade, name).property.columns[0].type, columns[TRADE_FIELDS.index(name)])
+                             for name in ('amount', 'price', 'fee')]
+    entries = []
+    for trade_id, exchange, market, side, amount, price, fee, fee_side, time in zip(
+            trade_ids, exchanges, markets, sides, amounts, prices, fees, fee_sides, times):
+        base, quote = market.split("_")
+        date = time.strftime('%Y/%m/%d %H:%M:%S')
+        s_price = _show(price, quote)
+        s_q_price = _show(_div(COIN * COIN, price), base)
+        s_amount = _show(amount, base)
+        s_fee = _show(fee, base if fee_side == 'base' else quote)
+        if fee > 0:
+            if fee_side == 'base':
+                feeline = "    Expenses:TradeFee    %s @ %s\n" % (s_fee, s_price)
+                if side == 'sell':
+                    b_vol, b_mine = amount - fee, -amount
+                    q_vol = -_truncated(_div(price * b_vol, COIN), quote)
+                else:
+                    b_vol, b_mine = -amount, amount - fee
+                    q_vol = _truncated(_div(price * amount, COIN), quote)
+                q_mine = -q_vol
+            else:
+                feeline = "    Expenses:TradeFee    %s @ %s\n" % (s_fee, s_q_price)
+                if side == 'sell':
+                    b_vol, b_mine = amount, -amount
+                    q_vol = -_truncated(_div(price * amount, COIN), quote)
+                else:
+                    b_vol, b_mine = -amount, amount
+                    q_vol = _truncated(_div(price * amount, COIN), quote)
+                q_mine = -q_vol - fee
+        else:
+            feeline = "\n"
+            if side == 'sell':
+                b_vol, b_mine = amount, -amount
+                q_vol = -_div(price * amount, COIN)
+            else:
+                b_vol, b_mine = -amount, amount
+                q_vol = _div(price * amount, COIN)
+            q_mine = -q_vol
+        entries.append("".join([
+            "P %s %s %s\n" % (date, base, s_price),
+            "P %s %s %s\n" % (date, quote, s_q_price),
+            "%s %s %s %s\n" % (date, exchange, market, side),
+            "    ;<Trade(trade_id='%s', side='%s', amount=%s, price=%s, fee=%s, fee_side='%s', market='%s', "
+            "exchange='%s', time=%s)>\n" % (trade_id, side, s_amount, s_price, s_fee, fee_side, market,
+                                             exchange, datetime_rfc3339(time)),
+            "    Assets:%s:%s    %s @ %s\n" % (exchange, quote, _show(q_mine, quote), s_q_price),
+            "    FX:%s:%s   %s @ %s\n" % (market, side, _show(q_vol, quote), s_q_price),
+            "    Assets:%s:%s    %s @ %s\n" % (exchange, base, _show(b_mine, base), s_price),
+            "    FX:%s:%s   %s @ %s\n" % (market, side, _show(b_vol, base), s_price),
+            feeline]))
+    return entries
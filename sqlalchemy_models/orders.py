@@ -0,0 +1,418 @@
+"""
+In-memory order books built from LimitOrder rows, and bulk reconciling of
+LimitOrder fills and states.
+"""
+import bisect
+import datetime
+import itertools
+import threading
+from collections import OrderedDict, namedtuple
+from decimal import Decimal
+
+try:
+    from sortedcontainers import SortedList
+except ImportError:
+    SortedList = None
+
+from __init__ import sa, orm
+import exchange as em
+from statements import connection_for
+
+__all__ = ['BookOrder', 'OrderBook', 'OrderBooks', 'OrderChange', 'ReconcileResult', 'reconcile_orders']
+
+ZERO = Decimal(0)
+
+
+class _PriceList(list):
+    """
+    A sorted list of prices, for when sortedcontainers isn't installed. Adding
+    and removing find the place by bisection, but move the list, so are O(n).
+    """
+
+    def add(self, price):
+        bisect.insort(self, price)
+
+    def remove(self, price):
+        del self[bisect.bisect_left(self, price)]
+
+
+def _price_list():
+    return SortedList() if SortedList is not None else _PriceList()
+
+
+class BookOrder(namedtuple('BookOrder', ['order_id', 'side', 'price', 'remaining'])):
+    """An order's place in a book. Prices and remaining amounts are Decimals."""
+
+    @classmethod
+    def from_values(cls, order_id, side, price, amount, exec_amount, state='open'):
+        """
+        Build a BookOrder from LimitOrder values, as Amounts or stored numbers.
+        Orders which aren't open have nothing remaining.
+        """
+        amount_type = em.LimitOrder.amount.property.columns[0].type
+        remaining = amount_type.to_decimal(amount) - amount_type.to_decimal(exec_amount or 0)
+        if state != 'open':
+            remaining = ZERO
+        return cls(order_id, side, amount_type.to_decimal(price), remaining)
+
+    @classmethod
+    def from_order(cls, order):
+        """
+        :param LimitOrder order: The order
+        """
+        return cls.from_values(order.order_id, order.side, order.price, order.amount,
+                               order.exec_amount, order.state)
+
+
+class OrderBook(object):
+    """
+    The open orders of one exchange and market, aggregated by price level.
+
+    Each side keeps a sorted list of its prices and a dict of levels. Orders
+    at an existing level are added, filled or cancelled in constant time. A
+    new or emptied level is added to or removed from the price list in
+    O(log n) with the sortedcontainers extra, or O(n) with a plain list
+    otherwise, which bench/orderbook.py times at realistic depths.
+
+    Usage::
+        book = OrderBook.from_query(session, 'kraken', 'BTC_USD')
+        book.best_bid()  # (price, total amount)
+        book.cumulative_depth('ask', levels=10)
+    """
+
+    def __init__(self, exchange, market):
+        self.exchange = exchange
+        self.market = market
+        self._prices = {'bid': _price_list(), 'ask': _price_list()}  # ascending
+        self._levels = {'bid': {}, 'ask': {}}  # price: OrderedDict of order_id: remaining
+        self._totals = {'bid': {}, 'ask': {}}  # price: total remaining
+        self._orders = {}  # order_id: BookOrder
+
+    @classmethod
+    def from_query(cls, session, exchange, market):
+        """
+        Load a book from the open LimitOrders of an exchange and market.
+
+        :param session: The sqlalchemy session to use
+        :param str exchange: The exchange, i.e. 'kraken'
+        :param str market: The market, i.e. 'BTC_USD'
+        :rtype: OrderBook
+        """
+        book = cls(exchange, market)
+        dialect = session.get_bind(mapper=orm.class_mapper(em.LimitOrder)).dialect
+        amount_type = em.LimitOrder.amount.property.columns[0].type
+        raw = amount_type.load_dialect_impl(dialect)
+        rows = session.query(em.LimitOrder.order_id, em.LimitOrder.side,
+                             sa.type_coerce(em.LimitOrder.price, raw),
+                             sa.type_coerce(em.LimitOrder.amount, raw),
+                             sa.type_coerce(em.LimitOrder.exec_amount, raw)).filter(
+            em.LimitOrder.exchange == exchange, em.LimitOrder.market == market,
+            em.LimitOrder.state == 'open').order_by(em.LimitOrder.create_time, em.LimitOrder.id)
+        for order_id, side, price, amount, exec_amount in rows:
+            book.update(BookOrder.from_values(order_id, side, amount_type.from_db(price),
+                                              amount_type.from_db(amount), amount_type.from_db(exec_amount)))
+        return book
+
+    def __len__(self):
+        return len(self._orders)
+
+    def __contains__(self, order_id):
+        return order_id in self._orders
+
+    def update(self, order):
+        """
+        Add, fill or move an order. Orders with nothing remaining are removed.
+
+        :param BookOrder order: The order's current state
+        """
+        current = self._orders.get(order.order_id)
+        if current is not None and (current.side, current.price) != (order.side, order.price):
+            self.remove(order.order_id)
+            current = None
+        if order.remaining <= 0:
+            if current is not None:
+                self.remove(order.order_id)
+            return
+        side, price = order.side, order.price
+        levels = self._levels[side]
+        if price not in levels:
+            self._prices[side].add(price)
+            levels[price] = OrderedDict()
+            self._totals[side][price] = ZERO
+        previous = levels[price].get(order.order_id, ZERO)
+        levels[price][order.order_id] = order.remaining
+        self._totals[side][price] += order.remaining - previous
+        self._orders[order.order_id] = order
+
+    def remove(self, order_id):
+        """
+        Remove an order, i.e. when it is cancelled or closed.
+
+        :param str order_id: The LimitOrder order_id
+        """
+        order = self._orders.pop(order_id, None)
+        if order is None:
+            return
+        side, price = order.side, order.price
+        level = self._levels[side][price]
+        self._totals[side][price] -= level.pop(order_id)
+        if not level:
+            del self._levels[side][price]
+            del self._totals[side][price]
+            self._prices[side].remove(price)
+
+    def best_bid(self):
+        """The highest bid price and its total amount, or None."""
+        prices = self._prices['bid']
+        return (prices[-1], self._totals['bid'][prices[-1]]) if prices else None
+
+    def best_ask(self):
+        """The lowest ask price and its total amount, or None."""
+        prices = self._prices['ask']
+        return (prices[0], self._totals['ask'][prices[0]]) if prices else None
+
+    def depth_at(self, side, price):
+        """
+        The total amount of a side's orders at a price.
+
+        :param str side: 'bid' or 'ask'
+        :param price: The price, as a Decimal or number
+        :rtype: Decimal
+        """
+        amount_type = em.LimitOrder.price.property.columns[0].type
+        return self._totals[side].get(amount_type.to_decimal(price), ZERO)
+
+    def levels(self, side):
+        """
+        A side's price levels, best first.
+
+        :param str side: 'bid' or 'ask'
+        :return: A list of (price, total amount)
+        """
+        prices = reversed(self._prices[side]) if side == 'bid' else self._prices[side]
+        return [(price, self._totals[side][price]) for price in prices]
+
+    def cumulative_depth(self, side, levels=None):
+        """
+        The running total amount of a side, best price first.
+
+        :param str side: 'bid' or 'ask'
+        :param int levels: Only the best levels, if given
+        :return: A list of (price, cumulative amount)
+        """
+        prices = self._prices[side]
+        if levels is not None:
+            prices = prices[-levels:] if side == 'bid' else prices[:levels]
+        if side == 'bid':
+            prices = reversed(prices)
+        total = ZERO
+        depth = []
+        for price in prices:
+            total += self._totals[side][price]
+            depth.append((price, total))
+        return depth
+
+
+class OrderBooks(object):
+    """
+    Order books per exchange and market, kept up to date from LimitOrder
+    inserts and updates when their session commits. Books are loaded from
+    the open orders on first use. Every flushed change is kept until the
+    commit, so a book loaded in between still gets it.
+
+    Usage::
+        books = OrderBooks()
+        books.book('kraken', 'BTC_USD', session).best_ask()
+    """
+
+    def __init__(self):
+        self._books = {}
+        self._lock = threading.Lock()
+        self._pending_key = 'order_books_%s' % id(self)
+        sa.event.listen(em.LimitOrder, 'after_insert', self._on_flush)
+        sa.event.listen(em.LimitOrder, 'after_update', self._on_flush)
+        sa.event.listen(orm.Session, 'after_commit', self._on_commit)
+        sa.event.listen(orm.Session, 'after_rollback', self._on_rollback)
+
+    def _on_flush(self, mapper, connection, target):
+        session = orm.object_session(target)
+        if session is not None:
+            session.info.setdefault(self._pending_key, []).append(
+                ((target.exchange, target.market), BookOrder.from_order(target)))
+
+    def _on_commit(self, session):
+        for key, order in session.info.pop(self._pending_key, []):
+            self.apply(key[0], key[1], order)
+
+    def _on_rollback(self, session):
+        session.info.pop(self._pending_key, None)
+
+    def close(self):
+        """
+        Stop listening for LimitOrder changes.
+        """
+        sa.event.remove(em.LimitOrder, 'after_insert', self._on_flush)
+        sa.event.remove(em.LimitOrder, 'after_update', self._on_flush)
+        sa.event.remove(orm.Session, 'after_commit', self._on_commit)
+        sa.event.remove(orm.Session, 'after_rollback', self._on_rollback)
+
+    def book(self, exchange, market, session=None):
+        """
+        The book for an exchange and market.
+
+        :param str exchange: The exchange, i.e. 'kraken'
+        :param str market: The market, i.e. 'BTC_USD'
+        :param session: A session to load the book with, if it isn't loaded
+        :return: The OrderBook, or None if it isn't loaded and no session was given
+        """
+        key = (exchange, market)
+        if key not in self._books and session is not None:
+            book = OrderBook.from_query(session, exchange, market)
+            with self._lock:
+                self._books.setdefault(key, book)
+        return self._books.get(key)
+
+    def apply(self, exchange, market, order):
+        """
+        Apply an order's new state to its book, if the book is loaded.
+
+        :param BookOrder order: The order's current state
+        """
+        book = self._books.get((exchange, market))
+        if book is not None:
+            with self._lock:
+                book.update(order)
+
+    def apply_changes(self, changes):
+        """
+        Apply the orders changed by reconcile_orders, which bypasses the ORM
+        events these books follow.
+
+        :param changes: OrderChanges, i.e. ReconcileResult.orders
+        """
+        for change in changes:
+            self.apply(change.exchange, change.market, change.book_order())
+
+
+class OrderChange(namedtuple('OrderChange', ['order_id', 'exchange', 'market', 'side', 'price', 'amount',
+                                             'exec_amount', 'old_state', 'state'])):
+    """A LimitOrder updated by reconcile_orders, with amounts as numbers."""
+
+    def book_order(self):
+        """
+        :rtype: BookOrder
+        """
+        return BookOrder.from_values(self.order_id, self.side, self.price, self.amount,
+                                     self.exec_amount, self.state)
+
+
+class ReconcileResult(namedtuple('ReconcileResult', ['orders'])):
+    """The LimitOrders whose exec_amount or state changed in a reconcile."""
+
+    @property
+    def state_changes(self):
+        """The orders that moved to a new state."""
+        return [o for o in self.orders if o.old_state != o.state]
+
+
+CHANGE_FIELDS = ['order_id', 'exchange', 'market', 'side', 'price', 'amount', 'exec_amount']
+
+
+def _reconcile_values(conn, rows, change_time):
+    """Postgres: one UPDATE ... FROM (VALUES ...), returning the old state from a self join."""
+    table = em.LimitOrder.__table__
+    dialect = conn.dialect
+    amount_type = table.c.exec_amount.type
+    raw = amount_type.load_dialect_impl(dialect).compile(dialect=dialect)
+    state = table.c.state.type.name
+    preparer = dialect.identifier_preparer
+    params = {'change_time': change_time}
+    values = []
+    for i, (order_id, exec_amount, new_state) in enumerate(rows):
+        values.append("(:o%d, CAST(:e%d AS %s), CAST(:s%d AS %s))" % (i, i, raw, i, state))
+        params.update({'o%d' % i: order_id, 'e%d' % i: amount_type.process_bind_param(exec_amount, dialect),
+                       's%d' % i: new_state})
+    sql = ("UPDATE {t} AS o SET exec_amount = v.exec_amount, state = v.state, change_time = :change_time "
+           "FROM (VALUES {values}) AS v (order_id, exec_amount, state), {t} AS old "
+           "WHERE o.order_id = v.order_id AND old.id = o.id "
+           "AND (o.exec_amount <> v.exec_amount OR o.state IS DISTINCT FROM v.state) "
+           "RETURNING {fields}, old.state, o.state").format(
+        t=preparer.format_table(table), values=", ".join(values),
+        fields=", ".join("o.%s" % preparer.quote(f) for f in CHANGE_FIELDS))
+    return list(conn.execute(sa.text(sql), **params))
+
+
+def _reconcile_temp_table(conn, rows, change_time):
+    """Other databases: join against a temporary table of the new values."""
+    table = em.LimitOrder.__table__
+    dialect = conn.dialect
+    amount_type = table.c.exec_amount.type
+    raw = amount_type.load_dialect_impl(dialect)
+    temp = sa.Table('reconcile_limit_order', sa.MetaData(),
+                    sa.Column('order_id', sa.String(80), primary_key=True),
+                    sa.Column('exec_amount', raw),
+                    sa.Column('state', sa.String(7)),
+                    prefixes=['TEMPORARY'])
+    temp.create(conn)
+    try:
+        conn.execute(temp.insert(), [{'order_id': order_id, 'state': state,
+                                      'exec_amount': amount_type.process_bind_param(exec_amount, dialect)}
+                                     for order_id, exec_amount, state in rows])
+        differs = sa.or_(sa.type_coerce(table.c.exec_amount, raw) != temp.c.exec_amount,
+                         table.c.state.is_distinct_from(temp.c.state))
+        joined = table.join(temp, table.c.order_id == temp.c.order_id)
+        changed = list(conn.execute(sa.select([table.c[f] if f not in ('price', 'amount', 'exec_amount')
+                                               else sa.type_coerce(table.c[f], raw) for f in CHANGE_FIELDS[:-1]] +
+                                              [temp.c.exec_amount, table.c.state, temp.c.state, table.c.id])
+                                    .select_from(joined).where(differs)))
+        ids = [row[-1] for row in changed]
+        new = lambda column: sa.select([column]).where(temp.c.order_id == table.c.order_id).as_scalar()
+        for start in range(0, len(ids), 500):
+            conn.execute(table.update().where(table.c.id.in_(ids[start:start + 500])).values(
+                exec_amount=new(temp.c.exec_amount), state=new(temp.c.state), change_time=change_time))
+    finally:
+        temp.drop(conn)
+    return [row[:-1] for row in changed]
+
+
+def reconcile_orders(bind, rows, exchange=None, change_time=None, batch_size=10000):
+    """
+    Apply many LimitOrder fills and state transitions without loading the
+    orders. Only orders whose exec_amount or state differ are written, and
+    their change_time is set.
+
+    Postgres uses one UPDATE ... FROM (VALUES ...) per batch; other databases
+    join against a temporary table. LimitOrders loaded in a session passed as
+    bind are expired.
+
+    Usage::
+        result = reconcile_orders(session, [('abc', 0.5, 'open'), ('def', 1, 'closed')], exchange='kraken')
+        books.apply_changes(result.orders)
+
+    :param bind: The session, engine or connection to write with
+    :param rows: An iterable of (order_id, exec_amount, state) tuples
+    :param str exchange: Prefix order ids with this exchange, like the LimitOrder constructor
+    :param datetime change_time: The change_time to set, defaults to now
+    :param int batch_size: The number of orders to update per statement
+    :rtype: ReconcileResult
+    """
+    amount_type = em.LimitOrder.amount.property.columns[0].type
+    change_time = change_time if change_time is not None else datetime.datetime.utcnow()
+    rows = iter(rows)
+    changed = []
+    with connection_for(bind) as conn:
+        reconcile = _reconcile_values if conn.dialect.name == 'postgresql' else _reconcile_temp_table
+        while True:
+            batch = [(em.LimitOrder.unique_id(exchange, order_id) if exchange is not None else order_id,
+                      exec_amount, state) for order_id, exec_amount, state in itertools.islice(rows, batch_size)]
+            if not batch:
+                break
+            for row in reconcile(conn, batch, change_time):
+                changed.append(OrderChange(*(list(row[:4]) + [amount_type.from_db(v) for v in row[4:7]] +
+                                             list(row[7:]))))
+    if isinstance(bind, orm.Session) and changed:
+        order_ids = set(o.order_id for o in changed)
+        for obj in list(bind.identity_map.values()):
+            if isinstance(obj, em.LimitOrder) and obj.order_id in order_ids:
+                bind.expire(obj)
+    return ReconcileResult(changed)
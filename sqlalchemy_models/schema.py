@@ -0,0 +1,94 @@
+"""
+Schema bootstrap helpers: table collection and stored schema fingerprints.
+"""
+import datetime
+import hashlib
+from collections import namedtuple
+
+import sqlalchemy as sa
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+__all__ = ['SetupResult', 'collect_tables', 'schema_fingerprints', 'stored_fingerprints',
+           'store_fingerprints']
+
+# Kept out of the models' metadata, so create_all never checks it.
+fingerprint_table = sa.Table('schema_fingerprint', sa.MetaData(),
+                             sa.Column('name', sa.String(128), primary_key=True),
+                             sa.Column('fingerprint', sa.String(40), nullable=False),
+                             sa.Column('time', sa.DateTime(), nullable=False))
+
+
+class SetupResult(namedtuple('SetupResult', ['tables', 'created', 'timings'])):
+    """
+    The tables set up by setup_database, whether create_all ran, and the
+    seconds spent in each phase.
+    """
+
+
+def collect_tables(modules=None, models=None):
+    """
+    The tables for the models in each module's __all__ and the given models,
+    plus the tables their foreign keys refer to, each listed once.
+
+    :param list modules: A list of modules with models inside.
+    :param list models:  A list of models.
+    :rtype: list
+    """
+    models = list(models or [])
+    for modu in modules or []:
+        models.extend(getattr(modu, m) for m in modu.__all__)
+    tables = []
+    pending = [model.__table__ for model in models if hasattr(model, '__table__')]
+    while pending:
+        table = pending.pop(0)
+        if table not in tables:
+            tables.append(table)
+            pending.extend(fk.column.table for fk in table.foreign_keys)
+    return tables
+
+
+def schema_fingerprints(tables, dialect):
+    """
+    A hash of each table's DDL, with its indexes, for a dialect.
+
+    :param list tables: The tables to fingerprint
+    :param dialect: The dialect the DDL is compiled for
+    :return: A dict of fingerprints by table name
+    """
+    fingerprints = {}
+    for table in tables:
+        ddl = [str(CreateTable(table).compile(dialect=dialect))]
+        ddl.extend(sorted(str(CreateIndex(index).compile(dialect=dialect)) for index in table.indexes))
+        fingerprints[table.name] = hashlib.sha1("\n".join(ddl)).hexdigest()
+    return fingerprints
+
+
+def stored_fingerprints(eng, names):
+    """
+    The fingerprints stored for some tables, without reflecting the schema.
+
+    :param eng: The sqlalchemy engine to use.
+    :param list names: The table names
+    :return: A dict of fingerprints by table name, empty if none were stored
+    """
+    try:
+        rows = eng.execute(sa.select([fingerprint_table.c.name, fingerprint_table.c.fingerprint])
+                           .where(fingerprint_table.c.name.in_(names)))
+    except sa.exc.DBAPIError:
+        return {}  # no fingerprint table yet
+    return dict(list(rows))
+
+
+def store_fingerprints(eng, fingerprints):
+    """
+    Replace the stored fingerprints for some tables.
+
+    :param eng: The sqlalchemy engine to use.
+    :param dict fingerprints: The fingerprints by table name
+    """
+    fingerprint_table.create(eng, checkfirst=True)
+    now = datetime.datetime.utcnow()
+    with eng.begin() as conn:
+        conn.execute(fingerprint_table.delete().where(fingerprint_table.c.name.in_(list(fingerprints))))
+        conn.execute(fingerprint_table.insert(), [{'name': name, 'fingerprint': fingerprint, 'time': now}
+                                                  for name, fingerprint in fingerprints.items()])
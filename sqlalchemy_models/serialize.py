@@ -0,0 +1,208 @@
+"""
+Cached, precompiled JSON serializers for models, driven by definitions.json.
+"""
+import copy
+import json
+import os
+
+import sqlalchemy.orm as orm
+from alchemyjsonschema.dictify import jsonify_dict, get_properties, ConvertionError
+from ledger import Amount
+
+__all__ = ['SerializerRegistry', 'SERIALIZERS', 'load_schemas', 'serialize',
+           'serialize_many']
+
+DEFINITIONS_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'definitions.json')
+
+
+def load_schemas(fpath=DEFINITIONS_PATH):
+    """
+    Read the json schema definitions from disk.
+
+    :param str fpath: The path of the definitions file
+    :return: The definitions, keyed by model name
+    """
+    with open(fpath, 'r') as f:
+        return json.loads(f.read())['definitions']
+
+
+def _number(ob):
+    if ob is None:
+        return None
+    if isinstance(ob, Amount):
+        ob = ob.to_double()
+    return float(ob)
+
+
+class SerializerRegistry(object):
+    """
+    Loads the schema definitions once, and compiles one serializer function
+    per model, with its properties and converters resolved up front.
+
+    The output matches alchemyjsonschema's jsonify, without modifying the
+    serialized objects. In strict mode, meant for tests, every call checks
+    that the sessions of the serialized objects have nothing dirty.
+    """
+
+    def __init__(self, fpath=DEFINITIONS_PATH, strict=False):
+        self.fpath = fpath
+        self.strict = strict
+        self._schemas = None
+        self._specs = {}
+        self._serializers = {}
+        self._folds = {}
+
+    @property
+    def schemas(self):
+        if self._schemas is None:
+            self._schemas = load_schemas(self.fpath)
+        return self._schemas
+
+    def spec(self, name):
+        """
+        The schema for a model, with its definitions attached for $ref lookup.
+
+        :param str name: The model name, i.e. 'Trade'
+        :rtype: dict
+        """
+        if name not in self._specs:
+            spec = copy.copy(self.schemas[name])
+            spec['definitions'] = self.schemas
+            self._specs[name] = spec
+        return self._specs[name]
+
+    def serializer(self, name):
+        """
+        The compiled serializer for a model. It takes an object and returns
+        the dict jsonify would.
+
+        :param str name: The model name, i.e. 'Trade'
+        """
+        if name not in self._serializers:
+            spec = self.spec(name)
+            self._serializers[name] = self._fold(get_properties(spec, spec), spec)
+        return self._serializers[name]
+
+    def _fold(self, properties, root):
+        key = id(properties)
+        if key not in self._folds:
+            fields = []
+
+            def fold(ob):
+                if ob is None:
+                    return None
+                d = {}
+                for name, convert in fields:
+                    val = convert(ob)
+                    if val is not None:
+                        d[name] = val
+                return d
+
+            # register before compiling fields, so recursive $refs resolve
+            self._folds[key] = fold
+            for name, schema in properties.items():
+                fields.append((name, self._field(name, schema, root)))
+        return self._folds[key]
+
+    def _field(self, name, schema, root):
+        type_ = schema.get("type")
+        if type_ == "array":
+            fold = self._fold(get_properties(schema, root), root)
+            return lambda ob: [fold(e) for e in getattr(ob, name, [])]
+        elif type_ is None or type_ == "object":
+            fold = self._fold(get_properties(schema, root), root)
+            return lambda ob: fold(getattr(ob, name))
+        convert = self.converter(name, schema)
+        return lambda ob: convert(getattr(ob, name, None))
+
+    def converter(self, name, schema):
+        """
+        The function converting a scalar property's value for json.
+
+        :param str name: The property name
+        :param dict schema: The property's schema
+        """
+        format_ = (schema.get("type"), schema.get("format"))
+        if format_ == ('number', None):
+            return _number
+        elif format_ in jsonify_dict:
+            return jsonify_dict[format_]
+        raise ConvertionError(name, "convert {} failure. unknown format {}".format(name, format_))
+
+    def dictify(self, obj, name=None):
+        """
+        Convert a model object to a json-ready dict.
+
+        :param obj: The model object
+        :param str name: The schema name, defaults to the object's class name
+        :rtype: dict
+        """
+        return self.serializer(name or obj.__class__.__name__)(obj)
+
+    def serialize(self, obj, name=None):
+        """
+        Serialize a model object to a json string.
+
+        :param obj: The model object
+        :param str name: The schema name, defaults to the object's class name
+        :rtype: str
+        """
+        data = json.dumps(self.dictify(obj, name))
+        if self.strict:
+            self.check_clean([obj])
+        return data
+
+    def serialize_many(self, objs, name=None):
+        """
+        Serialize many model objects to json strings.
+
+        :param objs: An iterable of model objects
+        :param str name: The schema name, defaults to each object's class name
+        :rtype: list
+        """
+        if self.strict:
+            objs = list(objs)
+        if name is not None:
+            serializer = self.serializer(name)
+            data = [json.dumps(serializer(obj)) for obj in objs]
+        else:
+            data = [json.dumps(self.dictify(obj)) for obj in objs]
+        if self.strict:
+            self.check_clean(objs)
+        return data
+
+    def check_clean(self, objs):
+        """
+        Assert that serializing left the objects' sessions with nothing dirty.
+
+        :param objs: The serialized model objects
+        """
+        sessions = set(orm.object_session(obj) for obj in objs)
+        sessions.discard(None)
+        for session in sessions:
+            assert not session.dirty, "serialization dirtied %s" % list(session.dirty)
+
+
+SERIALIZERS = SerializerRegistry()
+
+
+def serialize(obj, name=None):
+    """
+    Serialize a model object to a json string, using the shared registry.
+
+    :param obj: The model object
+    :param str name: The schema name, defaults to the object's class name
+    :rtype: str
+    """
+    return SERIALIZERS.serialize(obj, name)
+
+
+def serialize_many(objs, name=None):
+    """
+    Serialize many model objects to json strings, using the shared registry.
+
+    :param objs: An iterable of model objects
+    :param str name: The schema name, defaults to each object's class name
+    :rtype: list
+    """
+    return SERIALIZERS.serialize_many(objs, name)
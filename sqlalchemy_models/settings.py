@@ -0,0 +1,198 @@
+"""
+Typed user settings, loaded for many users in one query.
+"""
+from collections import OrderedDict
+
+from __init__ import sa, orm
+from cache import TTLCache
+import user as um
+
+__all__ = ['SettingCatalog', 'SettingsCache', 'catalog', 'load_settings', 'set_settings']
+
+# Setting.value_type: the model holding values of that type
+SETTING_MODELS = OrderedDict([('int', um.IntUserSetting),
+                              ('str', um.StrUserSetting),
+                              ('date-time', um.DateTimeUserSetting)])
+
+
+class SettingCatalog(object):
+    """
+    The Setting rows by name, loaded once per process.
+
+    The settings models are not in user.__all__, so their tables are only
+    set up with setup_database(eng, models=[Setting, IntUserSetting, ...]).
+    """
+
+    def __init__(self):
+        self._by_name = {}
+        self._by_id = {}
+        self.loaded = False
+
+    def load(self, session, reload=False):
+        """
+        Read the Setting rows. Only the first call queries, unless reload is set.
+
+        :param session: The sqlalchemy session to use
+        :param bool reload: Query again, i.e. after adding Settings
+        """
+        if self.loaded and not reload:
+            return
+        rows = session.query(um.Setting.id, um.Setting.name, um.Setting.value_type).all()
+        self._by_name = dict((name, (setting_id, value_type)) for setting_id, name, value_type in rows)
+        self._by_id = dict((setting_id, name) for setting_id, name, value_type in rows)
+        self.loaded = True
+
+    def get(self, name):
+        """
+        The id and value_type of a Setting.
+
+        :param str name: The Setting name
+        :raises ValueError: For an unknown Setting
+        :return: (id, value_type)
+        """
+        if name not in self._by_name:
+            raise ValueError("unknown setting '%s'" % name)
+        return self._by_name[name]
+
+    def name(self, setting_id):
+        """The name of a Setting id, or None."""
+        return self._by_id.get(setting_id)
+
+
+class SettingsCache(TTLCache):
+    """
+    A read-through cache of each user's settings, for load_settings.
+    Entries for a user are dropped whenever one of their settings is flushed
+    by the ORM or written by set_settings, and again when that session
+    commits or rolls back, in case settings were read in between.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        super(SettingsCache, self).__init__(maxsize=maxsize, ttl=ttl)
+        self._pending_key = 'settings_cache_%s' % id(self)
+        for model in SETTING_MODELS.values():
+            for event in ('after_insert', 'after_update', 'after_delete'):
+                sa.event.listen(model, event, self._on_flush)
+        sa.event.listen(orm.Session, 'after_commit', self._on_end)
+        sa.event.listen(orm.Session, 'after_rollback', self._on_end)
+
+    def _on_flush(self, mapper, connection, target):
+        session = orm.object_session(target)
+        if session is not None:
+            self.written(session, [target.user_id])
+        else:
+            self.invalidate(target.user_id)
+
+    def _on_end(self, session):
+        for user_id in session.info.pop(self._pending_key, ()):
+            self.invalidate(user_id)
+
+    def written(self, session, user_ids):
+        """
+        Drop users whose settings a session wrote, now and again when its
+        transaction ends.
+
+        :param session: The sqlalchemy session that wrote the settings
+        :param user_ids: The users' ids
+        """
+        pending = session.info.setdefault(self._pending_key, set())
+        for user_id in user_ids:
+            self.invalidate(user_id)
+            pending.add(user_id)
+
+    def close(self):
+        """
+        Stop listening for setting flushes and session commits.
+        """
+        for model in SETTING_MODELS.values():
+            for event in ('after_insert', 'after_update', 'after_delete'):
+                sa.event.remove(model, event, self._on_flush)
+        sa.event.remove(orm.Session, 'after_commit', self._on_end)
+        sa.event.remove(orm.Session, 'after_rollback', self._on_end)
+
+
+# The process-wide catalog
+catalog = SettingCatalog()
+
+
+def _settings_query(user_ids):
+    """One UNION ALL over the setting tables, with a value column per type."""
+    value_types = [sa.Integer, sa.String(320), sa.DateTime()]
+    selects = []
+    for i, model in enumerate(SETTING_MODELS.values()):
+        table = model.__table__
+        values = [table.c.value if j == i else sa.cast(sa.null(), value_type)
+                  for j, value_type in enumerate(value_types)]
+        selects.append(sa.select([table.c.id, table.c.user_id, table.c.setting_id, sa.literal(i)] + values)
+                       .where(table.c.user_id.in_(user_ids)))
+    return sa.union_all(*selects)
+
+
+def load_settings(session, user_ids, cache=None):
+    """
+    Every setting of some users, as typed values by Setting name. Where a
+    user has several rows for a setting, the last one written wins.
+
+    :param session: The sqlalchemy session to use
+    :param user_ids: A list of user ids
+    :param SettingsCache cache: A cache to read users' settings through
+    :return: A dict of {name: value} dicts by user_id
+    """
+    settings = {}
+    missing = []
+    for user_id in user_ids:
+        cached = cache.get(user_id) if cache is not None else None
+        if cached is not None:
+            settings[user_id] = dict(cached)
+        else:
+            missing.append(user_id)
+    if missing:
+        catalog.load(session)
+        loaded = dict((user_id, {}) for user_id in missing)
+        rows = sorted(session.execute(_settings_query(missing)), key=lambda row: row[0])
+        if any(catalog.name(row[2]) is None for row in rows):
+            catalog.load(session, reload=True)  # Settings added since the catalog was loaded
+        for row_id, user_id, setting_id, kind, int_value, str_value, datetime_value in rows:
+            loaded[user_id][catalog.name(setting_id)] = (int_value, str_value, datetime_value)[kind]
+        for user_id, values in loaded.items():
+            if cache is not None:
+                cache.set(user_id, values)
+            settings[user_id] = dict(values)
+    return settings
+
+
+def set_settings(session, settings, cache=None):
+    """
+    Write settings for many users, replacing any earlier rows of the same
+    setting. A value of None only deletes. Each setting table gets one DELETE
+    per Setting and one executemany INSERT. The caller commits.
+
+    :param session: The sqlalchemy session to use
+    :param dict settings: {name: value} dicts by user_id
+    :param SettingsCache cache: A cache to drop the users from
+    :raises ValueError: For an unknown Setting
+    :return: The number of rows inserted
+    """
+    catalog.load(session)
+    deletes = {}  # (value_type, setting_id): user_ids
+    inserts = dict((value_type, []) for value_type in SETTING_MODELS)
+    for user_id, values in settings.items():
+        for name, value in values.items():
+            try:
+                setting_id, value_type = catalog.get(name)
+            except ValueError:
+                catalog.load(session, reload=True)  # a Setting added since the catalog was loaded
+                setting_id, value_type = catalog.get(name)
+            deletes.setdefault((value_type, setting_id), []).append(user_id)
+            if value is not None:
+                inserts[value_type].append({'user_id': user_id, 'setting_id': setting_id, 'value': value})
+    conn = session.connection()
+    for (value_type, setting_id), user_ids in deletes.items():
+        table = SETTING_MODELS[value_type].__table__
+        conn.execute(table.delete().where(sa.and_(table.c.setting_id == setting_id, table.c.user_id.in_(user_ids))))
+    for value_type, rows in inserts.items():
+        if rows:
+            conn.execute(SETTING_MODELS[value_type].__table__.insert(), rows)
+    if cache is not None:
+        cache.written(session, settings)
+    return sum(len(rows) for rows in inserts.values())
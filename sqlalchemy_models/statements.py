@@ -0,0 +1,97 @@
+"""
+Statement helpers shared by the bulk write modules.
+"""
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+
+__all__ = ['connection_for', 'on_conflict_statement', 'execute_statement', 'insert_on_conflict',
+           'committed_horizon']
+
+
+@contextmanager
+def connection_for(bind):
+    """A connection for a session (in its transaction), engine (in a new one) or connection."""
+    if isinstance(bind, orm.Session):
+        yield bind.connection()
+    elif isinstance(bind, sa.engine.Engine):
+        with bind.begin() as conn:
+            yield conn
+    else:
+        yield bind
+
+
+def on_conflict_statement(dialect, table, batch, key, action='DO NOTHING', returning='id'):
+    """
+    Build INSERT ... ON CONFLICT (key) for a batch of row dicts, and its
+    params. Postgres gets one multi-row statement, returning the given SQL
+    for the written rows, with ids drawn from the table's sequence. Other
+    databases get a statement and list of rows for executemany.
+    """
+    preparer = dialect.identifier_preparer
+    keys = sorted(batch[0])
+    if dialect.name == 'postgresql':
+        sequence = table.c.id.default if isinstance(table.c.id.default, sa.Sequence) else None
+        columns = (['id'] if sequence is not None and 'id' not in keys else []) + keys
+        head = "INSERT INTO %s (%s) VALUES " % (preparer.format_table(table),
+                                               ", ".join(preparer.quote(k) for k in columns))
+        values, binds, params = [], [], {}
+        for i, row in enumerate(batch):
+            names = ["%s_%d" % (k, i) for k in keys]
+            placeholders = [":%s" % name for name in names]
+            if columns[0] == 'id' and 'id' not in keys:
+                # the sequence is client side, so the column has no server default
+                placeholders.insert(0, "nextval('%s')" % preparer.format_sequence(sequence))
+            values.append("(%s)" % ", ".join(placeholders))
+            binds.extend(sa.bindparam(name, type_=table.c[k].type) for name, k in zip(names, keys))
+            params.update(zip(names, (row[k] for k in keys)))
+        sql = head + ", ".join(values) + " ON CONFLICT (%s) %s RETURNING %s" % (preparer.quote(key), action,
+                                                                                returning)
+        return sa.text(sql).bindparams(*binds), params
+    head = "INSERT INTO %s (%s) VALUES " % (preparer.format_table(table),
+                                           ", ".join(preparer.quote(k) for k in keys))
+    sql = head + "(%s)" % ", ".join(":%s" % k for k in keys) + " ON CONFLICT (%s) %s" % (preparer.quote(key), action)
+    return sa.text(sql).bindparams(*[sa.bindparam(k, type_=table.c[k].type) for k in keys]), batch
+
+
+def execute_statement(conn, stmt, params):
+    """
+    Execute a statement from on_conflict_statement: with a dict of params
+    once, or with a list of rows as executemany.
+    """
+    if isinstance(params, dict):
+        return conn.execute(stmt, **params)
+    return conn.execute(stmt, params)
+
+
+def insert_on_conflict(conn, table, batch, key, action='DO NOTHING', returning='id'):
+    """
+    Execute INSERT ... ON CONFLICT (key) for a batch of row dicts. See
+    on_conflict_statement. Returns the result, with rows on Postgres and a
+    rowcount elsewhere.
+    """
+    stmt, params = on_conflict_statement(conn.dialect, table, batch, key, action, returning)
+    return execute_statement(conn, stmt, params)
+
+
+def committed_horizon(conn, tables):
+    """
+    Postgres: the highest id of each table that no uncommitted row can be
+    below. A SHARE lock waits for every transaction writing the tables to
+    end, so the ids read under it were all committed. It is taken on another
+    connection, so writers are only held up for the reads, and conn must not
+    hold uncommitted writes to the tables itself. This holds as long as ids
+    are drawn by the INSERTs themselves, as the models do.
+
+    :param conn: A connection to the database, for its engine
+    :param tables: The tables, with integer id columns
+    :return: A dict of the highest committed id by table
+    """
+    preparer = conn.dialect.identifier_preparer
+    with conn.engine.connect() as other:
+        with other.begin():
+            other.execute(sa.text("LOCK TABLE %s IN SHARE MODE" % ", ".join(
+                preparer.format_table(table) for table in tables)))
+            return dict((table, other.execute(sa.select([sa.func.max(table.c.id)])).scalar() or 0)
+                        for table in tables)
@@ -0,0 +1,156 @@
+"""
+An in-process store of the latest Ticker per exchange and market.
+"""
+import datetime
+import threading
+
+from __init__ import sa, orm
+from cache import TTLCache
+import exchange as em
+
+__all__ = ['TickerStore', 'latest_ticker', 'copy_ticker']
+
+
+def latest_ticker(session, exchange, market):
+    """
+    The latest Ticker for an exchange and market, using the
+    (exchange, market, time) index.
+
+    :param session: The sqlalchemy session to use
+    :param str exchange: The exchange, i.e. 'kraken'
+    :param str market: The market, i.e. 'BTC_USD'
+    :rtype: Ticker
+    """
+    return session.query(em.Ticker).filter(em.Ticker.exchange == exchange, em.Ticker.market == market)\
+        .order_by(em.Ticker.time.desc(), em.Ticker.id.desc()).first()
+
+
+def copy_ticker(ticker):
+    """
+    A transient copy of a Ticker, sharing its Amounts, which stays readable
+    after the original's session is closed.
+
+    :param Ticker ticker: The Ticker to copy
+    :rtype: Ticker
+    """
+    copy = orm.class_mapper(em.Ticker).class_manager.new_instance()
+    for prop in orm.class_mapper(em.Ticker).column_attrs:
+        setattr(copy, prop.key, getattr(ticker, prop.key))
+    return copy
+
+
+class TickerStore(object):
+    """
+    The latest Ticker per exchange and market, kept in memory.
+
+    Tickers added through the ORM are stored when their session commits.
+    Rows written outside the ORM, i.e. with the ingest module, are only seen
+    through a read-through lookup once the cached entry is gone.
+
+    Entries expire ttl seconds after they are stored, and are treated as
+    missing when the ticker time is more than max_age seconds old. Stored
+    Tickers are shared, don't modify them.
+
+    Usage::
+        store = TickerStore(ttl=60)
+        store.get('kraken', 'BTC_USD')
+        store.best('BTC_USD')  # the best bid and ask across exchanges
+    """
+
+    def __init__(self, ttl=60, max_age=None, maxsize=10000):
+        self.max_age = max_age
+        self._latest = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._exchanges = {}  # market: set of exchanges
+        self._lock = threading.Lock()
+        self._pending_key = 'ticker_store_%s' % id(self)
+        sa.event.listen(em.Ticker, 'after_insert', self._on_insert)
+        sa.event.listen(orm.Session, 'after_commit', self._on_commit)
+        sa.event.listen(orm.Session, 'after_rollback', self._on_rollback)
+
+    def _on_insert(self, mapper, connection, target):
+        session = orm.object_session(target)
+        if session is not None:
+            session.info.setdefault(self._pending_key, []).append(copy_ticker(target))
+
+    def _on_commit(self, session):
+        for ticker in session.info.pop(self._pending_key, []):
+            self.update(ticker)
+
+    def _on_rollback(self, session):
+        session.info.pop(self._pending_key, None)
+
+    def close(self):
+        """
+        Stop listening for Ticker inserts.
+        """
+        sa.event.remove(em.Ticker, 'after_insert', self._on_insert)
+        sa.event.remove(orm.Session, 'after_commit', self._on_commit)
+        sa.event.remove(orm.Session, 'after_rollback', self._on_rollback)
+
+    def update(self, ticker):
+        """
+        Store a Ticker, unless a newer one is stored for its exchange and market.
+
+        :param Ticker ticker: The Ticker, which must not be modified afterwards
+        """
+        key = (ticker.exchange, ticker.market)
+        with self._lock:
+            current = self._latest.get(key)
+            if current is None or ticker.time >= current.time:
+                self._latest.set(key, ticker)
+                self._exchanges.setdefault(ticker.market, set()).add(ticker.exchange)
+
+    def _fresh(self, ticker):
+        if ticker is None or self.max_age is None:
+            return ticker
+        if ticker.time < datetime.datetime.utcnow() - datetime.timedelta(seconds=self.max_age):
+            return None
+        return ticker
+
+    def get(self, exchange, market, session=None):
+        """
+        The latest Ticker for an exchange and market.
+
+        :param str exchange: The exchange, i.e. 'kraken'
+        :param str market: The market, i.e. 'BTC_USD'
+        :param session: A session to read through to on a miss
+        :return: The Ticker, or None if it is unknown or stale
+        """
+        ticker = self._fresh(self._latest.get((exchange, market)))
+        if ticker is None and session is not None:
+            ticker = latest_ticker(session, exchange, market)
+            if ticker is not None:
+                ticker = copy_ticker(ticker)
+                self.update(ticker)
+                ticker = self._fresh(ticker)
+        return ticker
+
+    def best(self, market):
+        """
+        The consolidated Ticker for a market across exchanges: the best bid
+        and ask, the widest high and low, the total volume and the most
+        recent last price. Exchanges with stale Tickers are left out.
+
+        :param str market: The market, i.e. 'BTC_USD'
+        :return: A Ticker with exchange 'multiple', or None if none are fresh
+        """
+        with self._lock:
+            exchanges = list(self._exchanges.get(market, ()))
+        tickers = []
+        for exchange in exchanges:
+            ticker = self._latest.get((exchange, market))
+            if ticker is None:
+                with self._lock:
+                    self._exchanges[market].discard(exchange)  # expired or evicted
+            elif self._fresh(ticker) is not None:
+                tickers.append(ticker)
+        if not tickers:
+            return None
+        latest = max(tickers, key=lambda t: t.time)
+        volume = tickers[0].volume
+        for ticker in tickers[1:]:
+            volume = volume + ticker.volume
+        return em.Ticker(bid=max(t.bid for t in tickers), ask=min(t.ask for t in tickers),
+                         high=max(t.high for t in tickers), low=min(t.low for t in tickers),
+                         volume=volume, last=latest.last, market=market, exchange='multiple',
+                         time=latest.time)
@@ -1,4 +1,7 @@
+import datetime
+import itertools
 import json
+from collections import namedtuple
 
 from alchemyjsonschema import command, RelationDesicion, AlsoChildrenWalker
 from ledger import Amount
@@ -8,12 +11,14 @@ import exchange as em
 import todo
 import user as um
 import wallet as wm
-from __init__ import LedgerAmount
+from __init__ import sa, LedgerAmount
+from statements import execute_statement, on_conflict_statement
 
 
 def create_user(username, key, session):
     """
-    Create a User and UserKey record in the session provided.
+    Create a User and UserKey record in the session provided, in a single
+    flush and commit. The UserKey is linked to the User by its relationship.
     Will rollback both records if any issues are encountered.
     After rollback, Exception is re-raised.
 
@@ -23,27 +28,120 @@ def create_user(username, key, session):
     :rtype: User
     :return: the new User record
     """
+    user = um.User(username=username)
     try:
-        user = um.User(username=username)
         session.add(user)
+        session.add(um.UserKey(key=key, keytype='public', user=user))
         session.commit()
-    except Exception as e:
+    except Exception:
         session.rollback()
-        session.flush()
-        raise e
-    try:
-        ukey = um.UserKey(key=key, keytype='public', user_id=user.id)
-        session.add(ukey)
-        session.commit()
-    except Exception as e:
-        session.rollback()
-        session.flush()
-        session.delete(user)
-        session.commit()
-        raise e
+        raise
     return user
 
 
+class ProvisionResult(namedtuple('ProvisionResult', ['users', 'failures'])):
+    """
+    The (username, user_id) of each created User, and (index, username,
+    reason) for each row that wasn't created, in the order of the rows.
+    """
+
+
+def _existing(conn, column, values):
+    """The values already stored in a unique column."""
+    return set(r[0] for r in conn.execute(sa.select([column]).where(column.in_(values)))) if values else set()
+
+
+def _user_statement(dialect, rows, now):
+    """The insert for the Users of (index, username, key, keytype) rows, returning id and username on Postgres."""
+    preparer = dialect.identifier_preparer
+    return on_conflict_statement(dialect, um.User.__table__, [{'username': r[1], 'createtime': now} for r in rows],
+                                 'username', returning="%s, %s" % (preparer.quote('id'), preparer.quote('username')))
+
+
+def _key_statement(dialect, rows, ids, now):
+    """The insert for the UserKeys of (index, username, key, keytype) rows, given the user ids by username."""
+    return on_conflict_statement(dialect, um.UserKey.__table__,
+                                 [{'key': key, 'keytype': keytype, 'user_id': ids[username], 'createtime': now,
+                                   'last_nonce': 0} for index, username, key, keytype in rows], 'key')
+
+
+def _create_batch(conn, batch):
+    """Create the users and keys for a batch of (index, username, key, keytype) rows."""
+    users, keys = um.User.__table__, um.UserKey.__table__
+    failures = []
+    taken_names = _existing(conn, users.c.username, [row[1] for row in batch])
+    taken_keys = _existing(conn, keys.c.key, [row[2] for row in batch])
+    rows = []
+    for index, username, key, keytype in batch:
+        if username in taken_names:
+            failures.append((index, username, "username exists"))
+        elif key in taken_keys:
+            failures.append((index, username, "key exists"))
+        else:
+            taken_names.add(username)  # later duplicates in the batch fail too
+            taken_keys.add(key)
+            rows.append((index, username, key, keytype))
+    if not rows:
+        return [], failures
+    now = datetime.datetime.utcnow()
+    result = execute_statement(conn, *_user_statement(conn.dialect, rows, now))
+    if result.returns_rows:
+        ids = dict((username, user_id) for user_id, username in result)
+    else:
+        ids = dict((username, user_id) for user_id, username in conn.execute(
+            sa.select([users.c.id, users.c.username]).where(users.c.username.in_([r[1] for r in rows]))))
+    for index, username, key, keytype in rows:
+        if username not in ids:
+            failures.append((index, username, "username exists"))  # created since the check
+    rows = [r for r in rows if r[1] in ids]
+    if not rows:
+        return [], failures
+    execute_statement(conn, *_key_statement(conn.dialect, rows, ids, now))
+    owners = dict(conn.execute(sa.select([keys.c.key, keys.c.user_id]).where(
+        keys.c.key.in_([r[2] for r in rows]))).fetchall())
+    created, orphans = [], []
+    for index, username, key, keytype in rows:
+        if owners.get(key) == ids[username]:
+            created.append((index, username, ids[username]))
+        else:
+            failures.append((index, username, "key exists"))  # created since the check
+            orphans.append(ids[username])
+    if orphans:
+        conn.execute(users.delete().where(users.c.id.in_(orphans)))
+    return created, failures
+
+
+def create_users(session, rows, batch_size=1000):
+    """
+    Create many Users, each with a UserKey, in the session's transaction.
+    Rows whose username or key is already taken, or repeated in the rows,
+    are reported as failures without aborting the others.
+
+    Each batch checks the usernames and keys with two queries, then inserts
+    users and keys with one INSERT ... ON CONFLICT DO NOTHING each, returning
+    the new ids on Postgres. The caller commits.
+
+    :param session: The sqlalchemy session to use
+    :param rows: An iterable of (username, key) or (username, key, keytype) tuples
+    :param int batch_size: The number of users to insert per statement
+    :rtype: ProvisionResult
+    """
+    conn = session.connection()
+    created, failures = [], []
+    rows = iter(rows)
+    offset = 0
+    while True:
+        batch = [(offset + i, row[0], row[1], row[2] if len(row) > 2 else 'public')
+                 for i, row in enumerate(itertools.islice(rows, batch_size))]
+        if not batch:
+            break
+        offset += len(batch)
+        batch_created, batch_failures = _create_batch(conn, batch)
+        created.extend(batch_created)
+        failures.extend(batch_failures)
+    return ProvisionResult([(username, user_id) for index, username, user_id in sorted(created)], sorted(failures))
+
+
 def build_definitions(dpath="sqlalchemy_models/_definitions.json"):
     """
     Nasty hacky method of ensuring LedgerAmounts are rendered as floats in json schemas, instead of integers.
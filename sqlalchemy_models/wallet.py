@@ -3,8 +3,7 @@ SQLAlchemy models for Wallets
 """
 from alchemyjsonschema.dictify import datetime_rfc3339
 
-from __init__ import sa, orm, Base, LedgerAmount
-from ledger import Amount
+from __init__ import sa, orm, Base, LedgerAmount, apply_commodities
 import datetime
 
 __all__ = ['Balance', 'Address', 'Credit', 'Debit', 'HWBalance']
@@ -12,9 +11,10 @@ __all__ = ['Balance', 'Address', 'Credit', 'Debit', 'HWBalance']
 
 class Balance(Base):
     """A user's balance in a single currency. Only the latest record is valid."""
+    __table_args__ = (sa.Index('ix_balance_user_currency_time', 'user_id', 'currency', 'time'),)
     id = sa.Column(sa.Integer, sa.Sequence('balance_id_seq'), primary_key=True)
-    total = sa.Column(LedgerAmount, nullable=False)
-    available = sa.Column(LedgerAmount, nullable=False)
+    total = sa.Column(LedgerAmount(commodity_column='currency'), nullable=False)
+    available = sa.Column(LedgerAmount(commodity_column='currency'), nullable=False)
     currency = sa.Column(sa.String(4), nullable=False)  # i.e. BTC, DASH, USD
     time = sa.Column(sa.DateTime(), default=datetime.datetime.utcnow)
     reference = sa.Column(sa.String(256), nullable=True)
@@ -40,19 +40,14 @@ class Balance(Base):
                    self.total, self.available, self.currency,
                    self.reference, self.user_id, datetime_rfc3339(self.time))
 
-    @orm.reconstructor
     def load_commodities(self):
         """
         Load the commodities for Amounts in this object.
+
+        LedgerAmount columns are loaded with their commodity, so this is only
+        needed after assigning plain numbers to an instance.
         """
-        if isinstance(self.available, Amount):
-            self.available = Amount("{0:.8f} {1}".format(self.available.to_double(), self.currency))
-        else:
-            self.available = Amount("{0:.8f} {1}".format(self.available, self.currency))
-        if isinstance(self.total, Amount):
-            self.total = Amount("{0:.8f} {1}".format(self.total.to_double(), self.currency))
-        else:
-            self.total = Amount("{0:.8f} {1}".format(self.total, self.currency))
+        apply_commodities(self)
 
 
 class Address(Base):
@@ -82,7 +77,7 @@ class Address(Base):
 class Credit(Base):
     """A Credit, which adds tokens to a User's Balance."""
     id = sa.Column(sa.Integer, sa.Sequence('credit_id_seq'), primary_key=True)
-    amount = sa.Column(LedgerAmount, nullable=False)
+    amount = sa.Column(LedgerAmount(commodity_column='currency'), nullable=False)
     address = sa.Column(sa.String(64),
                         nullable=False)  # i.e. 1PkzTWAyfR9yoFw2jptKQ3g6E5nKXPsy8r, XhwWxABXPVG5Z3ePyLVA3VixPRkARK6FKy
     currency = sa.Column(sa.String(4), nullable=False)  # i.e. BTC, DASH, USD
@@ -127,22 +122,21 @@ class Credit(Base):
         ledger += "\n"
         return ledger
 
-    @orm.reconstructor
     def load_commodities(self):
         """
         Load the commodities for Amounts in this object.
+
+        LedgerAmount columns are loaded with their commodity, so this is only
+        needed after assigning plain numbers to an instance.
         """
-        if isinstance(self.amount, Amount):
-            self.amount = Amount("{0:.8f} {1}".format(self.amount.to_double(), self.currency))
-        else:
-            self.amount = Amount("{0:.8f} {1}".format(self.amount, self.currency))
+        apply_commodities(self)
 
 
 class Debit(Base):
     """A Debit, which subtracts tokens from a User's Balance."""
     id = sa.Column(sa.Integer, sa.Sequence('debit_id_seq'), primary_key=True)
-    amount = sa.Column(LedgerAmount, nullable=False)
-    fee = sa.Column(LedgerAmount, nullable=False)
+    amount = sa.Column(LedgerAmount(commodity_column='currency'), nullable=False)
+    fee = sa.Column(LedgerAmount(commodity_column='currency'), nullable=False)
     address = sa.Column(sa.String(64), nullable=False)  # i.e. 1PkzTWAyfR9yoFw2jptKQ3g6E5nKXPsy8r,  XhwWxABXPVG5Z3ePyLVA3VixPRkARK6FKy
     currency = sa.Column(sa.String(4), nullable=False)  # i.e. BTC, DASH, USDT
     network = sa.Column(sa.String(64), nullable=False)  # i.e. Bitcoin, Dash, Crypto Capital
@@ -193,26 +187,22 @@ class Debit(Base):
         ledger += "\n"
         return ledger
 
-    @orm.reconstructor
     def load_commodities(self):
         """
         Load the commodities for Amounts in this object.
+
+        LedgerAmount columns are loaded with their commodity, so this is only
+        needed after assigning plain numbers to an instance.
         """
-        if isinstance(self.fee, Amount):
-            self.fee = Amount("{0:.8f} {1}".format(self.fee.to_double(), self.currency))
-        else:
-            self.fee = Amount("{0:.8f} {1}".format(self.fee, self.currency))
-        if isinstance(self.amount, Amount):
-            self.amount = Amount("{0:.8f} {1}".format(self.amount.to_double(), self.currency))
-        else:
-            self.amount = Amount("{0:.8f} {1}".format(self.amount, self.currency))
+        apply_commodities(self)
 
 
 class HWBalance(Base):
     """A Hot Wallet Balance, for internal use only"""
+    __table_args__ = (sa.Index('ix_hwbalance_currency_network_time', 'currency', 'network', 'time'),)
     id = sa.Column(sa.Integer, sa.Sequence('hwbalance_id_seq'), primary_key=True)
-    available = sa.Column(LedgerAmount, nullable=False)
-    total = sa.Column(LedgerAmount, nullable=False)
+    available = sa.Column(LedgerAmount(commodity_column='currency'), nullable=False)
+    total = sa.Column(LedgerAmount(commodity_column='currency'), nullable=False)
     currency = sa.Column(sa.String(4), nullable=False)  # i.e. BTC, DASH, USDT
     network = sa.Column(sa.String(64), nullable=False)  # i.e. Bitcoin, Dash, Crypto Capital
     time = sa.Column(sa.DateTime(), default=datetime.datetime.utcnow)
@@ -224,16 +214,11 @@ class HWBalance(Base):
         self.network = network
         self.load_commodities()
 
-    @orm.reconstructor
     def load_commodities(self):
         """
         Load the commodities for Amounts in this object.
+
+        LedgerAmount columns are loaded with their commodity, so this is only
+        needed after assigning plain numbers to an instance.
         """
-        if isinstance(self.available, Amount):
-            self.available = Amount("{0:.8f} {1}".format(self.available.to_double(), self.currency))
-        else:
-            self.available = Amount("{0:.8f} {1}".format(self.available, self.currency))
-        if isinstance(self.total, Amount):
-            self.total = Amount("{0:.8f} {1}".format(self.total.to_double(), self.currency))
-        else:
-            self.total = Amount("{0:.8f} {1}".format(self.total, self.currency))
+        apply_commodities(self)
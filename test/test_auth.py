@@ -0,0 +1,107 @@
+import datetime
+import random
+import string
+import unittest
+
+from sqlalchemy_models import create_session_engine, setup_database, user as um, wallet as wm, exchange as em
+from sqlalchemy_models.auth import KeyResolver, PermissionRegistry, advance_nonce, advance_nonces, _check_nonces
+from sqlalchemy_models.util import create_user
+from tapp_config import get_config
+
+
+class TestAuth(unittest.TestCase):
+    def setUp(self):
+        self.ses, self.eng = create_session_engine(cfg=get_config("helper"))
+        setup_database(self.eng, modules=[um, em, wm], models=[um.KeyPermission])
+        self.username = ''.join([random.choice(string.ascii_letters) for letter in xrange(8)])
+        self.key = ''.join([random.choice(string.ascii_letters) for letter in xrange(36)])
+        self.user = create_user(self.username, self.key, self.ses)
+
+    def tearDown(self):
+        self.ses.close()
+
+    def test_key_resolver(self):
+        resolver = KeyResolver()
+        try:
+            record = resolver.resolve(self.ses, self.key)
+            assert (record.user_id, record.username, record.keytype) == (self.user.id, self.username, 'public')
+            assert resolver.resolve(self.ses, self.key) == record
+            assert (resolver.hits, resolver.misses) == (1, 1)
+            assert resolver.resolve(self.ses, 'missing') is None
+            ukey = self.ses.query(um.UserKey).filter(um.UserKey.key == self.key).one()
+            ukey.deactivated_at = datetime.datetime.utcnow()
+            self.ses.commit()
+            assert resolver.resolve(self.ses, self.key) is None
+            assert resolver.resolve(self.ses, self.key, active_only=False).deactivated_at is not None
+        finally:
+            resolver.close()
+
+    def test_key_resolver_commit(self):
+        resolver = KeyResolver()
+        other, eng = create_session_engine(cfg=get_config("helper"))
+        try:
+            ukey = self.ses.query(um.UserKey).filter(um.UserKey.key == self.key).one()
+            ukey.permissionbits = 2
+            self.ses.flush()
+            assert resolver.resolve(other, self.key).permissionbits != 2  # another session caches the old row
+            self.ses.commit()
+            assert resolver.resolve(other, self.key).permissionbits == 2
+        finally:
+            other.close()
+            resolver.close()
+
+    def test_advance_nonce(self):
+        assert advance_nonce(self.ses, self.key, 5).accepted
+        assert not advance_nonce(self.ses, self.key, 5).accepted
+        assert not advance_nonce(self.ses, 'missing', 1).accepted
+        results = advance_nonces(self.ses, [(self.key, 7), (self.key, 6), ('missing', 1), (self.key, 8)])
+        assert [r.accepted for r in results] == [True, False, False, True]
+        self.ses.commit()
+        assert self.ses.query(um.UserKey.last_nonce).filter(um.UserKey.key == self.key).scalar() == 8
+
+    def test_check_nonces(self):
+        results, latest = _check_nonces({'a': (1, 5), 'b': (2, 9)},
+                                        [('a', 7), ('a', 6), ('b', 9), ('c', 1), ('a', 8)])
+        assert [tuple(r) for r in results] == [(True, 1), (False, None), (False, None), (False, None), (True, 1)]
+        assert latest == {'a': 8}
+
+    def test_permission_registry(self):
+        registry = PermissionRegistry()
+        ukey = self.ses.query(um.UserKey).filter(um.UserKey.key == self.key).one()
+        ukey.permissionbits = 1 | 4
+        self.ses.add_all([um.KeyPermission(permission=1, name='read', user_key_id=ukey.id),
+                          um.KeyPermission(permission=4, name='withdraw', user_key_id=ukey.id)])
+        self.ses.commit()
+        registry.load(self.ses)
+        registry.register('trade', 2)
+        assert registry.mask('read', 'withdraw') == 5
+        assert registry.check(ukey.permissionbits, 'read', 'withdraw')
+        assert not registry.check(ukey.permissionbits, 'trade')
+        assert registry.names(ukey.permissionbits) == ['read', 'withdraw']
+        self.assertRaises(ValueError, registry.register, 'trade', 8)
+        self.assertRaises(ValueError, registry.mask, 'missing')
+        assert ukey in registry.keys_with(self.ses, 'withdraw').all()
+        assert ukey not in registry.keys_with(self.ses, 'trade').all()
+
+    def test_permission_registry_conflicts(self):
+        read, deposit = [''.join([random.choice(string.ascii_letters) for letter in xrange(12)]) for n in xrange(2)]
+        ukey = self.ses.query(um.UserKey).filter(um.UserKey.key == self.key).one()
+        self.ses.add_all([um.KeyPermission(permission=1, name=read, user_key_id=ukey.id),
+                          um.KeyPermission(permission=2, name=read, user_key_id=ukey.id),
+                          um.KeyPermission(permission=8, name=deposit, user_key_id=ukey.id)])
+        self.ses.commit()
+        registry = PermissionRegistry()
+        registry.register(deposit, 16)
+        try:
+            registry.load(self.ses)
+        except ValueError as e:
+            assert "'%s' is 1 and 2" % read in str(e)
+            assert "'%s' is 8 and 16" % deposit in str(e)
+        else:
+            assert False, "conflicting bits were loaded"
+        finally:  # other registries load every KeyPermission
+            self.ses.query(um.KeyPermission).filter(um.KeyPermission.name.in_([read, deposit])).delete(
+                synchronize_session=False)
+            self.ses.commit()
+        assert registry.names(0xff) == [deposit]  # nothing else was registered
+        assert not registry.loaded
@@ -0,0 +1,140 @@
+import datetime
+import random
+import string
+import unittest
+
+from ledger import Amount
+from sqlalchemy_models import (create_session_engine, setup_database,
+                               user as um, wallet as wm, exchange as em)
+from decimal import Decimal
+
+from sqlalchemy_models.balances import BalanceCache, _load_marks, latest_balances, recompute_balances
+from sqlalchemy_models.cache import TTLCache
+from tapp_config import get_config
+
+
+def test_ttl_cache():
+    cache = TTLCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)  # evicts b, the least recently used
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    cache.invalidate('c')
+    assert cache.get('c', 'missing') == 'missing'
+    assert len(cache) == 1
+    expired = TTLCache(ttl=-1)
+    expired.set('a', 1)
+    assert expired.get('a') is None
+
+
+class TestLatestBalances(unittest.TestCase):
+    def setUp(self):
+        self.ses, self.eng = create_session_engine(cfg=get_config("helper"))
+        setup_database(self.eng, modules=[um, em, wm])
+        self.user = um.User(username=''.join([random.choice(string.ascii_letters) for letter in xrange(8)]))
+        self.ses.add(self.user)
+        self.ses.commit()
+
+    def tearDown(self):
+        self.ses.close()
+
+    def add_balance(self, total, currency, time):
+        self.ses.add(wm.Balance(Amount("%s %s" % (total, currency)), Amount("%s %s" % (total, currency)),
+                                currency, 'test', self.user.id, time=time))
+        self.ses.commit()
+
+    def test_latest_balances(self):
+        now = datetime.datetime.utcnow()
+        self.add_balance(1, 'BTC', now - datetime.timedelta(minutes=2))
+        self.add_balance(2, 'BTC', now)
+        self.add_balance(3, 'BTC', now - datetime.timedelta(minutes=1))
+        self.add_balance(5, 'USD', now)
+        balances = latest_balances(self.ses, self.user.id)
+        assert [b.currency for b in balances] == ['BTC', 'USD']
+        assert "2.00000000 BTC" == str(balances[0].total)
+        assert "5.00000000 USD" == str(balances[1].available)
+        assert [b for b in latest_balances(self.ses) if b.user_id == self.user.id] == balances
+
+    def test_balance_cache(self):
+        cache = BalanceCache()
+        try:
+            now = datetime.datetime.utcnow()
+            self.add_balance(1, 'BTC', now)
+            assert "1.00000000 BTC" == str(latest_balances(self.ses, self.user.id, cache=cache)[0].total)
+            latest_balances(self.ses, self.user.id, cache=cache)
+            assert cache.hits == 1
+            self.add_balance(4, 'BTC', now + datetime.timedelta(seconds=1))
+            assert "4.00000000 BTC" == str(latest_balances(self.ses, self.user.id, cache=cache)[0].total)
+        finally:
+            cache.close()
+
+    def test_balance_cache_commit(self):
+        cache = BalanceCache()
+        other, eng = create_session_engine(cfg=get_config("helper"))
+        try:
+            now = datetime.datetime.utcnow()
+            self.add_balance(1, 'BTC', now)
+            self.ses.add(wm.Balance(Amount("6 BTC"), Amount("6 BTC"), 'BTC', 'test', self.user.id,
+                                    time=now + datetime.timedelta(seconds=1)))
+            self.ses.flush()
+            # another session caches the committed balances before the flush is committed
+            assert "1.00000000 BTC" == str(latest_balances(other, self.user.id, cache=cache)[0].total)
+            self.ses.commit()
+            assert "6.00000000 BTC" == str(latest_balances(other, self.user.id, cache=cache)[0].total)
+        finally:
+            other.close()
+            cache.close()
+
+
+class TestRecomputeBalances(unittest.TestCase):
+    def setUp(self):
+        self.ses, self.eng = create_session_engine(cfg=get_config("helper"))
+        setup_database(self.eng, modules=[um, em, wm])
+        self.user = um.User(username=''.join([random.choice(string.ascii_letters) for letter in xrange(8)]))
+        self.ses.add(self.user)
+        self.ses.commit()
+
+    def tearDown(self):
+        self.ses.close()
+
+    def credit(self, amount, state):
+        tid = ''.join([random.choice(string.ascii_letters) for letter in xrange(19)])
+        credit = wm.Credit(Amount("%s BTC" % amount), tid, 'BTC', 'Bitcoin', state, 'test', tid,
+                           self.user.id, datetime.datetime.utcnow())
+        self.ses.add(credit)
+        return credit
+
+    def test_recompute_balances(self):
+        key = (self.user.id, 'BTC')
+        self.credit(1.1, 'complete')
+        pending = self.credit(0.5, 'unconfirmed')
+        self.ses.add(wm.Debit(Amount("0.2 BTC"), Amount("0.01 BTC"), 'addr', 'BTC', 'Bitcoin', 'complete',
+                              'test', 'debit', self.user.id, datetime.datetime.utcnow()))
+        self.credit(3, 'canceled')
+        self.ses.commit()
+        result = recompute_balances(self.ses, full=True, verify=True)
+        assert result.balances[key] == (Decimal('1.39'), Decimal('0.89'))
+        assert result.mismatches == []
+        self.ses.commit()
+        assert "0.89000000 BTC" == str(latest_balances(self.ses, self.user.id)[0].available)
+
+        self.credit(2, 'complete')
+        self.ses.commit()
+        for run in range(2):  # the rows from the unconfirmed one on are summed again on every run
+            result = recompute_balances(self.ses, verify=True)
+            assert result.balances[key] == (Decimal('3.39'), Decimal('2.89'))
+            assert result.marks['credit'] < pending.id
+            assert result.mismatches == []
+            self.ses.commit()
+            assert _load_marks(self.ses.connection()) == result.marks
+        assert "2.89000000 BTC" == str(latest_balances(self.ses, self.user.id)[0].available)
+
+        pending.transaction_state = 'complete'
+        self.ses.commit()
+        result = recompute_balances(self.ses, verify=True)
+        assert result.balances[key] == (Decimal('3.39'), Decimal('3.39'))
+        assert result.mismatches == []
+        self.ses.commit()
+        assert "3.39000000 BTC" == str(latest_balances(self.ses, self.user.id)[0].total)
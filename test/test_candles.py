@@ -0,0 +1,89 @@
+import datetime
+import random
+import string
+import unittest
+
+from sqlalchemy_models import (sa, create_session_engine, setup_database,
+                               user as um, wallet as wm, exchange as em)
+from sqlalchemy_models.candles import bucket_start, get_candles, update_candles
+from sqlalchemy_models.ingest import bulk_insert_tickers
+from tapp_config import get_config
+
+
+def test_bucket_start():
+    time = datetime.datetime(2016, 7, 10, 4, 56, 21)
+    assert bucket_start(time, '1m') == datetime.datetime(2016, 7, 10, 4, 56)
+    assert bucket_start(time, '5m') == datetime.datetime(2016, 7, 10, 4, 55)
+    assert bucket_start(time, '1h') == datetime.datetime(2016, 7, 10, 4)
+    assert bucket_start(time, '1d') == datetime.datetime(2016, 7, 10)
+
+
+class TestCandles(unittest.TestCase):
+    def setUp(self):
+        self.ses, self.eng = create_session_engine(cfg=get_config("helper"))
+        setup_database(self.eng, modules=[um, em, wm])
+        self.exchange = ''.join([random.choice(string.ascii_letters) for letter in xrange(12)])
+        update_candles(self.ses)
+        self.ses.commit()
+
+    def tearDown(self):
+        self.ses.close()
+
+    def add_tickers(self, prices):
+        start = datetime.datetime(2016, 7, 10, 4, 56)
+        bulk_insert_tickers(self.ses, [{'bid': last - 1, 'ask': last + 1, 'high': 800, 'low': 700,
+                                        'volume': 10000 + seconds, 'last': last, 'market': 'BTC_USD',
+                                        'exchange': self.exchange,
+                                        'time': start + datetime.timedelta(seconds=seconds)}
+                                       for seconds, last in prices])
+        self.ses.commit()
+
+    def test_update_candles(self):
+        self.add_tickers([(0, 770), (30, 775), (50, 765), (70, 772)])
+        assert update_candles(self.ses) == 4
+        self.ses.commit()
+        minutes = get_candles(self.ses, self.exchange, 'BTC_USD', '1m')
+        assert [c.bucket_start.minute for c in minutes] == [56, 57]
+        assert "770.00000000 USD" == str(minutes[0].open)
+        assert "775.00000000 USD" == str(minutes[0].high)
+        assert "765.00000000 USD" == str(minutes[0].low)
+        assert "765.00000000 USD" == str(minutes[0].close)
+        assert "766.00000000 USD" == str(minutes[0].ask)
+        assert minutes[0].ticker_count == 3
+
+        # a late ticker for the first minute, and a new low
+        self.add_tickers([(10, 760), (200, 780)])
+        assert update_candles(self.ses) == 2
+        self.ses.commit()
+        minutes = get_candles(self.ses, self.exchange, 'BTC_USD', '1m')
+        assert "760.00000000 USD" == str(minutes[0].low)
+        assert "765.00000000 USD" == str(minutes[0].close)
+        for interval in ('5m', '1h', '1d'):
+            candle, = get_candles(self.ses, self.exchange, 'BTC_USD', interval)
+            assert "770.00000000 USD" == str(candle.open)
+            assert "780.00000000 USD" == str(candle.high)
+            assert "760.00000000 USD" == str(candle.low)
+            assert "780.00000000 USD" == str(candle.close)
+            assert "10200.00000000 BTC" == str(candle.volume)
+            assert candle.ticker_count == 6
+        assert get_candles(self.ses, self.exchange, 'BTC_USD', '5m',
+                           start=datetime.datetime(2016, 7, 10, 5)) == []
+
+    def test_tickers_out_of_id_order(self):
+        start = datetime.datetime(2016, 7, 10, 4, 56)
+        first = (self.ses.query(sa.func.max(em.Ticker.id)).scalar() or 0) + 1
+        for offset, last in ((2, 772), (0, 770), (1, 775)):  # committed in this order
+            ticker = em.Ticker(last - 1, last + 1, 800, 700, 10000, last, 'BTC_USD', self.exchange,
+                               time=start + datetime.timedelta(seconds=offset))
+            ticker.id = first + offset
+            self.ses.add(ticker)
+            self.ses.commit()
+        assert update_candles(self.ses, batch_size=2) == 3
+        self.ses.commit()
+        minute, = get_candles(self.ses, self.exchange, 'BTC_USD', '1m')
+        assert minute.ticker_count == 3
+        assert minute.ticker_id == first + 2
+        assert "770.00000000 USD" == str(minute.open)
+        assert "775.00000000 USD" == str(minute.high)
+        assert "772.00000000 USD" == str(minute.close)
+        assert update_candles(self.ses) == 0
@@ -0,0 +1,50 @@
+import pytest
+from ledger import Amount
+from sqlalchemy_models import exchange as em
+from sqlalchemy_models.util import multiply_tickers
+
+pytest.importorskip("numpy")
+from sqlalchemy_models.crossrates import CrossRates
+
+
+def make_tickers():
+    usdticker = em.Ticker(769, 771, 800, 700, 10000.1, 770, 'BTC_USD', 'helper')
+    dashticker = em.Ticker(0.0199, 0.0201, 0.021, 0.02, 1000000.1, 0.02, 'DASH_BTC', 'helper')
+    eurticker = em.Ticker(0.9, 0.92, 0.95, 0.85, 5000, 0.91, 'USD_EUR', 'helper')
+    return usdticker, dashticker, eurticker
+
+
+def test_cross_rates_multiply():
+    usdticker, dashticker, eurticker = make_tickers()
+    rates = CrossRates([usdticker, dashticker, eurticker])
+    expected = multiply_tickers(dashticker, usdticker)
+    dashusd = rates.ticker('DASH', 'USD')
+    assert dashusd.market == 'DASH_USD'
+    assert dashusd.exchange == 'multiple'
+    for name in ('bid', 'ask', 'high', 'low', 'last'):
+        assert getattr(dashusd, name) == getattr(expected, name)
+    assert rates.ticker('DASH', 'EUR').bid == Amount("%.8f EUR" % (0.0199 * 769 * 0.9))
+    assert rates.ticker('EUR', 'BTC').ask == Amount("%.8f BTC" % (1 / (769 * 0.9)))
+    assert len(rates.tickers()) == 12
+    assert rates.ticker('DASH', 'XMR') is None
+
+
+def test_cross_rates_update():
+    usdticker, dashticker, eurticker = make_tickers()
+    rates = CrossRates([usdticker, dashticker])
+    assert rates.rate('DASH', 'USD') == pytest.approx(0.0199 * 769)
+    rates.update(em.Ticker(770, 772, 800, 700, 10, 771, 'BTC_USD', 'other'))
+    assert rates.rate('DASH', 'USD') == pytest.approx(0.0199 * 770)
+    assert rates.ticker('BTC', 'USD').ask == Amount("771 USD")
+    rates.update(em.Ticker(760, 775, 800, 700, 10, 761, 'BTC_USD', 'other'))
+    assert rates.rate('DASH', 'USD') == pytest.approx(0.0199 * 769)
+    rates.update(eurticker)
+    assert rates.rate('DASH', 'EUR') == pytest.approx(0.0199 * 769 * 0.9)
+
+
+def test_cross_rates_arbitrage():
+    usdticker, dashticker, eurticker = make_tickers()
+    rates = CrossRates([usdticker, dashticker, eurticker])
+    rates.update(em.Ticker(780, 782, 800, 700, 10, 781, 'BTC_USD', 'other'))  # bids over helper's ask
+    with pytest.raises(ValueError):
+        rates.rate('DASH', 'EUR')
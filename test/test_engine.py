@@ -0,0 +1,61 @@
+import threading
+import ConfigParser
+
+import sqlalchemy as sa
+from sqlalchemy_models import create_session_engine, pool_stats
+from sqlalchemy_models.engine import TimedQueuePool, get_engine, pool_options
+from tapp_config import get_config
+
+
+def test_engine_registry():
+    ses, eng = create_session_engine(cfg=get_config("helper"))
+    ses2, eng2 = create_session_engine(cfg=get_config("helper"))
+    assert eng is eng2
+    assert ses is not ses2
+    ses.close()
+    ses2.close()
+
+
+def test_engine_registry_nested_options():
+    uri = get_config("helper").get('db', 'SA_ENGINE_URI')
+    eng = get_engine(uri, connect_args={'timeout': 5}, execution_options={'stream_results': False})
+    assert get_engine(uri, execution_options={'stream_results': False}, connect_args={'timeout': 5}) is eng
+    assert get_engine(uri, connect_args={'timeout': 6}, execution_options={'stream_results': False}) is not eng
+
+
+def test_scoped_session():
+    ses, eng = create_session_engine(cfg=get_config("helper"), scoped=True)
+    ses2, eng2 = create_session_engine(cfg=get_config("helper"), scoped=True)
+    assert ses is ses2
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(ses()))
+    thread.start()
+    thread.join()
+    assert sessions[0] is not ses()
+    ses.remove()
+
+
+def test_pool_options():
+    cfg = ConfigParser.ConfigParser()
+    cfg.add_section('db')
+    cfg.set('db', 'SA_ENGINE_URI', 'postgresql://postgres@localhost/sla')
+    cfg.set('db', 'SA_POOL_SIZE', '20')
+    cfg.set('db', 'SA_POOL_PRE_PING', 'true')
+    assert pool_options(cfg) == {'pool_size': 20, 'pool_pre_ping': True}
+
+
+def test_pool_stats():
+    uri = get_config("helper").get('db', 'SA_ENGINE_URI')
+    eng = get_engine(uri, poolclass=TimedQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.1)
+    conn = eng.connect()
+    try:
+        eng.connect()
+    except sa.exc.TimeoutError:
+        pass
+    conn.close()
+    stats = pool_stats(eng)
+    assert stats['checkouts'] == 1
+    assert stats['checkins'] == 1
+    assert stats['timeouts'] == 1
+    assert stats['max_wait'] >= 0.1
+    assert stats['size'] == 1
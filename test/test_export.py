@@ -0,0 +1,40 @@
+import json
+import StringIO
+import unittest
+
+from sqlalchemy_models import (sa, create_session_engine, setup_database, serialize,
+                               user as um, wallet as wm, exchange as em)
+from sqlalchemy_models.export import export_ndjson
+from tapp_config import get_config
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.ses, self.eng = create_session_engine(cfg=get_config("helper"))
+        setup_database(self.eng, modules=[um, em, wm])
+        for bid in (769, 770, 771):
+            self.ses.add(em.Ticker(bid, 772, 800, 700, 10000.1, 770, 'BTC_USD', 'export'))
+        self.ses.commit()
+
+    def tearDown(self):
+        self.ses.query(em.Ticker).filter(em.Ticker.exchange == 'export').delete()
+        self.ses.commit()
+        self.ses.close()
+
+    def test_export_query(self):
+        query = self.ses.query(em.Ticker).filter(em.Ticker.exchange == 'export').order_by(em.Ticker.id)
+        out = StringIO.StringIO()
+        assert export_ndjson(query, out, chunk_size=2) == 3
+        lines = out.getvalue().splitlines()
+        assert len(lines) == 3
+        for line, ticker in zip(lines, query.all()):
+            assert json.loads(line) == json.loads(serialize(ticker))
+
+    def test_export_select_array(self):
+        table = em.Ticker.__table__
+        out = StringIO.StringIO()
+        count = export_ndjson(sa.select([table]).where(table.c.exchange == 'export'), out,
+                              model=em.Ticker, bind=self.eng, json_array=True)
+        tickers = json.loads(out.getvalue())
+        assert count == len(tickers) == 3
+        assert sorted(t['bid'] for t in tickers) == [769.0, 770.0, 771.0]
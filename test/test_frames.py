@@ -0,0 +1,63 @@
+import datetime
+import random
+import string
+import unittest
+
+import pytest
+from sqlalchemy_models import (create_session_engine, setup_database,
+                               user as um, wallet as wm, exchange as em)
+from sqlalchemy_models.ingest import bulk_insert_tickers
+from tapp_config import get_config
+
+np = pytest.importorskip("numpy")
+from sqlalchemy_models.frames import TickerFrame
+
+
+def make_tickers():
+    start = datetime.datetime(2016, 7, 10, 4, 56, 21)
+    return [em.Ticker(769, 771, 800, 700, 10000.1, 770, 'BTC_USD', 'a', time=start),
+            em.Ticker(0.0199, 0.0201, 0.021, 0.02, 1000000.1, 0.02, 'DASH_BTC', 'a', time=start),
+            em.Ticker(779, 781, 800, 700, 10000.1, 777, 'BTC_USD', 'a', time=start + datetime.timedelta(minutes=1)),
+            em.Ticker(770, 773, 800, 700, 10000.1, 770, 'BTC_USD', 'b', time=start)]
+
+
+def test_ticker_frame():
+    tickers = make_tickers()
+    frame = TickerFrame.from_tickers(tickers)
+    assert len(frame) == 4
+    index = frame.calculate_index()
+    for ticker, value in zip(tickers, index):
+        assert value == pytest.approx(ticker.calculate_index().to_double())
+    assert list(frame.spread()) == pytest.approx([2, 0.0002, 2, 3])
+    assert list(frame.mid()) == pytest.approx([770, 0.02, 780, 771.5])
+    returns = frame.returns()
+    assert np.isnan(returns[[0, 1, 3]]).all()
+    assert returns[2] == pytest.approx(777 / 770.0 - 1)
+    assert frame.aggregate(frame.spread(), by='exchange', how=np.max) == pytest.approx({'a': 2, 'b': 3})
+    assert sorted(frame.groups()) == ['BTC_USD', 'DASH_BTC']
+    btc = frame[frame.market == frame.markets.index('BTC_USD')]
+    assert len(btc) == 3
+    ticker = btc.to_tickers()[2]
+    assert ticker.exchange == 'b'
+    assert ticker.time == tickers[3].time
+    assert str(ticker.ask) == "773.00000000 USD"
+
+
+class TestTickerFrame(unittest.TestCase):
+    def setUp(self):
+        self.ses, self.eng = create_session_engine(cfg=get_config("helper"))
+        setup_database(self.eng, modules=[um, em, wm])
+
+    def tearDown(self):
+        self.ses.close()
+
+    def test_from_query(self):
+        exchange = ''.join([random.choice(string.ascii_letters) for letter in xrange(12)])
+        bulk_insert_tickers(self.ses, [(t.bid, t.ask, t.high, t.low, t.volume, t.last, t.market, exchange, t.time)
+                                       for t in make_tickers()])
+        self.ses.commit()
+        frame = TickerFrame.from_query(self.ses.query(em.Ticker).filter(em.Ticker.exchange == exchange))
+        assert len(frame) == 4
+        assert frame.exchanges == [exchange]
+        assert sorted(frame.aggregate(frame.last, how=np.min).values()) == pytest.approx([0.02, 770])
+        assert frame.time.min() == np.datetime64(datetime.datetime(2016, 7, 10, 4, 56, 21))
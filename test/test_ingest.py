@@ -0,0 +1,123 @@
+import datetime
+import random
+import string
+import unittest
+
+import pytz
+from ledger import Amount
+from sqlalchemy_models import (create_session_engine, setup_database,
+                               user as um, wallet as wm, exchange as em)
+from sqlalchemy_models.ingest import (bulk_insert_tickers, bulk_insert_trades,
+                                      bulk_insert_limit_orders, bulk_insert_ignore_trades,
+                                      bulk_insert_ignore_limit_orders, ingest_credits, normalize)
+from tapp_config import get_config
+
+
+def test_normalize_trade():
+    eastern = pytz.timezone('US/Eastern').localize(datetime.datetime(2016, 7, 10, 0, 56, 21))
+    row = normalize(em.Trade, ('abc', 'helper', 'BTC_USD', 'sell', 1.1, 770, 1, 'quote', eastern))
+    assert row['trade_id'] == 'helper|abc'
+    assert row['trade_side'] == 'sell'
+    assert row['time'] == datetime.datetime(2016, 7, 10, 4, 56, 21)
+    order = normalize(em.LimitOrder, {'price': 770, 'amount': 1.1, 'market': 'BTC_USD',
+                                      'side': 'ask', 'exchange': 'helper', 'order_id': 'abc'})
+    assert order['order_id'] == 'helper|abc'
+    assert order['state'] == 'pending'
+    assert order['exec_amount'] == 0
+
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.ses, self.eng = create_session_engine(cfg=get_config("helper"))
+        setup_database(self.eng, modules=[um, em, wm])
+
+    def tearDown(self):
+        self.ses.close()
+
+    def test_bulk_insert_trades(self):
+        tids = [''.join([random.choice(string.ascii_letters) for letter in xrange(19)]) for n in xrange(3)]
+        result = bulk_insert_trades(self.ses, [(tid, 'helper', 'BTC_USD', 'buy', Amount("%s BTC" % 1.1),
+                                                Amount("%s USD" % 770), 1, 'quote') for tid in tids])
+        self.ses.commit()
+        assert result.rows == 3
+        assert result.rows_per_second > 0
+        trades = self.ses.query(em.Trade).filter(em.Trade.trade_id.in_(["helper|%s" % tid for tid in tids])).all()
+        assert len(trades) == 3
+        assert "1.10000000 BTC" == str(trades[0].amount)
+        assert "1.00000000 USD" == str(trades[0].fee)
+
+    def test_bulk_insert_tickers_orders(self):
+        exchange = ''.join([random.choice(string.ascii_letters) for letter in xrange(12)])
+        result = bulk_insert_tickers(self.eng, [{'bid': 769, 'ask': 771, 'high': 800, 'low': 700,
+                                                 'volume': 10000.1, 'last': 770, 'market': 'BTC_USD',
+                                                 'exchange': exchange}] * 5, batch_size=2)
+        assert result.rows == 5
+        assert self.ses.query(em.Ticker).filter(em.Ticker.exchange == exchange).count() == 5
+        result = bulk_insert_limit_orders(self.eng, [(770, 1.1, 'BTC_USD', 'ask', exchange)])
+        assert result.rows == 1
+        order = self.ses.query(em.LimitOrder).filter(em.LimitOrder.exchange == exchange).one()
+        assert order.order_id.startswith("tmp|")
+        assert "770.00000000 USD" == str(order.price)
+
+    def test_bulk_insert_ignore(self):
+        tids = [''.join([random.choice(string.ascii_letters) for letter in xrange(19)]) for n in xrange(4)]
+        rows = [(tid, 'helper', 'BTC_USD', 'buy', Amount("1.1 BTC"), Amount("770 USD"), 1, 'quote') for tid in tids]
+        result = bulk_insert_ignore_trades(self.ses, rows[:2])
+        assert (result.inserted, result.skipped) == (2, 0)
+        result = bulk_insert_ignore_trades(self.ses, rows + rows[3:], batch_size=3)
+        assert (result.inserted, result.skipped) == (2, 3)
+        self.ses.commit()
+        trades = self.ses.query(em.Trade).filter(em.Trade.trade_id.in_(["helper|%s" % tid for tid in tids])).all()
+        assert len(trades) == 4
+        assert "770.00000000 USD" == str(trades[0].price)
+        oid = ''.join([random.choice(string.ascii_letters) for letter in xrange(19)])
+        result = bulk_insert_ignore_limit_orders(self.eng, [(770, 1.1, 'BTC_USD', 'ask', 'helper', oid)] * 2)
+        assert (result.inserted, result.skipped) == (1, 1)
+
+    def test_ingest_credits(self):
+        user = um.User(username=''.join([random.choice(string.ascii_letters) for letter in xrange(8)]))
+        self.ses.add(user)
+        self.ses.commit()
+        txid = ''.join([random.choice(string.ascii_letters) for letter in xrange(19)])
+        date = datetime.datetime.utcfromtimestamp(1468126581)
+        row = lambda vout, state: (Amount("1.1 BTC"), txid, 'BTC', 'Bitcoin', state, 'scan',
+                                   "%s:%s" % (txid, vout), user.id, date)
+        result = ingest_credits(self.ses, [row(0, 'unconfirmed'), row(1, 'complete')])
+        assert sorted(c.ref_id for c in result.inserted) == ["%s:0" % txid, "%s:1" % txid]
+        assert result.confirmed == []
+        assert result.inserted[0].amount == 1.1
+        result = ingest_credits(self.ses, [row(0, 'complete'), row(1, 'unconfirmed'), row(2, 'unconfirmed')],
+                                batch_size=2)
+        assert [c.ref_id for c in result.inserted] == ["%s:2" % txid]
+        assert [(c.ref_id, c.transaction_state) for c in result.confirmed] == [("%s:0" % txid, 'complete')]
+        self.ses.commit()
+        credits = self.ses.query(wm.Credit).filter(wm.Credit.address == txid).order_by(wm.Credit.ref_id).all()
+        assert [c.transaction_state for c in credits] == ['complete', 'complete', 'unconfirmed']
+        assert "1.10000000 BTC" == str(credits[0].amount)
+
+
+def test_on_conflict_statement_postgres():
+    from sqlalchemy.dialects import postgresql
+    from sqlalchemy_models.statements import on_conflict_statement
+    batch = [normalize(em.Trade, ('abc', 'helper', 'BTC_USD', 'buy', 1.1, 770, 1, 'quote')),
+             normalize(em.Trade, ('def', 'helper', 'BTC_USD', 'buy', 1.1, 770, 1, 'quote'))]
+    stmt, params = on_conflict_statement(postgresql.dialect(), em.Trade.__table__, batch, 'trade_id')
+    sql = str(stmt.compile(dialect=postgresql.dialect()))
+    assert sql.startswith("INSERT INTO trade (id, amount, ")
+    assert sql.count("nextval('trade_id_seq')") == 2
+    assert sql.endswith("ON CONFLICT (trade_id) DO NOTHING RETURNING id")
+    assert params['trade_id_1'] == 'helper|def'
+
+
+def test_credit_statement_postgres():
+    from sqlalchemy.dialects import postgresql
+    from sqlalchemy_models.ingest import _credit_statement
+    date = datetime.datetime.utcfromtimestamp(1468126581)
+    batch = [normalize(wm.Credit, (1.1, 'addr', 'BTC', 'Bitcoin', 'complete', 'scan', 'tx:0', 1, date))]
+    stmt, params = _credit_statement(postgresql.dialect(), batch)
+    sql = str(stmt.compile(dialect=postgresql.dialect()))
+    assert sql.startswith("INSERT INTO credit (id, address, amount, ")
+    assert "VALUES (nextval('credit_id_seq'), " in sql
+    assert "ON CONFLICT (ref_id) DO UPDATE SET transaction_state = excluded.transaction_state" in sql
+    assert sql.endswith("transaction_state, xmax = 0")
+    assert params['ref_id_0'] == 'tx:0'
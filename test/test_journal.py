@@ -0,0 +1,117 @@
+import datetime
+import os
+import random
+import string
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from ledger import Amount
+from sqlalchemy_models import (create_session_engine, setup_database,
+                               user as um, wallet as wm, exchange as em)
+from sqlalchemy_models.journal import (append_journal, export_journal, read_checkpoint,
+                                       render_trades, trade_rows)
+from tapp_config import get_config
+
+
+def golden_trades():
+    date = datetime.datetime.utcfromtimestamp(1468126581)
+    trades = []
+    for side in ('sell', 'buy'):
+        for price, fee, fee_side in [(770, "1 USD", 'quote'), (770, "0.01 BTC", 'base'),
+                                     (770.5, "0.25 USD", 'quote'), (123456.789, "0.5 BTC", 'base'),
+                                     (0.00012345, "0.3 USD", 'quote')]:
+            tid = ''.join([random.choice(string.ascii_letters) for letter in xrange(19)])
+            trades.append(em.Trade(tid, 'helper', 'BTC_USD', side, Amount("1.1 BTC"),
+                                   Amount("%s USD" % price), Amount(fee), fee_side, date))
+    return trades
+
+
+def test_render_trades():
+    trades = golden_trades()
+    rows = [(t.trade_id, t.exchange, t.market, t.trade_side, t.amount.to_double(), t.price.to_double(),
+             t.fee.to_double(), t.fee_side, t.time) for t in trades]
+    entries = render_trades(rows)
+    for trade, entry in zip(trades, entries):
+        assert entry == trade.get_ledger_entry()
+    assert entries[0] == """P 2016/07/10 04:56:21 BTC 770.00000000 USD
+P 2016/07/10 04:56:21 USD 0.00129870 BTC
+2016/07/10 04:56:21 helper BTC_USD sell
+    ;<Trade(trade_id='{0}', side='sell', amount=1.10000000 BTC, price=770.00000000 USD, fee=1.00000000 USD, fee_side='quote', market='BTC_USD', exchange='helper', time=2016-07-10T04:56:21+00:00)>
+    Assets:helper:USD    846.00000000 USD @ 0.00129870 BTC
+    FX:BTC_USD:sell   -847.00000000 USD @ 0.00129870 BTC
+    Assets:helper:BTC    -1.10000000 BTC @ 770.00000000 USD
+    FX:BTC_USD:sell   1.10000000 BTC @ 770.00000000 USD
+    Expenses:TradeFee    1.00000000 USD @ 0.00129870 BTC
+""".format(trades[0].trade_id)
+    assert render_trades([]) == []
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.ses, self.eng = create_session_engine(cfg=get_config("helper"))
+        setup_database(self.eng, modules=[um, em, wm])
+        self.checkpoint = export_journal(self.ses, StringIO(), processes=0).checkpoint
+        self.user = um.User(username=''.join([random.choice(string.ascii_letters) for letter in xrange(8)]))
+        self.ses.add(self.user)
+        self.ses.commit()
+
+    def tearDown(self):
+        self.ses.close()
+
+    def add_history(self):
+        tid = ''.join([random.choice(string.ascii_letters) for letter in xrange(19)])
+        date = datetime.datetime.utcfromtimestamp(1468126581)
+        objs = [wm.Debit(Amount("1.1 BTC"), Amount("0.0001 BTC"), tid, 'BTC', 'Bitcoin', 'complete',
+                         'helper', 'helper|%s' % tid, self.user.id, date + datetime.timedelta(seconds=2)),
+                em.Trade(tid, 'helper', 'BTC_USD', 'buy', Amount("1.1 BTC"), Amount("770 USD"),
+                         Amount("0.01 BTC"), 'base', date),
+                wm.Credit(Amount("1.1 BTC"), tid, 'BTC', 'Bitcoin', 'complete', 'helper',
+                          'helper|%s' % tid, self.user.id, date + datetime.timedelta(seconds=1))]
+        self.ses.add_all(objs)
+        self.ses.commit()
+        return objs
+
+    def test_export_journal(self):
+        debit, trade, credit = self.add_history()
+        for processes in (0, 2):
+            out = StringIO()
+            result = export_journal(self.ses, out, checkpoint=self.checkpoint, chunk_size=2, processes=processes)
+            assert result.entries == 3
+            assert result.checkpoint == {'Trade': trade.id, 'Credit': credit.id, 'Debit': debit.id}
+            assert out.getvalue() == trade.get_ledger_entry() + credit.get_ledger_entry() + debit.get_ledger_entry()
+        assert export_journal(self.ses, StringIO(), checkpoint=result.checkpoint, processes=0).entries == 0
+
+    def test_append_journal(self):
+        tmpdir = tempfile.mkdtemp()
+        path, checkpoint_path = os.path.join(tmpdir, 'journal.ledger'), os.path.join(tmpdir, 'checkpoint.json')
+        append_journal(self.ses, path, checkpoint_path, processes=0)
+        debit, trade, credit = self.add_history()
+        assert append_journal(self.ses, path, checkpoint_path, processes=0).entries == 3
+        assert read_checkpoint(checkpoint_path)['Debit'] == debit.id
+        with open(path, 'r') as f:
+            assert f.read().endswith(debit.get_ledger_entry())
+
+    def test_append_journal_rerun(self):
+        tmpdir = tempfile.mkdtemp()
+        path, checkpoint_path = os.path.join(tmpdir, 'journal.ledger'), os.path.join(tmpdir, 'checkpoint.json')
+        with open(path, 'w') as f:
+            f.write("; not from a checkpointed run\n")
+        append_journal(self.ses, path, checkpoint_path, processes=0)
+        with open(path, 'r') as f:
+            journal = f.read()
+        assert not journal.startswith("; not from")  # no checkpoint, so the journal was started over
+        debit, trade, credit = self.add_history()
+        with open(path, 'a') as f:
+            f.write(trade.get_ledger_entry())  # appended by a run that died before its checkpoint
+        assert append_journal(self.ses, path, checkpoint_path, processes=0).entries == 3
+        with open(path, 'r') as f:
+            assert f.read() == journal + (trade.get_ledger_entry() + credit.get_ledger_entry() +
+                                          debit.get_ledger_entry())
+
+    def test_trade_rows(self):
+        trades = golden_trades()
+        self.ses.add_all(trades)
+        self.ses.commit()
+        query = self.ses.query(em.Trade).filter(em.Trade.id.in_([t.id for t in trades])).order_by(em.Trade.id)
+        assert render_trades(trade_rows(query)) == [t.get_ledger_entry() for t in query]
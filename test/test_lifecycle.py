@@ -10,15 +10,18 @@ import os
 import random
 import string
 import unittest
+from decimal import Decimal
 
 from jsonschema import validate
 from ledger import Amount
-from sqlalchemy_models import (sa, generate_signature_class, Base,
+from sqlalchemy_models import (sa, generate_signature_class, Base, LedgerAmount, amount_sum, migrate_amount_storage,
                                create_session_engine, setup_database, get_schemas, jsonify2,
+                               serialize, serialize_many,
                                user as um, wallet as wm, exchange as em)
 from tapp_config import get_config
 
-from sqlalchemy_models.util import create_user, build_definitions, multiply_tickers
+from sqlalchemy_models.serialize import SERIALIZERS
+from sqlalchemy_models.util import create_user, create_users, build_definitions, multiply_tickers
 
 SCHEMAS = get_schemas()
 
@@ -58,8 +61,10 @@ class TestSetupLogger(unittest.TestCase):
     def setUp(self):
         self.ses, self.eng = create_session_engine(cfg=get_config("helper"))
         setup_database(self.eng, modules=[um, em, wm])
+        self.strict, SERIALIZERS.strict = SERIALIZERS.strict, True
 
     def tearDown(self):
+        SERIALIZERS.strict = self.strict
         self.ses.close()
     #     try:
     #         os.remove(self.uri)
@@ -87,6 +92,15 @@ class TestSetupLogger(unittest.TestCase):
         del ukey_dict['user']
         assert validate(ukey_dict, ukey_schema) is None
 
+    def test_serialize_clean(self):
+        ticker = em.Ticker(769, 771, 800, 700, 10000.1, 770, 'BTC_USD', 'helper')
+        self.ses.add(ticker)
+        self.ses.commit()
+        jticker = jsonify2(ticker, 'Ticker')
+        assert serialize_many([ticker]) == [jticker]
+        assert not self.ses.dirty
+        assert isinstance(ticker.bid, Amount)
+
     def test_create_user(self):
         address = ''.join([random.choice(string.ascii_letters) for n in xrange(19)])
         userdict = {'username': address[0:8]}
@@ -94,6 +108,36 @@ class TestSetupLogger(unittest.TestCase):
         assert user.username == userdict['username']
         ukey = self.ses.query(um.UserKey).filter(um.UserKey.user_id == user.id).first()
         assert ukey.key == address
+        self.assertRaises(Exception, create_user, userdict['username'], address[::-1], self.ses)
+        assert self.ses.query(um.UserKey).filter(um.UserKey.key == address[::-1]).count() == 0
+
+    def test_create_users(self):
+        names = [''.join([random.choice(string.ascii_letters) for n in xrange(12)]) for i in xrange(4)]
+        keys = [''.join([random.choice(string.ascii_letters) for n in xrange(36)]) for i in xrange(4)]
+        create_user(names[0], keys[0], self.ses)
+        result = create_users(self.ses, [(names[0], keys[3]), (names[1], keys[1]), (names[2], keys[0]),
+                                         (names[3], keys[2], 'tfa'), (names[3], keys[3])], batch_size=3)
+        self.ses.commit()
+        assert [username for username, user_id in result.users] == [names[1], names[3]]
+        assert [(index, reason) for index, username, reason in result.failures] == [
+            (0, "username exists"), (2, "key exists"), (4, "username exists")]
+        ukey = self.ses.query(um.UserKey).filter(um.UserKey.key == keys[2]).one()
+        assert (ukey.user.username, ukey.keytype, ukey.last_nonce) == (names[3], 'tfa', 0)
+        assert self.ses.query(um.User).filter(um.User.username == names[2]).count() == 0
+
+    def test_create_users_statements_postgres(self):
+        from sqlalchemy.dialects import postgresql
+        from sqlalchemy_models.util import _key_statement, _user_statement
+        now = datetime.datetime.utcnow()
+        rows = [(0, 'alice', 'key0', 'public'), (1, 'bob', 'key1', 'tfa')]
+        stmt, params = _user_statement(postgresql.dialect(), rows, now)
+        sql = str(stmt.compile(dialect=postgresql.dialect()))
+        assert sql.startswith('INSERT INTO "user" (id, createtime, username) VALUES (nextval(\'user_id_seq\'), ')
+        assert sql.endswith("ON CONFLICT (username) DO NOTHING RETURNING id, username")
+        stmt, params = _key_statement(postgresql.dialect(), rows, {'alice': 1, 'bob': 2}, now)
+        sql = str(stmt.compile(dialect=postgresql.dialect()))
+        assert sql.count("nextval('user_key_id_seq')") == 2
+        assert (params['user_id_1'], params['keytype_1']) == (2, 'tfa')
 
     def test_override_id(self):
         class StrIdClass(Base):
@@ -124,6 +168,21 @@ class TestSetupLogger(unittest.TestCase):
         assert "1.10000000 BTC" == str(dbtrade.amount)
         assert "1.00000000 USD" == str(dbtrade.fee)
 
+    def test_load_trade_base_fee(self):
+        tid = ''.join([random.choice(string.ascii_letters) for letter in xrange(19)])
+        trade = em.Trade(tid, 'helper', 'DASH_BTC', 'buy',
+                         Amount("%s DASH" % 2), Amount("%s BTC" % 0.02),
+                         Amount("%s DASH" % 0.01), 'base', datetime.datetime.utcnow())
+        self.ses.add(trade)
+        self.ses.commit()
+        self.ses.expunge(trade)
+        dbtrade = self.ses.query(em.Trade).filter(em.Trade.trade_id == "helper|%s" % tid).one()
+        assert "2.00000000 DASH" == str(dbtrade.amount)
+        assert "0.02000000 BTC" == str(dbtrade.price)
+        assert "0.01000000 DASH" == str(dbtrade.fee)
+        price, = self.ses.query(em.Trade.price).filter(em.Trade.trade_id == "helper|%s" % tid).one()
+        assert "0.02000000 BTC" == str(price)
+
     def test_load_ticker(self):
         ticker = em.Ticker(Amount("%s USD" % 769), Amount("%s USD" % 771),
                            Amount("%s USD" % 800), Amount("%s USD" % 700),
@@ -358,6 +417,57 @@ def test_ticker_encoding():
     assert ticker.time == from_dticker.time
 
 
+def test_ticker_serialize():
+    ticker = em.Ticker(769, 771, 800, 700, 10000.1, 770, 'BTC_USD', 'helper')
+    strict, SERIALIZERS.strict = SERIALIZERS.strict, True
+    try:
+        jticker = serialize(ticker)
+        assert jticker == jsonify2(ticker, 'Ticker')
+        assert serialize_many([ticker, ticker]) == [jticker, jticker]
+    finally:
+        SERIALIZERS.strict = strict
+
+
+def golden_object(model, user, skip):
+    """A detached model object with every column set, except every skip-th is None."""
+    obj = sa.orm.class_mapper(model).class_manager.new_instance()
+    for i, prop in enumerate(sa.orm.class_mapper(model).column_attrs):
+        column_type = prop.columns[0].type
+        if skip and i % skip == skip - 1:
+            value = None
+        elif type(column_type).__name__ == 'LedgerAmount':  # the models import it as __init__.LedgerAmount
+            value = Amount("%s BTC" % (1.23456789 + i))
+        elif isinstance(column_type, sa.Enum):
+            value = column_type.enums[-1]
+        elif isinstance(column_type, sa.DateTime):
+            value = datetime.datetime(2016, 7, 10, 4, 56, 21, 1000 * i)
+        elif isinstance(column_type, sa.Integer):
+            value = 7 + i
+        else:
+            value = "%s%d" % (prop.key, i)
+        setattr(obj, prop.key, value)
+    if hasattr(model, 'user') and user is not None:
+        obj.user = user
+    return obj
+
+
+def test_serializers_match_jsonify():
+    from alchemyjsonschema.dictify import jsonify
+    for module in (um, wm, em):
+        for name in module.__all__:
+            if name not in SCHEMAS:
+                continue  # no schema to serialize with, i.e. Candle
+            model = getattr(module, name)
+            for skip in (0, 2, 3):
+                user = golden_object(um.User, None, skip)
+                obj = golden_object(model, user, skip)
+                reference = golden_object(model, golden_object(um.User, None, skip), skip)
+                for key, value in reference.__dict__.items():  # what jsonify2 used to write back
+                    if isinstance(value, Amount):
+                        setattr(reference, key, value.to_double())
+                assert serialize(obj) == json.dumps(jsonify(reference, SERIALIZERS.spec(name))), (name, skip)
+
+
 def test_ticker_multiply():
     usdticker = em.Ticker(769, 771, 800, 700, 10000.1, 770, 'BTC_USD', 'helper')
     usdticker.load_commodities()
@@ -371,6 +481,52 @@ def test_ticker_multiply():
     assert dashusdticker.last == Amount("%s USD" % 15.4)
 
 
+def test_exact_amount_storage():
+    bigint = LedgerAmount(commodity='BTC', storage='bigint')
+    assert bigint.process_bind_param(Amount("1.10000000 BTC"), None) == 110000000
+    assert bigint.process_bind_param(0.1 + 0.2, None) == 30000000
+    assert "1.10000000 BTC" == str(bigint.process_result_value(110000000, None))
+    numeric = LedgerAmount(storage='numeric')
+    assert numeric.process_bind_param(0.1, None) == Decimal("0.10000000")
+    assert "0.10000000" == str(numeric.process_result_value(Decimal("0.1"), None))
+
+
+def amount_table(storage, metadata=None):
+    return sa.Table('amounts', metadata or sa.MetaData(), sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('currency', sa.String(4)),
+                    sa.Column('amount', LedgerAmount(storage=storage)))
+
+
+def test_amount_sum():
+    for storage in ('bigint', 'numeric'):
+        eng = sa.create_engine("sqlite://")
+        table = amount_table(storage)
+        table.metadata.create_all(eng)
+        eng.execute(table.insert(), [{'currency': 'BTC', 'amount': 0.1}, {'currency': 'BTC', 'amount': 0.2},
+                                     {'currency': 'USD', 'amount': 5}])
+        total = eng.execute(sa.select([amount_sum(table.c.amount, commodity='BTC')]).where(
+            table.c.currency == 'BTC')).scalar()
+        assert "0.30000000 BTC" == str(total)
+        grouped = eng.execute(sa.select([table.c.currency, amount_sum(table.c.amount, commodity=table.c.currency)])
+                              .group_by(table.c.currency).order_by(table.c.currency)).fetchall()
+        assert [(currency, str(value)) for currency, value in grouped] == [('BTC', "0.30000000 BTC"),
+                                                                           ('USD', "5.00000000 USD")]
+        eng.dispose()
+
+
+def test_migrate_amount_storage():
+    for storage, stored in (('bigint', 30000000), ('numeric', 0.3)):
+        eng = sa.create_engine("sqlite://")
+        table = amount_table('float')
+        table.metadata.create_all(eng)
+        eng.execute(table.insert(), [{'currency': 'BTC', 'amount': 0.1 + 0.2}])
+        migrated = amount_table(storage)
+        migrate_amount_storage(eng, migrated.c.amount)
+        assert eng.execute(sa.text("SELECT amount FROM amounts")).scalar() == stored
+        assert "0.30000000 BTC" == str(eng.execute(sa.select([amount_sum(migrated.c.amount, 'BTC')])).scalar())
+        eng.dispose()
+
+
 def test_ticker_index():
     ticker = em.Ticker(769, 773, 800, 700, 10000.1, 771, 'BTC_USD', 'helper')
     ticker.load_commodities()
@@ -0,0 +1,119 @@
+import random
+import string
+import unittest
+from decimal import Decimal
+
+from sqlalchemy_models import (create_session_engine, setup_database,
+                               user as um, wallet as wm, exchange as em)
+from sqlalchemy_models.orders import BookOrder, OrderBook, OrderBooks, _PriceList, reconcile_orders
+from tapp_config import get_config
+
+
+class TestOrderBook(unittest.TestCase):
+    def test_levels(self):
+        book = OrderBook('helper', 'BTC_USD')
+        book.update(BookOrder('a', 'bid', Decimal('100'), Decimal('1')))
+        book.update(BookOrder('b', 'bid', Decimal('101'), Decimal('2')))
+        book.update(BookOrder('c', 'bid', Decimal('101'), Decimal('0.5')))
+        book.update(BookOrder('d', 'ask', Decimal('103'), Decimal('1')))
+        book.update(BookOrder('e', 'ask', Decimal('102'), Decimal('3')))
+        assert book.best_bid() == (Decimal('101'), Decimal('2.5'))
+        assert book.best_ask() == (Decimal('102'), Decimal('3'))
+        assert book.depth_at('bid', 101) == Decimal('2.5')
+        assert book.cumulative_depth('bid') == [(Decimal('101'), Decimal('2.5')), (Decimal('100'), Decimal('3.5'))]
+        assert book.cumulative_depth('ask', levels=1) == [(Decimal('102'), Decimal('3'))]
+        book.update(BookOrder('b', 'bid', Decimal('101'), Decimal('1.5')))  # partial fill
+        assert book.best_bid() == (Decimal('101'), Decimal('2.0'))
+        book.remove('b')
+        book.update(BookOrder('c', 'bid', Decimal('101'), Decimal('0')))  # filled
+        assert book.best_bid() == (Decimal('100'), Decimal('1'))
+        book.update(BookOrder('e', 'ask', Decimal('104'), Decimal('3')))  # moved
+        assert book.levels('ask') == [(Decimal('103'), Decimal('1')), (Decimal('104'), Decimal('3'))]
+        assert len(book) == 3
+
+    def test_price_list(self):
+        prices = _PriceList()  # the fallback without sortedcontainers
+        for price in (3, 1, 2):
+            prices.add(Decimal(price))
+        prices.remove(Decimal(2))
+        assert list(prices) == [Decimal(1), Decimal(3)]
+
+
+class TestOrderBooks(unittest.TestCase):
+    def setUp(self):
+        self.ses, self.eng = create_session_engine(cfg=get_config("helper"))
+        setup_database(self.eng, modules=[um, em, wm])
+        self.books = OrderBooks()
+        self.market = ''.join([random.choice(string.ascii_uppercase) for letter in xrange(4)]) + "_USD"
+
+    def tearDown(self):
+        self.books.close()
+        self.ses.close()
+
+    def test_load_and_follow(self):
+        bid = em.LimitOrder(770, 1, self.market, 'bid', 'helper', state='open')
+        self.ses.add(bid)
+        self.ses.add(em.LimitOrder(775, 2, self.market, 'ask', 'helper', state='open'))
+        self.ses.add(em.LimitOrder(760, 5, self.market, 'bid', 'helper', state='closed'))
+        self.ses.commit()
+        book = self.books.book('helper', self.market, session=self.ses)
+        assert len(book) == 2
+        assert book.best_bid() == (Decimal('770'), Decimal('1'))
+        assert book.best_ask() == (Decimal('775'), Decimal('2'))
+
+        bid.exec_amount = 0.25
+        self.ses.add(em.LimitOrder(771, 1, self.market, 'bid', 'helper', state='open'))
+        self.ses.flush()
+        assert book.best_bid() == (Decimal('770'), Decimal('1'))  # not committed yet
+        self.ses.commit()
+        assert book.best_bid() == (Decimal('771'), Decimal('1'))
+        assert book.depth_at('bid', 770) == Decimal('0.75')
+
+        bid.state = 'closed'
+        self.ses.commit()
+        assert book.depth_at('bid', 770) == 0
+        assert bid.order_id not in book
+
+        self.ses.add(em.LimitOrder(780, 1, self.market, 'ask', 'helper', state='open'))
+        self.ses.flush()
+        self.ses.rollback()
+        assert book.cumulative_depth('ask') == [(Decimal('775'), Decimal('2'))]
+
+    def test_load_before_commit(self):
+        other, eng = create_session_engine(cfg=get_config("helper"))
+        try:
+            self.ses.add(em.LimitOrder(770, 1, self.market, 'bid', 'helper', state='open'))
+            self.ses.flush()
+            book = self.books.book('helper', self.market, session=other)  # loaded without the uncommitted bid
+            assert book.best_bid() is None
+            self.ses.commit()
+            assert book.best_bid() == (Decimal('770'), Decimal('1'))
+        finally:
+            other.close()
+
+
+class TestReconcile(unittest.TestCase):
+    def setUp(self):
+        self.ses, self.eng = create_session_engine(cfg=get_config("helper"))
+        setup_database(self.eng, modules=[um, em, wm])
+
+    def tearDown(self):
+        self.ses.close()
+
+    def test_reconcile_orders(self):
+        ids = [''.join([random.choice(string.ascii_letters) for letter in xrange(19)]) for n in xrange(3)]
+        orders = [em.LimitOrder(770 + n, 1, 'BTC_USD', 'bid', 'helper', order_id=oid, state='open')
+                  for n, oid in enumerate(ids)]
+        self.ses.add_all(orders)
+        self.ses.commit()
+        result = reconcile_orders(self.ses, [(ids[0], 0.25, 'open'), (ids[1], 1, 'closed'),
+                                             (ids[2], 0, 'open'), ('missing', 1, 'closed')], exchange='helper')
+        assert sorted(o.order_id for o in result.orders) == sorted(orders[n].order_id for n in (0, 1))
+        changes = result.state_changes
+        assert len(changes) == 1
+        assert (changes[0].order_id, changes[0].old_state, changes[0].state) == (orders[1].order_id, 'open', 'closed')
+        assert changes[0].book_order().remaining == 0
+        self.ses.commit()
+        assert "0.25000000 BTC" == str(orders[0].exec_amount)
+        assert orders[1].state == 'closed'
+        assert reconcile_orders(self.ses, [(ids[0], 0.25, 'open')], exchange='helper').orders == []
@@ -0,0 +1,27 @@
+import sqlalchemy as sa
+from sqlalchemy_models import setup_database, user as um, wallet as wm
+from sqlalchemy_models.schema import fingerprint_table, store_fingerprints
+
+
+def test_setup_database_tables():
+    eng = sa.create_engine("sqlite://")  # not the shared engine, so only these tables exist
+    result = setup_database(eng, models=[wm.Balance])
+    assert [t.name for t in result.tables] == ['balance', 'user']
+    assert result.created
+    assert set(sa.inspect(eng).get_table_names()) == {'balance', 'user'}
+    eng.dispose()
+
+
+def test_setup_database_fingerprint():
+    eng = sa.create_engine("sqlite://")
+    result = setup_database(eng, modules=[um, wm], fingerprint=True)
+    assert result.created
+    assert list(result.timings) == ['collect', 'fingerprint', 'create_all', 'store']
+    result = setup_database(eng, modules=[um, wm], fingerprint=True)
+    assert not result.created
+    assert list(result.timings) == ['collect', 'fingerprint']
+    store_fingerprints(eng, {'balance': 'stale'})
+    assert setup_database(eng, modules=[um, wm], fingerprint=True).created
+    assert eng.execute(sa.select([fingerprint_table.c.fingerprint])
+                       .where(fingerprint_table.c.name == 'balance')).scalar() != 'stale'
+    eng.dispose()
@@ -0,0 +1,80 @@
+import datetime
+import random
+import string
+import unittest
+
+from sqlalchemy_models import create_session_engine, setup_database, user as um, wallet as wm, exchange as em
+from sqlalchemy_models.settings import SettingsCache, catalog, load_settings, set_settings
+from tapp_config import get_config
+
+
+class TestSettings(unittest.TestCase):
+    def setUp(self):
+        self.ses, self.eng = create_session_engine(cfg=get_config("helper"))
+        setup_database(self.eng, modules=[um, em, wm],
+                       models=[um.Setting, um.IntUserSetting, um.StrUserSetting, um.DateTimeUserSetting])
+        self.users = [um.User(username=''.join([random.choice(string.ascii_letters) for letter in xrange(8)]))
+                      for n in xrange(2)]
+        self.ses.add_all(self.users)
+        self.names = dict((value_type, ''.join([random.choice(string.ascii_letters) for letter in xrange(12)]))
+                          for value_type in ('int', 'str', 'date-time'))
+        self.ses.add_all([um.Setting(name=name, value_type=value_type) for value_type, name in self.names.items()])
+        self.ses.commit()
+
+    def tearDown(self):
+        self.ses.close()
+
+    def test_settings(self):
+        cache = SettingsCache()
+        try:
+            catalog.load(self.ses, reload=True)
+            when = datetime.datetime(2016, 7, 10, 4, 56, 21)
+            first, second = [u.id for u in self.users]
+            written = set_settings(self.ses, {first: {self.names['int']: 3, self.names['str']: 'a',
+                                                      self.names['date-time']: when},
+                                              second: {self.names['int']: 4}}, cache=cache)
+            assert written == 4
+            self.ses.commit()
+            settings = load_settings(self.ses, [first, second], cache=cache)
+            assert settings[first] == {self.names['int']: 3, self.names['str']: 'a', self.names['date-time']: when}
+            assert settings[second] == {self.names['int']: 4}
+            assert load_settings(self.ses, [first], cache=cache)[first] == settings[first]
+            assert cache.hits == 1
+            set_settings(self.ses, {first: {self.names['int']: 5, self.names['str']: None}}, cache=cache)
+            self.ses.commit()
+            assert load_settings(self.ses, [first], cache=cache)[first] == {self.names['int']: 5,
+                                                                           self.names['date-time']: when}
+            self.assertRaises(ValueError, set_settings, self.ses, {first: {'missing': 1}})
+        finally:
+            cache.close()
+
+    def test_settings_cache_rollback(self):
+        cache = SettingsCache()
+        other, eng = create_session_engine(cfg=get_config("helper"))
+        try:
+            catalog.load(self.ses, reload=True)
+            user_id = self.users[0].id
+            set_settings(self.ses, {user_id: {self.names['int']: 1}}, cache=cache)
+            self.ses.commit()
+            set_settings(self.ses, {user_id: {self.names['int']: 99}}, cache=cache)
+            assert load_settings(self.ses, [user_id], cache=cache)[user_id] == {self.names['int']: 99}
+            self.ses.rollback()
+            assert load_settings(self.ses, [user_id], cache=cache)[user_id] == {self.names['int']: 1}
+            set_settings(self.ses, {user_id: {self.names['int']: 2}}, cache=cache)
+            # another session caches the committed value before the write is committed
+            assert load_settings(other, [user_id], cache=cache)[user_id] == {self.names['int']: 1}
+            other.commit()
+            self.ses.commit()
+            assert load_settings(other, [user_id], cache=cache)[user_id] == {self.names['int']: 2}
+        finally:
+            other.close()
+            cache.close()
+
+    def test_set_new_setting(self):
+        catalog.load(self.ses, reload=True)
+        name = ''.join([random.choice(string.ascii_letters) for letter in xrange(12)])
+        self.ses.add(um.Setting(name=name, value_type='int'))
+        self.ses.commit()
+        assert set_settings(self.ses, {self.users[0].id: {name: 7}}) == 1
+        self.ses.commit()
+        assert load_settings(self.ses, [self.users[0].id])[self.users[0].id] == {name: 7}
@@ -0,0 +1,62 @@
+import datetime
+import random
+import string
+import unittest
+
+from ledger import Amount
+from sqlalchemy_models import (create_session_engine, setup_database,
+                               user as um, wallet as wm, exchange as em)
+from sqlalchemy_models.ingest import bulk_insert_tickers
+from sqlalchemy_models.tickers import TickerStore
+from tapp_config import get_config
+
+
+class TestTickerStore(unittest.TestCase):
+    def setUp(self):
+        self.ses, self.eng = create_session_engine(cfg=get_config("helper"))
+        setup_database(self.eng, modules=[um, em, wm])
+        self.store = TickerStore(ttl=60)
+        self.market = ''.join([random.choice(string.ascii_uppercase) for letter in xrange(4)]) + "_USD"
+
+    def tearDown(self):
+        self.store.close()
+        self.ses.close()
+
+    def test_get_on_commit(self):
+        old = em.Ticker(769, 771, 800, 700, 10000.1, 770, self.market, 'helper',
+                        time=datetime.datetime.utcnow() - datetime.timedelta(minutes=1))
+        self.ses.add(em.Ticker(768, 772, 800, 700, 10000.1, 771, self.market, 'helper'))
+        self.ses.flush()
+        assert self.store.get('helper', self.market) is None  # not committed yet
+        self.ses.commit()
+        assert "768.00000000 USD" == str(self.store.get('helper', self.market).bid)
+        self.ses.add(old)
+        self.ses.commit()
+        assert "768.00000000 USD" == str(self.store.get('helper', self.market).bid)
+        self.ses.add(em.Ticker(1, 2, 3, 0, 1, 1, self.market, 'helper'))
+        self.ses.flush()
+        self.ses.rollback()
+        assert "768.00000000 USD" == str(self.store.get('helper', self.market).bid)
+
+    def test_read_through_and_stale(self):
+        bulk_insert_tickers(self.ses, [(769, 771, 800, 700, 10000.1, 770, self.market, 'helper',
+                                        datetime.datetime.utcnow() - datetime.timedelta(minutes=5))])
+        self.ses.commit()
+        assert self.store.get('helper', self.market) is None
+        assert "771.00000000 USD" == str(self.store.get('helper', self.market, session=self.ses).ask)
+        self.ses.close()
+        assert "770.00000000 USD" == str(self.store.get('helper', self.market).last)
+        self.store.max_age = 60
+        assert self.store.get('helper', self.market) is None
+
+    def test_best(self):
+        for exchange, bid, ask, last in [('a', 769, 771, 770), ('b', 770, 772, 771), ('c', 768, 770.5, 769)]:
+            self.store.update(em.Ticker(bid, ask, 800, 700, 10, last, self.market, exchange))
+        best = self.store.best(self.market)
+        assert best.exchange == 'multiple'
+        assert best.market == self.market
+        assert best.bid == Amount("770 USD")
+        assert best.ask == Amount("770.5 USD")
+        assert best.last == Amount("769 USD")
+        assert "30.00000000 %s" % self.market.split("_")[0] == str(best.volume)
+        assert self.store.best('NONE_USD') is None